@@ -0,0 +1,245 @@
+# agent/anomaly_scan.py
+"""
+Batch anomaly scan that sets Expense.is_flagged across all users (meant to run nightly).
+
+Three checks, all computed with vectorized NumPy group-bys over columnar chunks:
+
+* duplicate:     same user, normalized vendor and amount within ANOMALY_DUPLICATE_WINDOW_SECONDS
+                 of an earlier expense (the earliest one stays unflagged);
+* outlier:       more than ANOMALY_Z_THRESHOLD standard deviations from the user's other
+                 expenses in that category (leave-one-out, so the outlier does not hide itself);
+* concentration: one vendor accounts for ANOMALY_VENDOR_SHARE or more of a user's spend.
+
+Memory is bounded by the partition size: a streamed per-user count cuts the table into
+user_id ranges of about ANOMALY_SCAN_CHUNK_ROWS rows, and each range (whole users only, so
+every statistic is exact) is loaded and scanned on its own. The new flags replace the old
+ones in a single transaction on the group-commit writer.
+
+    python -m agent.anomaly_scan [--db sqlite:///poc_main.db] [--user U1] [--dry-run]
+"""
+import argparse
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import Integer, cast, func, update
+from sqlmodel import select
+
+from client_config import (
+    ANOMALY_SCAN_CHUNK_ROWS, ANOMALY_Z_THRESHOLD, ANOMALY_MIN_HISTORY, ANOMALY_DUPLICATE_WINDOW_SECONDS,
+    ANOMALY_VENDOR_SHARE,
+)
+from .db import Expense, get_db_engine
+from .shards import SHARD_ROUTER, shard_engines
+from .vendor_index import normalize_vendor
+from .writer import get_writer
+from . import metrics
+
+REASONS = ("duplicate", "outlier", "concentration")
+
+# The spread of a category norm is at least this share of its mean, so a run of identical
+# amounts (a subscription) does not turn every small price change into an outlier
+MIN_RELATIVE_SPREAD = 0.1
+# Flagged ids per UPDATE statement (stays below SQLite's bound-parameter limit)
+UPDATE_BATCH_SIZE = 500
+
+
+@dataclass
+class ScanReport:
+    rows_scanned: int = 0
+    partitions: int = 0
+    flagged: int = 0
+    previously_flagged: int = 0
+    reasons: Dict[str, int] = field(default_factory=lambda: dict.fromkeys(REASONS, 0))
+    dry_run: bool = False
+    seconds: float = 0.0
+
+
+def scan_expenses(db_engine: Optional[Any] = None, user_id: Optional[str] = None,
+                  chunk_rows: int = ANOMALY_SCAN_CHUNK_ROWS, z_threshold: float = ANOMALY_Z_THRESHOLD,
+                  min_history: int = ANOMALY_MIN_HISTORY, duplicate_window: float = ANOMALY_DUPLICATE_WINDOW_SECONDS,
+                  vendor_share: float = ANOMALY_VENDOR_SHARE, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Scans every user's expenses (or only `user_id`'s) and replaces is_flagged with the result.
+    db_engine is an engine, a ShardRouter or None (every shard of the application's router).
+    With dry_run=True nothing is written; the report still counts what would be flagged.
+    """
+    report = ScanReport(dry_run=dry_run)
+    start = time.perf_counter()
+
+    with metrics.phase("anomaly_scan"):
+        # Users never span shards, so each shard is scanned and flagged on its own
+        for shard_engine in shard_engines(db_engine, user_id):
+            flagged_ids: List[np.ndarray] = []
+            for low, high in list(_user_partitions(shard_engine, chunk_rows, user_id)):
+                columns = _load_partition(shard_engine, low, high)
+                masks = flag_anomalies(*columns, z_threshold=z_threshold, min_history=min_history,
+                                       duplicate_window=duplicate_window, vendor_share=vendor_share)
+                flagged = np.logical_or.reduce(list(masks.values()))
+                flagged_ids.append(columns[0][flagged])
+
+                report.partitions += 1
+                report.rows_scanned += len(columns[0])
+                for reason, mask in masks.items():
+                    report.reasons[reason] += int(mask.sum())
+
+            ids = np.concatenate(flagged_ids) if flagged_ids else np.empty(0, dtype=np.int64)
+            report.flagged += len(ids)
+            if not dry_run:
+                report.previously_flagged += get_writer(shard_engine).run(
+                    lambda session: _apply_flags(session, ids, user_id)
+                )
+
+    report.seconds = round(time.perf_counter() - start, 3)
+    logging.info(f"ANOMALY SCAN: Flagged {report.flagged} of {report.rows_scanned} expenses "
+                 f"in {report.partitions} partitions ({report.reasons})")
+    return asdict(report)
+
+
+def flag_anomalies(ids: np.ndarray, users: np.ndarray, vendors: np.ndarray, amounts: np.ndarray,
+                   categories: np.ndarray, timestamps: np.ndarray, z_threshold: float = ANOMALY_Z_THRESHOLD,
+                   min_history: int = ANOMALY_MIN_HISTORY, duplicate_window: float = ANOMALY_DUPLICATE_WINDOW_SECONDS,
+                   vendor_share: float = ANOMALY_VENDOR_SHARE) -> Dict[str, np.ndarray]:
+    """
+    One boolean mask per reason for a set of complete user histories. `timestamps` are epoch
+    seconds (NaN for rows without created_at, which are never duplicates).
+    """
+    user_codes = _factorize(users)
+    category_codes = _factorize(categories)
+    # Normalizing is per distinct vendor string, not per row
+    unique_vendors, vendor_inverse = np.unique(vendors, return_inverse=True)
+    vendor_codes = _factorize(np.array([normalize_vendor(v) for v in unique_vendors], dtype=object))[vendor_inverse]
+
+    return {
+        "duplicate": _duplicates(ids, user_codes, vendor_codes, amounts, timestamps, duplicate_window),
+        "outlier": _outliers(user_codes, category_codes, amounts, z_threshold, min_history),
+        "concentration": _concentration(user_codes, vendor_codes, amounts, min_history, vendor_share),
+    }
+
+
+# --- Vectorized checks ---
+
+def _duplicates(ids, user_codes, vendor_codes, amounts, timestamps, window: float) -> np.ndarray:
+    cents = np.round(amounts * 100).astype(np.int64)
+    # Sorted by user, vendor, amount, then time (ties by id): a duplicate directly follows its original
+    order = np.lexsort((ids, timestamps, cents, vendor_codes, user_codes))
+    same_charge = (
+        (np.diff(user_codes[order]) == 0)
+        & (np.diff(vendor_codes[order]) == 0)
+        & (np.diff(cents[order]) == 0)
+        & (np.diff(timestamps[order]) <= window)
+    )
+    duplicate = np.zeros(len(ids), dtype=bool)
+    duplicate[order[1:][same_charge]] = True
+    return duplicate
+
+
+def _outliers(user_codes, category_codes, amounts, z_threshold: float, min_history: int) -> np.ndarray:
+    group = _group(user_codes, category_codes)
+    count = np.bincount(group)[group].astype(np.float64)
+    total = np.bincount(group, weights=amounts)[group]
+    total_sq = np.bincount(group, weights=amounts * amounts)[group]
+
+    # Mean and spread of the *other* expenses in the row's (user, category) group
+    others = count - 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (total - amounts) / others
+        variance = (total_sq - amounts * amounts) / others - mean * mean
+    spread = np.maximum(np.sqrt(np.clip(variance, 0.0, None)), MIN_RELATIVE_SPREAD * np.abs(mean))
+    with np.errstate(invalid="ignore"):
+        return (others >= min_history) & (np.abs(amounts - mean) > z_threshold * spread)
+
+
+def _concentration(user_codes, vendor_codes, amounts, min_history: int, vendor_share: float) -> np.ndarray:
+    user_count = np.bincount(user_codes)[user_codes]
+    user_total = np.bincount(user_codes, weights=amounts)[user_codes]
+    pair = _group(user_codes, vendor_codes)
+    pair_total = np.bincount(pair, weights=amounts)[pair]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = pair_total / user_total
+        return (user_count >= min_history) & (user_total > 0) & (share >= vendor_share)
+
+
+def _factorize(values: np.ndarray) -> np.ndarray:
+    """Dense integer codes (0..n_distinct-1) for any sortable array."""
+    return np.unique(values, return_inverse=True)[1].reshape(-1)
+
+
+def _group(*codes: np.ndarray) -> np.ndarray:
+    """Dense group ids for the combination of several code arrays."""
+    key = codes[0].astype(np.int64)
+    for extra in codes[1:]:
+        key = key * (int(extra.max(initial=0)) + 1) + extra
+    return _factorize(key)
+
+
+# --- DB access ---
+
+def _user_partitions(db_engine, chunk_rows: int, user_id: Optional[str]) -> Iterator[Tuple[str, str]]:
+    """(first, last) user_id ranges of about chunk_rows expenses each, from a streamed per-user count."""
+    statement = select(Expense.user_id, func.count()).group_by(Expense.user_id).order_by(Expense.user_id)
+    if user_id is not None:
+        statement = statement.where(Expense.user_id == user_id)
+
+    with db_engine.connect() as connection:
+        low, high, rows = None, None, 0
+        for current_user, count in connection.execution_options(stream_results=True).execute(statement):
+            if low is not None and rows + count > chunk_rows:
+                yield low, high
+                low, rows = None, 0
+            if low is None:
+                low = current_user
+            high, rows = current_user, rows + count
+        if low is not None:
+            yield low, high
+
+
+def _load_partition(db_engine, low: str, high: str) -> Tuple[np.ndarray, ...]:
+    """The partition's columns as arrays: ids, users, vendors, amounts, categories, timestamps."""
+    statement = select(
+        Expense.id, Expense.user_id, Expense.vendor, Expense.amount, Expense.category,
+        cast(func.strftime("%s", Expense.created_at), Integer)
+    ).where(Expense.user_id >= low, Expense.user_id <= high)
+
+    with db_engine.connect() as connection:
+        rows = connection.execute(statement).all()
+    ids, users, vendors, amounts, categories, timestamps = zip(*rows) if rows else ((),) * 6
+    return (
+        np.array(ids, dtype=np.int64),
+        np.array(users, dtype=object),
+        np.array(vendors, dtype=object),
+        np.array(amounts, dtype=np.float64),
+        np.array(categories, dtype=object),
+        np.array(timestamps, dtype=np.float64),  # None -> NaN
+    )
+
+
+def _apply_flags(session, flagged_ids: np.ndarray, user_id: Optional[str]) -> int:
+    """Writer job: replaces the flags in scope with `flagged_ids`. Returns how many were set before."""
+    scope = [Expense.is_flagged == True]  # noqa: E712 (SQL expression)
+    if user_id is not None:
+        scope.append(Expense.user_id == user_id)
+    previously_flagged = session.exec(update(Expense).where(*scope).values(is_flagged=False)).rowcount
+
+    id_list = flagged_ids.tolist()
+    for start in range(0, len(id_list), UPDATE_BATCH_SIZE):
+        batch = id_list[start:start + UPDATE_BATCH_SIZE]
+        session.exec(update(Expense).where(Expense.id.in_(batch)).values(is_flagged=True))
+    return previously_flagged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flag duplicate, outlier and vendor-concentrated expenses.")
+    parser.add_argument("--db", default=None, help="Database URL (defaults to every DB_SHARDS shard)")
+    parser.add_argument("--user", default=None, help="Only scan (and re-flag) this user_id")
+    parser.add_argument("--chunk-rows", type=int, default=ANOMALY_SCAN_CHUNK_ROWS)
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be flagged without writing")
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    result = scan_expenses(get_db_engine(cli_args.db) if cli_args.db else SHARD_ROUTER.init(), user_id=cli_args.user,
+                           chunk_rows=cli_args.chunk_rows, dry_run=cli_args.dry_run)
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,243 @@
+# agent/budget_cache.py
+"""
+Read-through cache of budget statuses: (user_id, category) -> limit and spend in the budget's
+current window, for check_budget_tool and GET /budgets.
+
+Every read goes through _check_budget_in_session, so repeated checks inside one plan or
+across concurrent plans skip the Budget and SpendRollup lookups. The cache never serves
+data a committed write has changed, and never stores uncommitted data:
+
+* every write that changes a user's budget or rollups (apply_to_rollups, recompute_rollups,
+  budget updates) marks the user on its session, and the entries are dropped when that
+  session commits;
+* a read in a session with pending writes for the user goes to the database and is not
+  stored (it may see rows that are rolled back later);
+* a fill is only stored if no commit touched the user since the read began (per-user
+  generation), so a read that raced with a commit cannot put back the old total.
+
+Writes from other processes (a separate job worker, the import CLI) are not seen, so entries
+also expire after BUDGET_CACHE_TTL_SECONDS. Entries are scoped by database file (an
+in-memory database by engine), so shards and test databases never share entries.
+"""
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from itertools import count
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from client_config import BUDGET_CACHE_ENABLED, BUDGET_CACHE_MAX_USERS, BUDGET_CACHE_TTL_SECONDS
+from . import metrics
+
+# session.info key: {(scope, user_id)} with uncommitted writes (user_id None = the whole scope)
+_PENDING = "budget_cache_pending"
+
+_memory_scopes: "weakref.WeakKeyDictionary[Any, str]" = weakref.WeakKeyDictionary()
+_memory_ids = count(1)
+_memory_lock = threading.Lock()
+
+
+def budget_scope(session: Session) -> str:
+    """The database a session reads: its file, or a per-engine id for in-memory databases."""
+    bind = session.get_bind()
+    database = bind.url.database
+    if database and database != ":memory:":
+        return database
+    with _memory_lock:
+        if bind not in _memory_scopes:
+            _memory_scopes[bind] = f"memory:{next(_memory_ids)}"
+        return _memory_scopes[bind]
+
+
+@dataclass
+class BudgetEntry:
+    limit: float
+    budget_period: str  # Budget.period ('all', 'month' or 'quarter')
+    period: str  # Rollup key of the window total_spent covers
+    total_spent: float
+
+
+@dataclass
+class _UserEntry:
+    expires_at: float
+    statuses: Dict[str, BudgetEntry] = field(default_factory=dict)  # By category
+    categories: Optional[List[str]] = None  # Budgeted and spent-in categories, once listed
+
+
+class BudgetCache:
+    """
+    LRU + TTL map of (scope, user_id) -> that user's cached statuses and category list,
+    bounded to max_users users (a user has a handful of categories). `lookup` returns a
+    cached entry or a fill token; `store` keeps a freshly read entry only if the token is
+    still current. A commit drops the user's whole entry.
+    """
+
+    def __init__(self, max_users: int = 10000, ttl_seconds: float = 60, enabled: bool = True):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._users: "OrderedDict[Tuple[str, str], _UserEntry]" = OrderedDict()
+        # Bumped by every commit that touches the user. Bounded like the entries: a user whose
+        # generation was evicted reads as `_floor`, which is past every token handed out for it.
+        self._generations: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._floor = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    # --- Reads ---
+
+    def lookup(self, session: Session, user_id: str, category: str) -> Tuple[Optional[BudgetEntry], Optional[int]]:
+        """
+        (entry or None, token): pass the token to `store` after reading the database. The
+        token is None when the result must not be cached (disabled, or pending writes).
+        """
+        if not self.enabled or _has_pending(session, user_id):
+            return None, None
+        key = (budget_scope(session), user_id)
+        with self._lock:
+            user = self._live(key)
+            entry = user.statuses.get(category) if user else None
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            token = self._generation(key)
+        metrics.record_cache("budget", entry is not None)
+        return entry, token
+
+    def store(self, session: Session, user_id: str, category: str, token: Optional[int], entry: BudgetEntry):
+        if token is not None:
+            self._fill(session, user_id, token, lambda user: user.statuses.__setitem__(category, entry))
+
+    def lookup_categories(self, session: Session, user_id: str) -> Tuple[Optional[List[str]], Optional[int]]:
+        """The user's budgeted and spent-in categories and a fill token, like `lookup`."""
+        if not self.enabled or _has_pending(session, user_id):
+            return None, None
+        key = (budget_scope(session), user_id)
+        with self._lock:
+            user = self._live(key)
+            categories = list(user.categories) if user is not None and user.categories is not None else None
+            return categories, self._generation(key)
+
+    def store_categories(self, session: Session, user_id: str, token: Optional[int], categories: List[str]):
+        if token is not None:
+            self._fill(session, user_id, token, lambda user: setattr(user, "categories", list(categories)))
+
+    # --- Writes ---
+
+    def mark_written(self, session: Session, user_ids: Optional[Iterable[str]] = None):
+        """
+        Records that the session changed these users' budgets or spend (None: every user of
+        its database). Their entries are dropped once the session commits.
+        """
+        pending = session.info.setdefault(_PENDING, set())
+        scope = budget_scope(session)
+        if user_ids is None:
+            pending.add((scope, None))
+        else:
+            pending.update((scope, user_id) for user_id in user_ids)
+
+    def invalidate(self, scope: str, user_id: Optional[str] = None):
+        with self._lock:
+            self.invalidations += 1
+            if user_id is None:
+                self._users = OrderedDict((key, user) for key, user in self._users.items() if key[0] != scope)
+                self._reset_generations()
+                return
+            key = (scope, user_id)
+            self._users.pop(key, None)
+            self._generations[key] = self._generation(key) + 1
+            self._generations.move_to_end(key)
+            while len(self._generations) > self.max_users:
+                _, evicted = self._generations.popitem(last=False)
+                self._floor = max(self._floor, evicted + 1)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "users": len(self._users),
+                "entries": sum(len(user.statuses) for user in self._users.values()),
+                "max_users": self.max_users,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._reset_generations()
+
+    # --- Internals ---
+
+    def _live(self, key: Tuple[str, str]) -> Optional[_UserEntry]:
+        user = self._users.get(key)
+        if user is None:
+            return None
+        if user.expires_at <= time.monotonic():
+            del self._users[key]
+            return None
+        self._users.move_to_end(key)
+        return user
+
+    def _fill(self, session: Session, user_id: str, token: int, update):
+        key = (budget_scope(session), user_id)
+        with self._lock:
+            if self._generation(key) != token:
+                return  # A commit touched the user while this was read
+            user = self._live(key)
+            if user is None:
+                user = self._users[key] = _UserEntry(expires_at=time.monotonic() + self.ttl_seconds)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+                    self.evictions += 1
+            update(user)
+
+    def _generation(self, key: Tuple[str, str]) -> int:
+        return self._generations.get(key, self._floor)
+
+    def _reset_generations(self):
+        # Every user moves past all tokens handed out so far (in-flight fills are dropped)
+        self._floor = max([self._floor, *self._generations.values()]) + 1
+        self._generations.clear()
+
+
+def _has_pending(session: Session, user_id: str) -> bool:
+    pending = session.info.get(_PENDING)
+    if not pending:
+        return False
+    scope = budget_scope(session)
+    return (scope, user_id) in pending or (scope, None) in pending
+
+
+BUDGET_CACHE = BudgetCache(
+    max_users=BUDGET_CACHE_MAX_USERS, ttl_seconds=BUDGET_CACHE_TTL_SECONDS, enabled=BUDGET_CACHE_ENABLED
+)
+
+
+# Registered on the ORM Session class, so every session (including the sync side of an
+# AsyncSession) reports its commits. Releasing a SAVEPOINT also fires after_commit; only the
+# outermost commit makes the writes visible.
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session: Session):
+    if session.in_nested_transaction():
+        return
+    for scope, user_id in session.info.pop(_PENDING, ()):
+        BUDGET_CACHE.invalidate(scope, user_id)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_rolled_back(session: Session, previous_transaction):
+    # A rolled-back SAVEPOINT keeps the marks: the other jobs of the transaction may still commit
+    if previous_transaction.parent is None:
+        session.info.pop(_PENDING, None)
@@ -0,0 +1,217 @@
+# agent/coalescer.py
+import contextvars
+import functools
+import json
+import logging
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from client_config import LLM_COALESCE_WINDOW_MS, LLM_COALESCE_MAX_BATCH
+from . import metrics
+from .llm_scheduler import LANES, current_lane
+from .planner import (
+    _planner_request, _judge_request, _coalesced_planner_request, _coalesced_judge_request, plan_request_mismatches,
+)
+
+# Batched calls that may be in flight at once (per coalescer)
+MAX_CONCURRENT_CALLS = 4
+
+# A queued call: its arguments, the caller's future and the caller's contextvars (scheduler
+# lane, per-request timings), which the pool thread sending it would otherwise not have
+Pending = Tuple[Any, Future, contextvars.Context]
+
+
+class _Lane:
+    """
+    One kind of call (planner or judge). Items queued within `window` seconds of the first
+    one, up to `max_batch`, are handed to `send` together.
+    """
+
+    def __init__(self, name: str, send: Callable[[List[Pending]], None], window: float, max_batch: int):
+        self.name = name
+        self.send = send
+        self.window = window
+        self.max_batch = max_batch
+        self.queue: "queue.Queue[Optional[Pending]]" = queue.Queue()
+        self.stats = {"items": 0, "calls": 0, "largest_batch": 0}
+        self.thread = threading.Thread(target=self._run, name=f"llm-coalescer-{name}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+
+            batch, stop = [first], False
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self.stats["items"] += len(batch)
+            self.stats["calls"] += 1
+            self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+            self.send(batch)
+            if stop:
+                return
+
+
+class LLMCoalescer:
+    """
+    Coalesces planner and judge calls from concurrent requests. Calls arriving within
+    `window_ms` of each other (at most `max_batch`) go to Gemini as ONE multi-request prompt
+    (COALESCED_PLAN_SCHEMA) and each caller's future receives the JSON text of its own plan,
+    exactly as a single call would return it. A lone item is sent as a regular single call.
+
+    Every call runs in its caller's contextvars: a single call in its own, a batched call in
+    the most urgent caller's (its scheduler lane), with the shared call's tokens added to each
+    caller's timings. Futures fail together when the batched call fails, and individually
+    when the response has no plan for their request or a judged plan does not belong to it
+    (plan_request_mismatches; single and batched calls alike), so run_planner_auditor still
+    fails fast.
+    """
+
+    def __init__(self, client, window_ms: float = LLM_COALESCE_WINDOW_MS, max_batch: int = LLM_COALESCE_MAX_BATCH,
+                 max_concurrent_calls: int = MAX_CONCURRENT_CALLS):
+        self.client = client
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent_calls, thread_name_prefix="llm-coalescer-call")
+        window = window_ms / 1000
+        # The lane threads only hold the coalescer weakly, so an unused one (and its client) is
+        # collected; its threads are then told to stop
+        this = weakref.ref(self)
+        self._planner = _Lane("planner", functools.partial(_dispatch, this, "_send_plans"), window, max_batch)
+        self._judge = _Lane("judge", functools.partial(_dispatch, this, "_send_judgements"), window, max_batch)
+        weakref.finalize(self, _stop, (self._planner, self._judge), self._pool)
+
+    def plan(self, user_id: str, expense_text: str) -> Future:
+        """Queues a planner call; the future resolves to the plan's JSON text."""
+        future: Future = Future()
+        self._planner.queue.put(((user_id, expense_text), future, contextvars.copy_context()))
+        return future
+
+    def judge(self, user_id: str, expense_text: str, proposed_plan_text: str) -> Future:
+        """Queues a judge call; the future resolves to the judged plan's JSON text."""
+        future: Future = Future()
+        self._judge.queue.put(((user_id, expense_text, proposed_plan_text), future, contextvars.copy_context()))
+        return future
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            "planner": {**self._planner.stats, "queue_depth": self._planner.queue.qsize()},
+            "judge": {**self._judge.stats, "queue_depth": self._judge.queue.qsize()},
+        }
+
+    def close(self, timeout: Optional[float] = None):
+        for lane in (self._planner, self._judge):
+            lane.queue.put(None)
+            lane.thread.join(timeout)
+        self._pool.shutdown(wait=True)
+
+    # --- Calls ---
+
+    def _send_plans(self, batch: List[Pending]):
+        if len(batch) == 1:
+            (user_id, expense_text), future, context = batch[0]
+            context.run(self._send_single, "planner", batch[0][0], future,
+                        _planner_request(user_id, expense_text, client=self.client))
+        else:
+            self._send_batch("planner", batch, _coalesced_planner_request([item for item, _, _ in batch], self.client))
+
+    def _send_judgements(self, batch: List[Pending]):
+        if len(batch) == 1:
+            (_, expense_text, proposed_plan_text), future, context = batch[0]
+            context.run(self._send_single, "judge", batch[0][0], future,
+                        _judge_request(expense_text, proposed_plan_text, client=self.client))
+        else:
+            request = _coalesced_judge_request([item[1:] for item, _, _ in batch], self.client)
+            self._send_batch("judge", batch, request)
+
+    def _send_single(self, phase: str, item: Any, future: Future, request: Dict[str, Any]):
+        try:
+            response = self.client.models.generate_content(**request)
+            metrics.record_usage(phase, response)
+            if phase == "judge":
+                self._deliver_judged(item, future, json.loads(response.text), "its request")
+            else:
+                future.set_result(response.text)
+        except Exception as e:
+            future.set_exception(e)
+
+    def _send_batch(self, phase: str, batch: List[Pending], request: Dict[str, Any]):
+        logging.info(f"COALESCER: Sending {len(batch)} {phase} requests in one call")
+        sender = min((context for _, _, context in batch), key=lambda context: LANES.index(context.run(current_lane)))
+        try:
+            response = sender.run(self.client.models.generate_content, **request)
+            sender.run(metrics.record_usage, phase, response)
+            plans = {entry.get('request_number'): entry for entry in json.loads(response.text)['plans']}
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        for number, (item, future, context) in enumerate(batch, start=1):
+            if context is not sender:
+                context.run(metrics.record_shared_usage, phase, response)
+            entry = plans.get(number)
+            if entry is None:
+                future.set_exception(ValueError(f"Coalesced {phase} response has no plan for request {number}."))
+                continue
+            plan = {key: value for key, value in entry.items() if key != 'request_number'}
+            if phase == "judge":
+                self._deliver_judged(item, future, plan, f"request {number}")
+            else:
+                future.set_result(json.dumps(plan))
+
+    @staticmethod
+    def _deliver_judged(item: Tuple[str, str, str], future: Future, plan: Dict[str, Any], label: str):
+        """Resolves a judge future with its final plan, unless the plan belongs to another request."""
+        user_id, expense_text, _ = item
+        mismatches = plan_request_mismatches(plan, user_id, expense_text)
+        if mismatches:
+            future.set_exception(ValueError(f"Coalesced judge plan for {label} does not match it: {' '.join(mismatches)}"))
+        else:
+            future.set_result(json.dumps(plan))
+
+
+def _dispatch(coalescer_ref: "weakref.ref[LLMCoalescer]", method: str, batch: List[Pending]):
+    coalescer = coalescer_ref()
+    if coalescer is not None:
+        coalescer._pool.submit(getattr(coalescer, method), batch)
+
+
+def _stop(lanes: Tuple[_Lane, ...], pool: ThreadPoolExecutor):
+    """Stops a collected coalescer's threads without waiting (it may run on one of them)."""
+    for lane in lanes:
+        lane.queue.put(None)
+    pool.shutdown(wait=False)
+
+
+# --- Coalescer registry (one per client) ---
+
+# Stored on the client it serves, like agent.llm_scheduler's wrappers: a registry would keep
+# every client alive, and one keyed by id() could hand a new client a collected one's coalescer
+_COALESCER_ATTRIBUTE = "_llm_coalescer"
+_coalescers_lock = threading.Lock()
+
+
+def get_coalescer(client) -> Optional[LLMCoalescer]:
+    """The shared coalescer for `client`, or None when coalescing is disabled (window 0)."""
+    if client is None or LLM_COALESCE_WINDOW_MS <= 0:
+        return None
+    with _coalescers_lock:
+        coalescer = getattr(client, _COALESCER_ATTRIBUTE, None)
+        if not isinstance(coalescer, LLMCoalescer) or coalescer.client is not client:
+            coalescer = LLMCoalescer(client)
+            setattr(client, _COALESCER_ATTRIBUTE, coalescer)
+        return coalescer
@@ -1,38 +1,250 @@
 # agent/db.py
 from sqlmodel import create_engine, SQLModel, Field, Session
+from sqlalchemy import Index, UniqueConstraint, event, inspect
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+from datetime import datetime, timezone
+import threading
 from typing import Optional
 
+SQLITE_FILE_NAME = "poc_main.db"
+
+# Applied to every new SQLite connection. WAL lets readers run alongside the single writer,
+# and synchronous=NORMAL only fsyncs at checkpoints instead of on every commit.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",  # ~20 MB page cache
+)
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
 # 1. Define Models
 class Expense(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_expense_user_category_created", "user_id", "category", "created_at"),
+        Index("ix_expense_user_created", "user_id", "created_at"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: str
     vendor: str
     amount: float
     category: str
     is_flagged: bool = Field(default=False)
+    # NULL only for rows created before timestamps existed; they count towards 'all' rollups only
+    created_at: Optional[datetime] = Field(default_factory=utc_now)
 
 class Budget(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: str = Field(unique=True) # Unique per user/category (for PoC)
     limit: float
     category: str
+    period: str = Field(default="all")  # Budget window: 'all', 'month' or 'quarter'
+
+class SpendRollup(SQLModel, table=True):
+    """Running spend per (user_id, category, period), maintained by the log-expense path."""
+    __table_args__ = (UniqueConstraint("user_id", "category", "period", name="uq_rollup_user_category_period"),)
 
-# 2. Engine Creation Function
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: str
+    category: str
+    period: str  # 'all', a month ('2026-10') or a quarter ('2026-Q4')
+    total: float = Field(default=0.0)
+    count: int = Field(default=0)
+
+class PlanCacheEntry(SQLModel, table=True):
+    template: str = Field(primary_key=True)  # Normalized expense text (see agent.plan_cache)
+    plan_json: str
+    created_at: float
+
+class ImportCheckpoint(SQLModel, table=True):
+    """Progress of one statement import (see agent.statement_import), committed with each chunk."""
+    import_id: str = Field(primary_key=True)
+    rows_done: int = Field(default=0)  # Input rows consumed, including skipped ones
+    rows_imported: int = Field(default=0)
+    rows_skipped: int = Field(default=0)
+    llm_resolved: int = Field(default=0)
+    affected_json: str = Field(default="[]")  # [[user_id, category], ...] touched so far
+    completed: bool = Field(default=False)
+    updated_at: Optional[datetime] = Field(default_factory=utc_now)
+
+class IdempotencyRecord(SQLModel, table=True):
+    """Claim and stored result of one /process_expense execution (see agent.idempotency)."""
+    key: str = Field(primary_key=True)
+    user_id: str
+    request_hash: Optional[str] = None  # request_fingerprint of the body the key was first used for
+    status: str = Field(default="in_progress")  # 'in_progress' or 'completed'
+    result_json: Optional[str] = None
+    created_at: float  # When the current claim was taken (epoch seconds)
+    heartbeat_at: Optional[float] = None  # Last renewal by the worker holding the claim
+    expires_at: float = Field(index=True)
+
+class AuditJob(SQLModel, table=True):
+    """One queued /process_expense audit (see agent.job_queue). `id` orders each user's jobs."""
+    __table_args__ = (
+        Index("ix_auditjob_status_id", "status", "id"),
+        Index("ix_auditjob_user_status", "user_id", "status"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    job_id: str = Field(unique=True)  # Public id (uuid hex)
+    user_id: str
+    expense_text: str
+    timings: bool = Field(default=False)
+    idempotency_key: Optional[str] = Field(default=None, index=True)
+    status: str = Field(default="queued")  # 'queued', 'running', 'done' or 'failed'
+    attempts: int = Field(default=0)
+    worker_id: Optional[str] = None
+    result_json: Optional[str] = None
+    error: Optional[str] = None
+    # Epoch seconds
+    created_at: float
+    available_at: float  # Not claimed before this (retry backoff)
+    started_at: Optional[float] = None
+    lease_expires_at: Optional[float] = None  # A running job whose lease expired is requeued
+    finished_at: Optional[float] = Field(default=None, index=True)
+
+# 2. Engine Creation Functions
 def get_db_engine(engine_url: str = None):
     """
-    Creates the database engine. Uses :memory: for testing if specified.
+    Creates the database engine with its schema in place. Uses :memory: for testing if specified.
     """
+    engine = create_db_engine(engine_url)
+    init_db(engine)
+    return engine
+
+def create_db_engine(engine_url: str = None):
+    """Creates the database engine without touching the schema (see init_db)."""
     if engine_url is None:
         # Default for the main application (persistent file)
-        sqlite_file_name = "poc_main.db"
-        engine_url = f"sqlite:///{sqlite_file_name}"
+        engine_url = f"sqlite:///{SQLITE_FILE_NAME}"
         
+    kwargs = {}
+    if ":memory:" in engine_url:
+        # One shared connection, so the writer thread sees the same in-memory DB as the caller
+        kwargs["poolclass"] = StaticPool
+
     engine = create_engine(
         engine_url, 
-        connect_args={"check_same_thread": False} # Required for SQLite with FastAPI
+        connect_args={"check_same_thread": False}, # Required for SQLite with FastAPI
+        **kwargs
     )
-    SQLModel.metadata.create_all(engine)
+    configure_sqlite(engine)
     return engine
 
-# The global engine used by the main application
-engine = get_db_engine()
+def init_db(engine=None):
+    """
+    Startup hook: creates missing tables and applies upgrade_schema. Defaults to the
+    application's engine (see get_engine); run once per process before serving requests.
+    A database from before spend rollups gets its SpendRollup rows backfilled from the
+    Expense rows it already holds, so budget checks keep counting that spend.
+    """
+    engine = engine if engine is not None else get_engine()
+    inspector = inspect(engine)
+    backfill_rollups = (inspector.has_table(Expense.__tablename__)
+                        and not inspector.has_table(SpendRollup.__tablename__))
+    SQLModel.metadata.create_all(engine)
+    upgrade_schema(engine)
+    if backfill_rollups:
+        from .rollups import rebuild_rollups  # agent.rollups imports this module
+        rebuild_rollups(engine)
+
+def configure_sqlite(engine):
+    """
+    Applies SQLITE_PRAGMAS on connect and hands transaction control to SQLAlchemy (the
+    documented pysqlite recipe), which SAVEPOINT-based group commit needs to work correctly.
+    A connection with the `sqlite_immediate` execution option begins with BEGIN IMMEDIATE,
+    taking the write lock before its first read (for check-then-insert transactions).
+    """
+    @event.listens_for(engine, "connect")
+    def _on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None  # Disable pysqlite's own BEGIN handling
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def _on_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE" if conn.get_execution_options().get("sqlite_immediate") else "BEGIN")
+
+def upgrade_schema(engine):
+    """
+    Adds columns and indexes introduced after a database file was created; create_all only
+    creates missing tables. Existing rows get NULL or the column's scalar default.
+    """
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column.type.compile(engine.dialect)}'
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if isinstance(default, str):
+                    ddl += f" NOT NULL DEFAULT '{default}'"
+                elif default is not None:
+                    ddl += f" NOT NULL DEFAULT {int(default) if isinstance(default, bool) else default}"
+                conn.exec_driver_sql(ddl)
+
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+def get_async_db_engine(engine_url: str = None):
+    """
+    Creates the aiosqlite engine used by the async pipeline.
+    Table creation must be awaited, so call init_async_db() for fresh databases.
+    """
+    if engine_url is None:
+        engine_url = f"sqlite+aiosqlite:///{SQLITE_FILE_NAME}"
+
+    kwargs = {"connect_args": {"check_same_thread": False}}
+    if ":memory:" in engine_url:
+        # Every pooled connection would otherwise get its own empty in-memory DB
+        kwargs["poolclass"] = StaticPool
+    async_engine = create_async_engine(engine_url, **kwargs)
+    configure_sqlite(async_engine.sync_engine)
+    return async_engine
+
+def database_name(bind) -> str:
+    """
+    The database file behind an engine or session. The sync and aiosqlite engines of one
+    file share it, so it identifies a shard whichever pipeline wrote to it.
+    """
+    if hasattr(bind, "get_bind"):
+        bind = bind.get_bind()
+    return bind.url.database or ""
+
+async def init_async_db(async_engine):
+    """Creates all tables on an async engine (e.g. a fresh in-memory test DB)."""
+    async with async_engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+
+# 3. The application's engines, created on first use (importing this module has no side effects)
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_engine():
+    """The shared engine for SQLITE_FILE_NAME. Its schema is created by init_db() at startup."""
+    return _memoized_engine("sync", create_db_engine)
+
+def get_async_engine():
+    """The shared aiosqlite engine for the same file as get_engine()."""
+    return _memoized_engine("async", get_async_db_engine)
+
+def _memoized_engine(kind: str, factory):
+    engine = _engines.get(kind)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(kind)
+            if engine is None:
+                engine = _engines[kind] = factory()
+    return engine
@@ -1,7 +1,14 @@
 # agent/executor.py
-from typing import Dict, Any, Optional
-from .tools import TOOL_REGISTRY
+from typing import Dict, Any, List, Optional
+from .tools import (
+    TOOL_REGISTRY, ASYNC_TOOL_REGISTRY, SESSION_TOOL_REGISTRY,
+    _log_expenses_in_session, _check_budget_in_session,
+)
+from .shards import resolve_engine, resolve_async_engine
+from .writer import get_writer, get_async_writer
+from . import metrics
 import logging
+import time
 
 def execute_plan_step(tool_name: str, args: Dict[str, Any], user_id: str, db_engine: Optional[Any]) -> Dict[str, Any]:
     """
@@ -10,15 +17,10 @@ def execute_plan_step(tool_name: str, args: Dict[str, Any], user_id: str, db_eng
     logging.info(f"EXECUTOR: Starting execution for {tool_name}")
 
     if tool_name not in TOOL_REGISTRY:
-        error_msg = f"Tool '{tool_name}' not found in registry."
-        logging.error(error_msg)
-        return {"tool_name": tool_name, "status": "FAILED", "result": error_msg}
+        return _unknown_tool_result(tool_name)
 
     tool_function = TOOL_REGISTRY[tool_name]
-
-    final_args = args.copy()
-    final_args['user_id'] = user_id
-    final_args['db_engine'] = db_engine  # CRITICAL: Pass the DB engine
+    final_args = _build_tool_args(args, user_id, db_engine)
 
     try:
         # Unpack and execute the core Python function
@@ -36,4 +38,179 @@ def execute_plan_step(tool_name: str, args: Dict[str, Any], user_id: str, db_eng
         "status": status,
         "arguments_used": final_args,
         "result": tool_result
-    }
\ No newline at end of file
+    }
+
+async def execute_plan_step_async(tool_name: str, args: Dict[str, Any], user_id: str, db_engine: Optional[Any]) -> Dict[str, Any]:
+    """
+    Async counterpart of execute_plan_step. Expects an async engine (or None for the default).
+    """
+    logging.info(f"EXECUTOR: Starting async execution for {tool_name}")
+
+    if tool_name not in ASYNC_TOOL_REGISTRY:
+        return _unknown_tool_result(tool_name)
+
+    tool_function = ASYNC_TOOL_REGISTRY[tool_name]
+    final_args = _build_tool_args(args, user_id, db_engine)
+
+    try:
+        tool_result = await tool_function(**final_args)
+        status = "SUCCESS"
+        logging.info(f"EXECUTOR: Success for {tool_name}")
+
+    except Exception as e:
+        tool_result = f"Tool Execution Error: {type(e).__name__}: {str(e)}"
+        status = "FAILED"
+        logging.error(f"EXECUTOR: Error during {tool_name}: {tool_result}")
+
+    return {
+        "tool_name": tool_name,
+        "status": status,
+        "arguments_used": final_args,
+        "result": tool_result
+    }
+
+def execute_plan(steps: List[Dict[str, Any]], user_id: str, db_engine: Optional[Any]) -> List[Dict[str, Any]]:
+    """
+    Executes a whole plan as ONE job on the group-commit writer of the user's shard
+    (db_engine is an engine, a ShardRouter or None; see agent.shards): a single session and
+    transaction for all steps, committed together with concurrent plans. Each step runs in
+    its own SAVEPOINT so a failing step does not undo the others.
+    """
+    logging.info(f"EXECUTOR: Submitting {len(steps)} steps to the group-commit writer")
+    try:
+        with metrics.phase("execute"):
+            return get_writer(resolve_engine(db_engine, user_id)).run(
+                lambda session: _run_steps_in_session(session, steps, user_id)
+            )
+    except Exception as e:
+        return _commit_failure(steps, e)
+
+async def execute_plan_async(steps: List[Dict[str, Any]], user_id: str, db_engine: Optional[Any]) -> List[Dict[str, Any]]:
+    """Async counterpart of execute_plan for aiosqlite engines."""
+    logging.info(f"EXECUTOR: Submitting {len(steps)} steps to the async group-commit writer")
+    try:
+        with metrics.phase("execute"):
+            return await get_async_writer(resolve_async_engine(db_engine, user_id)).run(
+                lambda session: _run_steps_in_session(session, steps, user_id)
+            )
+    except Exception as e:
+        return _commit_failure(steps, e)
+
+def _run_steps_in_session(session, steps: List[Dict[str, Any]], user_id: str) -> List[Dict[str, Any]]:
+    history = []
+    for step in steps:
+        tool_name = step.get('tool_name', 'UNKNOWN')
+        if tool_name not in SESSION_TOOL_REGISTRY:
+            history.append(_unknown_tool_result(tool_name))
+            continue
+
+        final_args = _build_tool_args(step.get('arguments', {}), user_id, None)
+        start = time.perf_counter()
+        try:
+            with session.begin_nested():
+                tool_result = SESSION_TOOL_REGISTRY[tool_name](session, **final_args)
+            status = "SUCCESS"
+            logging.info(f"EXECUTOR: Success for {tool_name}")
+        except Exception as e:
+            tool_result = f"Tool Execution Error: {type(e).__name__}: {str(e)}"
+            status = "FAILED"
+            logging.error(f"EXECUTOR: Error during {tool_name}: {tool_result}")
+        metrics.record_step(tool_name, status, time.perf_counter() - start)
+
+        history.append({
+            "tool_name": tool_name,
+            "status": status,
+            "arguments_used": final_args,
+            "result": tool_result
+        })
+    return history
+
+def _commit_failure(steps: List[Dict[str, Any]], e: Exception) -> List[Dict[str, Any]]:
+    error = f"Tool Execution Error: commit failed: {type(e).__name__}: {str(e)}"
+    logging.error(f"EXECUTOR: {error}")
+    return [
+        {"tool_name": step.get('tool_name', 'UNKNOWN'), "status": "FAILED", "result": error}
+        for step in steps
+    ]
+
+def execute_batch_plan(steps: List[Dict[str, Any]], user_id: str, db_engine: Optional[Any]) -> List[Dict[str, Any]]:
+    """
+    Executes a multi-expense plan (BATCH_PLAN_SCHEMA). All 'log_expense_tool' steps are inserted
+    as one group-commit job (all or nothing), then each distinct category gets exactly one
+    budget check.
+    Duplicate checks for an already-checked category are dropped. History keeps plan order.
+    """
+    logging.info(f"EXECUTOR: Starting batch execution of {len(steps)} steps")
+
+    history: List[Optional[Dict[str, Any]]] = [None] * len(steps)
+    log_positions, expenses = [], []
+    check_positions: Dict[str, int] = {}
+
+    for position, step in enumerate(steps):
+        tool_name = step.get('tool_name', 'UNKNOWN')
+        args = step.get('arguments', {})
+        if tool_name == "log_expense_tool":
+            log_positions.append(position)
+            expenses.append(args)
+        elif tool_name == "check_budget_tool":
+            check_positions.setdefault(args.get('category'), position)
+        else:
+            history[position] = _unknown_tool_result(tool_name)
+
+    with metrics.phase("execute"):
+        writer = get_writer(resolve_engine(db_engine, user_id))
+
+        if expenses:
+            try:
+                messages = writer.run(lambda session: _log_expenses_in_session(session, user_id, expenses))
+                results = [("SUCCESS", message) for message in messages]
+                logging.info(f"EXECUTOR: Logged {len(expenses)} expenses in one transaction")
+            except Exception as e:
+                error = f"Tool Execution Error: {type(e).__name__}: {str(e)}"
+                logging.error(f"EXECUTOR: Batch insert rolled back: {error}")
+                results = [("FAILED", error)] * len(expenses)
+
+            for position, (status, result) in zip(log_positions, results):
+                step = steps[position]
+                history[position] = {
+                    "tool_name": "log_expense_tool",
+                    "status": status,
+                    "line_item": step.get('line_item'),
+                    "arguments_used": _build_tool_args(step.get('arguments', {}), user_id, None),
+                    "result": result
+                }
+
+        if check_positions:
+            try:
+                statuses = writer.run(lambda session: {
+                    category: _check_budget_in_session(session, user_id, category) for category in check_positions
+                })
+                results = {category: ("SUCCESS", statuses[category]) for category in check_positions}
+            except Exception as e:
+                error = f"Tool Execution Error: {type(e).__name__}: {str(e)}"
+                logging.error(f"EXECUTOR: Batch budget check failed: {error}")
+                results = {category: ("FAILED", error) for category in check_positions}
+
+            for category, position in check_positions.items():
+                status, result = results[category]
+                history[position] = {
+                    "tool_name": "check_budget_tool",
+                    "status": status,
+                    "arguments_used": _build_tool_args(steps[position].get('arguments', {}), user_id, None),
+                    "result": result
+                }
+
+    return [entry for entry in history if entry is not None]
+
+def _build_tool_args(args: Dict[str, Any], user_id: str, db_engine: Optional[Any]) -> Dict[str, Any]:
+    """Copies the planned arguments and injects the trusted user_id and DB engine."""
+    final_args = args.copy()
+    final_args['user_id'] = user_id
+    if db_engine is not None:
+        final_args['db_engine'] = db_engine  # CRITICAL: Pass the DB engine
+    return final_args
+
+def _unknown_tool_result(tool_name: str) -> Dict[str, Any]:
+    error_msg = f"Tool '{tool_name}' not found in registry."
+    logging.error(error_msg)
+    return {"tool_name": tool_name, "status": "FAILED", "result": error_msg}
@@ -0,0 +1,254 @@
+# agent/fake_llm.py
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.genai import errors, types
+
+# Any object exposing this surface can be passed as `client` to the orchestrators:
+#   client.models.generate_content(model=, contents=, config=)
+#   client.aio.models.generate_content(...) / generate_content_stream(...)
+# FakeGeminiClient implements it offline for CI, benchmarks and air-gapped boxes.
+
+PHASES = ("planner", "judge", "summary", "categorize")
+
+_REQUEST_RE = re.compile(r"Request:\s*(.*)", re.DOTALL)
+_LINE_ITEM_RE = re.compile(r"^\s*(\d+)\.\s+(.+)$", re.MULTILINE)
+_FIRST_NUMBER_RE = re.compile(r"\d[\d,]*(?:\.\d+)?")
+_COALESCED_REQUEST_RE = re.compile(r"^### Request (\d+)\n", re.MULTILINE)
+_STATEMENT_ROW_RE = re.compile(r"^(\d+)\. Vendor: (.*)$", re.MULTILINE)
+
+
+class FakeGeminiClient:
+    """
+    Deterministic stand-in for genai.Client. Planner calls return schema-valid PLAN_SCHEMA /
+    BATCH_PLAN_SCHEMA / COALESCED_PLAN_SCHEMA JSON built from the request text, Judge calls
+    approve the proposed plan, categorizer calls (statement import) answer every row and
+    summary calls restate the budget status found in the execution history.
+
+    latency/jitter (seconds) are added to every call; error_rate and timeout_rate inject
+    429 RESOURCE_EXHAUSTED errors and timeouts. A seed makes runs reproducible.
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 timeout_rate: float = 0.0, timeout: float = 30.0, seed: Optional[int] = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.vertexai = False  # Read by types.FunctionDeclaration.from_callable
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = {phase: 0 for phase in PHASES}
+        self.seconds = {phase: 0.0 for phase in PHASES}  # Simulated latency spent per phase
+        self.errors = {"rate_limited": 0, "timeouts": 0}
+        self.models = _FakeModels(self)
+        self.aio = _FakeAio(_FakeAsyncModels(self))
+
+    @classmethod
+    def from_env(cls, environ) -> "FakeGeminiClient":
+        """Builds a client from FAKE_LLM_* variables (used when LLM_BACKEND=fake)."""
+        return cls(
+            latency=float(environ.get("FAKE_LLM_LATENCY", "0")),
+            jitter=float(environ.get("FAKE_LLM_JITTER", "0")),
+            error_rate=float(environ.get("FAKE_LLM_ERROR_RATE", "0")),
+            timeout_rate=float(environ.get("FAKE_LLM_TIMEOUT_RATE", "0")),
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": dict(self.calls), "seconds": dict(self.seconds), "errors": dict(self.errors)}
+
+    # --- Simulation ---
+
+    def _begin_call(self, config) -> Tuple[str, float, Optional[Exception]]:
+        """Picks the phase, the simulated latency and an injected failure (if any)."""
+        phase = _detect_phase(config)
+        with self._lock:
+            self.calls[phase] += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            roll = self._random.random()
+            failure = None
+            if roll < self.error_rate:
+                self.errors["rate_limited"] += 1
+                failure = errors.ClientError(429, {"error": {
+                    "code": 429, "message": "Fake quota exhausted.", "status": "RESOURCE_EXHAUSTED"}})
+            elif roll < self.error_rate + self.timeout_rate:
+                self.errors["timeouts"] += 1
+                delay, failure = self.timeout, TimeoutError("Fake LLM request timed out.")
+            self.seconds[phase] += delay
+        return phase, delay, failure
+
+    def _respond(self, phase: str, contents: Any) -> types.GenerateContentResponse:
+        prompt = _contents_text(contents)
+        if phase == "categorize":
+            text = json.dumps(_fake_categories(prompt))
+        elif phase != "summary" and _COALESCED_REQUEST_RE.match(prompt):
+            text = json.dumps(_fake_coalesced(phase, prompt))
+        elif phase == "planner":
+            text = json.dumps(_fake_plan(prompt))
+        elif phase == "judge":
+            text = json.dumps(_fake_judgement(prompt))
+        else:
+            text = _fake_summary(prompt)
+        return _response(text, prompt)
+
+
+class _FakeModels:
+    def __init__(self, client: FakeGeminiClient):
+        self._client = client
+
+    def generate_content(self, *, model: str, contents: Any, config: Any = None) -> types.GenerateContentResponse:
+        phase, delay, failure = self._client._begin_call(config)
+        time.sleep(delay)
+        if failure:
+            raise failure
+        return self._client._respond(phase, contents)
+
+
+class _FakeAsyncModels:
+    def __init__(self, client: FakeGeminiClient):
+        self._client = client
+
+    async def generate_content(self, *, model: str, contents: Any, config: Any = None) -> types.GenerateContentResponse:
+        phase, delay, failure = self._client._begin_call(config)
+        await asyncio.sleep(delay)
+        if failure:
+            raise failure
+        return self._client._respond(phase, contents)
+
+    async def generate_content_stream(self, *, model: str, contents: Any, config: Any = None):
+        phase, delay, failure = self._client._begin_call(config)
+        await asyncio.sleep(delay)
+        if failure:
+            raise failure
+        response = self._client._respond(phase, contents)
+
+        async def chunks():
+            for word in re.findall(r"\S+\s*", response.text):
+                yield _response(word, "")
+        return chunks()
+
+
+class _FakeAio:
+    def __init__(self, models: _FakeAsyncModels):
+        self.models = models
+
+
+# --- Canned behaviour ---
+
+def _detect_phase(config: Any) -> str:
+    instruction = str(getattr(config, "system_instruction", "") or "")
+    if instruction.lstrip().startswith("CRITIC"):
+        return "judge"
+    if instruction.lstrip().startswith("CATEGORIZER"):
+        return "categorize"
+    if "Planner" in instruction:
+        return "planner"
+    return "summary"
+
+
+def _contents_text(contents: Any) -> str:
+    if isinstance(contents, (list, tuple)):
+        return "\n".join(str(part) for part in contents)
+    return str(contents)
+
+
+def _fake_plan(prompt: str) -> Dict[str, Any]:
+    user_match = re.search(r"User ID:\s*(\S+)", prompt)
+    user_id = user_match.group(1) if user_match else "UNKNOWN"
+    request_match = _REQUEST_RE.search(prompt)
+    request = request_match.group(1).strip() if request_match else prompt
+
+    line_items = _LINE_ITEM_RE.findall(request)
+    if not line_items:
+        expense = _guess_expense(request)
+        return {"critique": "", "plan_steps": [
+            _step(1, "log_expense_tool", user_id, **expense),
+            _step(2, "check_budget_tool", user_id, category=expense["category"]),
+        ]}
+
+    steps: List[Dict[str, Any]] = []
+    for number, text in line_items:
+        step = _step(len(steps) + 1, "log_expense_tool", user_id, **_guess_expense(text))
+        step["line_item"] = int(number)
+        steps.append(step)
+    for category in dict.fromkeys(s["arguments"]["category"] for s in steps):
+        steps.append(_step(len(steps) + 1, "check_budget_tool", user_id, category=category))
+    return {"critique": "", "plan_steps": steps}
+
+
+def _guess_expense(text: str) -> Dict[str, Any]:
+    # Imported lazily: agent.planner imports client_config, which may import this module
+    from .planner import extract_expense_fields, infer_category, _VENDOR_RE
+
+    fields = extract_expense_fields(text)
+    amount = fields["amount"]
+    if amount is None:
+        number = _FIRST_NUMBER_RE.search(text)
+        amount = float(number.group(0).replace(",", "")) if number else 0.0
+    vendor = fields["vendor"]
+    if vendor is None:
+        vendor_match = _VENDOR_RE.search(text)
+        vendor = vendor_match.group(1) if vendor_match else "Unknown Vendor"
+    category = fields["category"] or infer_category(text)[0] or "General"
+    return {"vendor": vendor, "amount": amount, "category": category}
+
+
+def _step(number: int, tool_name: str, user_id: str, **arguments) -> Dict[str, Any]:
+    return {"step_number": number, "tool_name": tool_name, "arguments": {"user_id": user_id, **arguments}}
+
+
+def _fake_coalesced(phase: str, prompt: str) -> Dict[str, Any]:
+    """Answers a multi-request prompt (agent.coalescer) item by item."""
+    parts = _COALESCED_REQUEST_RE.split(prompt)[1:]
+    plans = []
+    for number, block in zip(parts[::2], parts[1::2]):
+        plan = _fake_plan(block) if phase == "planner" else _fake_judgement(block)
+        plans.append({"request_number": int(number), **plan})
+    return {"plans": plans}
+
+
+def _fake_categories(prompt: str) -> Dict[str, Any]:
+    """Keyword category per numbered statement row, 'General' when nothing matches."""
+    from .planner import infer_category
+
+    return {"categories": [
+        {"row": int(number), "category": infer_category(line)[0] or "General"}
+        for number, line in _STATEMENT_ROW_RE.findall(prompt)
+    ]}
+
+
+def _fake_judgement(prompt: str) -> Dict[str, Any]:
+    proposed = prompt.split("Proposed Plan:", 1)[-1].strip()
+    try:
+        plan = json.loads(proposed)
+    except json.JSONDecodeError:
+        plan = {"plan_steps": []}
+    return {"critique": "Plan is valid", "plan_steps": plan.get("plan_steps", [])}
+
+
+def _fake_summary(prompt: str) -> str:
+    statuses = re.findall(r'(?:Status: |"status":\s*")(Under Budget|OVER BUDGET)', prompt)
+    if "OVER BUDGET" in statuses:
+        return "Audit complete. Warning: OVER BUDGET."
+    if statuses:
+        return "Audit complete. Status: Under Budget."
+    return "Audit complete. Budget status could not be determined."
+
+
+def _response(text: str, prompt: str) -> types.GenerateContentResponse:
+    prompt_tokens, response_tokens = max(1, len(prompt) // 4), max(1, len(text) // 4)
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(parts=[types.Part(text=text)], role="model"))],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=response_tokens,
+            total_token_count=prompt_tokens + response_tokens
+        )
+    )
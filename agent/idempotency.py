@@ -0,0 +1,255 @@
+# agent/idempotency.py
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from client_config import IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_WINDOW_SECONDS, IDEMPOTENCY_LOCK_TIMEOUT_SECONDS
+from .db import IdempotencyRecord, get_engine
+
+# How often a request waits for a claim held by another worker process (seconds)
+POLL_INTERVAL = 0.05
+
+# Keys derived from the request text (no Idempotency-Key header)
+AUTO_PREFIX = "auto:"
+
+
+class IdempotencyConflict(Exception):
+    """The Idempotency-Key was already used for a different request (answered with 422)."""
+
+
+def idempotency_key(user_id: str, expense_text: str, header_key: Optional[str] = None,
+                    window_seconds: float = IDEMPOTENCY_WINDOW_SECONDS) -> Optional[str]:
+    """
+    The store key for a request: a hash of the user and the client's Idempotency-Key, else a
+    hash of user_id + whitespace/case-normalized text. None when there is no header and the
+    text window is disabled (the default: two identical purchases are two expenses).
+    Components are hashed as a JSON list, so no two (user, key) pairs share a store key.
+    """
+    if header_key:
+        return f"key:{_digest(user_id, header_key)}"
+    if window_seconds <= 0:
+        return None
+    return f"{AUTO_PREFIX}{_digest(user_id, ' '.join(expense_text.lower().split()))}"
+
+
+def request_fingerprint(user_id: str, expense_text: str) -> str:
+    """Hash of a request body, stored with its claim so a reused key with another body is refused."""
+    return _digest(user_id, expense_text)
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Runs each idempotency key at most once. Concurrent requests in this process join the
+    running execution; other worker processes see its claim row (renewed while it runs) and
+    poll until the result is stored. Finished results are replayed from SQLite until their TTL expires.
+    Text-derived keys use a sliding window instead: a request is a retry only if it arrives
+    within window_seconds of the claim that produced the stored result; a later one runs
+    again and becomes the new claim.
+    Only results that executed plan steps are stored: a request that failed before touching
+    the database (planning error, quota) is released so a retry can run it again.
+    A request carrying a fingerprint (request_fingerprint) whose key was claimed for another
+    fingerprint raises IdempotencyConflict instead of joining or replaying.
+    """
+
+    def __init__(self, db_engine: Optional[Any] = None, ttl_seconds: float = 86400, lock_timeout: float = 120,
+                 window_seconds: float = 120):
+        self._db_engine = db_engine
+        self.ttl_seconds = ttl_seconds
+        self.lock_timeout = lock_timeout
+        self.window_seconds = window_seconds
+        # key -> (task, when it started, request fingerprint)
+        self._inflight: Dict[str, Tuple[asyncio.Task, float, Optional[str]]] = {}
+        self.executions = 0
+        self.joined = 0
+        self.replayed = 0
+
+    @property
+    def db_engine(self):
+        return self._db_engine if self._db_engine is not None else get_engine()
+
+    # --- Public API ---
+
+    async def run(self, key: Optional[str], user_id: str, execute: Callable[[], Awaitable[Dict[str, Any]]],
+                  fingerprint: Optional[str] = None) -> Tuple[Dict[str, Any], bool]:
+        """Returns (result, replayed): replayed is True when `execute` ran for an earlier request."""
+        if key is None:
+            return await execute(), False
+
+        arrived_at = time.time()
+        task, started_at, running_fingerprint = self._inflight.get(key, (None, 0.0, None))
+        window = self._window(key)
+        joined = task is not None and (window is None or arrived_at - started_at <= window)
+        if joined and _conflicts(running_fingerprint, fingerprint):
+            raise IdempotencyConflict("Idempotency-Key was already used for a different request.")
+        if not joined:
+            # A task of its own, so a caller that disconnects does not cancel the audit for the others
+            task = asyncio.ensure_future(self._run_once(key, user_id, execute, arrived_at, fingerprint))
+            self._inflight[key] = (task, arrived_at, fingerprint)
+            task.add_done_callback(
+                lambda done: self._inflight.pop(key, None) if self._inflight.get(key, (None,))[0] is done else None
+            )
+        else:
+            self.joined += 1
+            logging.info("IDEMPOTENCY: Joining the in-flight execution of a retried request")
+
+        result, replayed = await asyncio.shield(task)
+        return result, replayed or joined
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._inflight),
+            "executions": self.executions,
+            "joined": self.joined,
+            "replayed": self.replayed,
+        }
+
+    # --- Internals ---
+
+    def _window(self, key: str) -> Optional[float]:
+        """The replay window of a text-derived key (None: replay until the TTL expires)."""
+        return self.window_seconds if key.startswith(AUTO_PREFIX) else None
+
+    async def _run_once(self, key: str, user_id: str, execute: Callable[[], Awaitable[Dict[str, Any]]],
+                        arrived_at: float, fingerprint: Optional[str]) -> Tuple[Dict[str, Any], bool]:
+        while True:
+            outcome, stored = await asyncio.to_thread(self._claim, key, user_id, arrived_at, fingerprint)
+            if outcome == "claimed":
+                break
+            if outcome == "completed":
+                self.replayed += 1
+                logging.info("IDEMPOTENCY: Replaying the stored result of an earlier request")
+                return stored, True
+            await asyncio.sleep(POLL_INTERVAL)  # Another worker holds the claim
+
+        self.executions += 1
+        heartbeat = asyncio.create_task(self._heartbeat(key))
+        try:
+            result = await execute()
+        except BaseException:
+            await asyncio.to_thread(self._release, key)
+            raise
+        finally:
+            heartbeat.cancel()
+
+        if isinstance(result, dict) and result.get("full_history"):
+            await asyncio.to_thread(self._complete, key, result)
+        else:
+            await asyncio.to_thread(self._release, key)
+        return result, False
+
+    async def _heartbeat(self, key: str):
+        """Renews the claim while `execute` runs (an audit queued on the scheduler can outlast lock_timeout)."""
+        while True:
+            await asyncio.sleep(self.lock_timeout / 3)
+            try:
+                await asyncio.to_thread(self._renew, key)
+            except Exception as e:
+                logging.warning(f"IDEMPOTENCY: Could not renew claim: {e}")
+
+    def _claim(self, key: str, user_id: str, arrived_at: float,
+               fingerprint: Optional[str] = None) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """
+        Returns ('claimed', None), ('completed', stored result) or ('in_progress', None);
+        raises IdempotencyConflict when the key was claimed for a different request.
+        """
+        now = time.time()
+        with Session(self.db_engine) as session:
+            # TTL eviction rides along with every claim (expires_at is indexed)
+            session.exec(delete(IdempotencyRecord).where(IdempotencyRecord.expires_at <= now))
+            record = session.get(IdempotencyRecord, key)
+
+            if record is None:
+                session.add(IdempotencyRecord(key=key, user_id=user_id, request_hash=fingerprint, created_at=now,
+                                              heartbeat_at=now, expires_at=now + self.ttl_seconds))
+                try:
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()  # Another worker claimed it between our read and insert
+                    return "in_progress", None
+                return "claimed", None
+
+            if _conflicts(record.request_hash, fingerprint):
+                session.commit()
+                raise IdempotencyConflict("Idempotency-Key was already used for a different request.")
+
+            if record.status == "completed":
+                window = self._window(key)
+                if window is None or arrived_at - record.created_at <= window:
+                    session.commit()
+                    return "completed", json.loads(record.result_json)
+                # The same text again after the window: a new purchase, which becomes the claim
+                record.status, record.result_json = "in_progress", None
+                record.created_at = record.heartbeat_at = now
+                record.request_hash = record.request_hash or fingerprint
+                record.expires_at = now + self.ttl_seconds
+                session.add(record)
+                session.commit()
+                return "claimed", None
+
+            if now - (record.heartbeat_at or record.created_at) > self.lock_timeout:
+                logging.warning("IDEMPOTENCY: Taking over a stale claim (its worker stopped responding)")
+                record.created_at = record.heartbeat_at = now
+                record.request_hash = record.request_hash or fingerprint
+                session.add(record)
+                session.commit()
+                return "claimed", None
+
+            session.commit()
+            return "in_progress", None
+
+    def _renew(self, key: str):
+        with Session(self.db_engine) as session:
+            session.exec(update(IdempotencyRecord).where(
+                IdempotencyRecord.key == key, IdempotencyRecord.status == "in_progress"
+            ).values(heartbeat_at=time.time()))
+            session.commit()
+
+    def _complete(self, key: str, result: Dict[str, Any]):
+        try:
+            with Session(self.db_engine) as session:
+                record = session.get(IdempotencyRecord, key)
+                if record is None:
+                    return
+                record.status = "completed"
+                record.result_json = json.dumps(result, default=str)
+                # A text-derived result is only replayed within its window (requests that were
+                # already waiting arrived before now), so it need not outlive it
+                window = self._window(key)
+                record.expires_at = time.time() + (window if window is not None else self.ttl_seconds)
+                session.add(record)
+                session.commit()
+        except Exception as e:
+            # Best-effort, like the plan cache: the caller still gets its result
+            logging.error(f"IDEMPOTENCY: Could not store result: {e}")
+
+    def _release(self, key: str):
+        try:
+            with Session(self.db_engine) as session:
+                session.exec(delete(IdempotencyRecord).where(
+                    IdempotencyRecord.key == key, IdempotencyRecord.status == "in_progress"
+                ))
+                session.commit()
+        except Exception as e:
+            logging.error(f"IDEMPOTENCY: Could not release claim: {e}")
+
+
+def _conflicts(stored: Optional[str], fingerprint: Optional[str]) -> bool:
+    return stored is not None and fingerprint is not None and stored != fingerprint
+
+
+# The global store used by /process_expense (on the main database, resolved on first use)
+IDEMPOTENCY_STORE = IdempotencyStore(
+    ttl_seconds=IDEMPOTENCY_TTL_SECONDS, lock_timeout=IDEMPOTENCY_LOCK_TIMEOUT_SECONDS,
+    window_seconds=IDEMPOTENCY_WINDOW_SECONDS
+)
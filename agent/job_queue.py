@@ -0,0 +1,413 @@
+# agent/job_queue.py
+"""
+Durable background queue for audits, so request intake does not wait on LLM throughput.
+
+/process_expense?background=true stores the audit as an AuditJob row and returns its job id
+at once; a JobWorkerPool runs queued jobs through run_auditor_async and clients poll (or
+long-poll) GET /jobs/{job_id} for the report.
+
+* Durable, at-least-once: a job is claimed with a lease its worker renews while it runs. A
+  worker that crashes stops renewing, and the next claim requeues the job (up to
+  JOB_MAX_ATTEMPTS). Jobs run through the idempotency store, so a re-run after a crash
+  replays a finished audit instead of logging its expense twice.
+* Per-user ordering: a job is only claimed once it is its user's oldest unfinished job, so a
+  user's audits (and their budget checks) run one at a time in submission order.
+* Backpressure: submissions beyond JOB_QUEUE_MAX_PENDING queued jobs (or
+  JOB_QUEUE_MAX_PER_USER for one user) raise QueueFull, which the API answers with 429.
+
+Claims are guarded row updates, so several worker processes can share one database:
+
+    python -m agent.job_queue worker [--workers 4]
+    python -m agent.job_queue stats
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import delete, func, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased
+from sqlmodel import Session, select
+
+from client_config import (
+    JOB_WORKERS, JOB_QUEUE_MAX_PENDING, JOB_QUEUE_MAX_PER_USER, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS,
+    JOB_RETENTION_SECONDS,
+)
+from .db import AuditJob, get_engine, init_db
+from .idempotency import IDEMPOTENCY_STORE, IdempotencyConflict, request_fingerprint
+from .main import run_auditor_async
+
+PENDING_STATUSES = ("queued", "running")
+FINISHED_STATUSES = ("done", "failed")
+
+# Idle workers look for work this often (submissions in this process wake them at once)
+IDLE_POLL_SECONDS = 1.0
+# Long-polls re-read the job this often (jobs finished in this process wake them at once)
+WAIT_POLL_SECONDS = 0.5
+# First retry delay of a failed attempt; doubles per attempt
+RETRY_BACKOFF_SECONDS = 2.0
+
+
+class QueueFull(Exception):
+    """The pending limits are reached; the client should retry after `retry_after` seconds."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """The AuditJob table as a queue: submit, claim/renew/complete for workers, get/wait for clients."""
+
+    def __init__(self, db_engine: Optional[Any] = None, max_pending: int = 1000, max_per_user: int = 50,
+                 lease_seconds: float = 120, max_attempts: int = 3, retention_seconds: float = 604800):
+        self._db_engine = db_engine
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self._submit_listeners: List[Callable[[], None]] = []
+        self._finished_events: Dict[str, asyncio.Event] = {}
+
+    @property
+    def db_engine(self):
+        return self._db_engine if self._db_engine is not None else get_engine()
+
+    # --- Client side ---
+
+    def submit(self, user_id: str, expense_text: str, timings: bool = False,
+               idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Queues an audit and returns its job view. A repeated idempotency key returns the existing
+        job, or raises IdempotencyConflict when that job was submitted for a different request.
+        """
+        now = time.time()
+        with Session(self.db_engine) as session:
+            # Write lock first, so the backpressure counts and the insert are one atomic step
+            # across threads and processes
+            session.connection(execution_options={"sqlite_immediate": True})
+            # Retention eviction rides along with every submission (finished_at is indexed)
+            session.exec(delete(AuditJob).where(AuditJob.finished_at <= now - self.retention_seconds))
+
+            if idempotency_key is not None:
+                existing = session.exec(select(AuditJob).where(AuditJob.idempotency_key == idempotency_key)).first()
+                if existing is not None:
+                    session.commit()
+                    if (existing.user_id, existing.expense_text) != (user_id, expense_text):
+                        raise IdempotencyConflict("Idempotency-Key was already used for a different request.")
+                    return job_view(existing)
+
+            pending = session.exec(select(func.count()).select_from(AuditJob).where(AuditJob.status.in_(PENDING_STATUSES))).one()
+            if pending >= self.max_pending:
+                raise QueueFull(f"Job queue is full ({pending} pending audits).", retry_after=30)
+            user_pending = session.exec(select(func.count()).select_from(AuditJob).where(
+                AuditJob.user_id == user_id, AuditJob.status.in_(PENDING_STATUSES)
+            )).one()
+            if user_pending >= self.max_per_user:
+                raise QueueFull(f"User {user_id} already has {user_pending} pending audits.", retry_after=10)
+
+            job = AuditJob(job_id=uuid.uuid4().hex, user_id=user_id, expense_text=expense_text, timings=timings,
+                           idempotency_key=idempotency_key, created_at=now, available_at=now)
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            view = job_view(job)
+
+        for listener in list(self._submit_listeners):
+            listener()
+        return view
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with Session(self.db_engine) as session:
+            job = session.exec(select(AuditJob).where(AuditJob.job_id == job_id)).first()
+            return job_view(job) if job is not None else None
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Long-poll: the job view once it is finished, or as it is when `timeout` runs out."""
+        deadline = time.monotonic() + timeout
+        event = self._finished_events.setdefault(job_id, asyncio.Event())
+        try:
+            while True:
+                view = await asyncio.to_thread(self.get, job_id)
+                remaining = deadline - time.monotonic()
+                if view is None or view["status"] in FINISHED_STATUSES or remaining <= 0:
+                    return view
+                await _wait_event(event, min(remaining, WAIT_POLL_SECONDS))
+        finally:
+            if not event.is_set():
+                self._finished_events.pop(job_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with Session(self.db_engine) as session:
+            counts = dict(session.exec(select(AuditJob.status, func.count()).group_by(AuditJob.status)).all())
+        return {status: counts.get(status, 0) for status in PENDING_STATUSES + FINISHED_STATUSES}
+
+    # --- Worker side ---
+
+    def claim(self, worker_id: str) -> Optional[AuditJob]:
+        """Leases the oldest runnable job (the first unfinished one of its user), or returns None."""
+        now = time.time()
+        try:
+            with Session(self.db_engine) as session:
+                self._requeue_expired(session, now)
+
+                earlier = aliased(AuditJob)
+                blocked = select(earlier.id).where(
+                    earlier.user_id == AuditJob.user_id, earlier.id < AuditJob.id, earlier.status.in_(PENDING_STATUSES)
+                ).exists()
+                job = session.exec(select(AuditJob).where(
+                    AuditJob.status == "queued", AuditJob.available_at <= now, ~blocked
+                ).order_by(AuditJob.id).limit(1)).first()
+                if job is None:
+                    session.commit()
+                    return None
+
+                # Guarded: of several workers (or processes) racing for this job, one wins
+                claimed = session.exec(update(AuditJob).where(AuditJob.id == job.id, AuditJob.status == "queued").values(
+                    status="running", worker_id=worker_id, attempts=AuditJob.attempts + 1,
+                    started_at=now, lease_expires_at=now + self.lease_seconds
+                )).rowcount
+                session.commit()
+                if not claimed:
+                    return None
+                session.refresh(job)
+                return job
+        except OperationalError as e:
+            logging.warning(f"JOB QUEUE: Claim failed, retrying later: {e}")  # e.g. SQLite busy
+            return None
+
+    def renew(self, job: AuditJob, worker_id: str):
+        with Session(self.db_engine) as session:
+            session.exec(update(AuditJob).where(
+                AuditJob.id == job.id, AuditJob.worker_id == worker_id, AuditJob.status == "running"
+            ).values(lease_expires_at=time.time() + self.lease_seconds))
+            session.commit()
+
+    def complete(self, job: AuditJob, worker_id: str, result: Dict[str, Any]):
+        """Stores the report. Aborted audits that never executed a step are retried with backoff."""
+        report = str(result.get("final_report", "")) if isinstance(result, dict) else ""
+        if isinstance(result, dict) and not result.get("full_history") and report.startswith("Audit aborted"):
+            self._retry_or_fail(job, worker_id, report)
+            return
+        self._finish(job, worker_id, status="done", result_json=json.dumps(result, default=str), error=None)
+
+    def fail(self, job: AuditJob, worker_id: str, e: BaseException):
+        self._retry_or_fail(job, worker_id, f"Audit job failed due to system error: {e}")
+
+    def release_worker(self, worker_prefix: str) -> int:
+        """Requeues the running jobs of a stopping worker process right away (not after the lease)."""
+        with Session(self.db_engine) as session:
+            released = session.exec(update(AuditJob).where(
+                AuditJob.status == "running", AuditJob.worker_id.startswith(worker_prefix, autoescape=True)
+            ).values(status="queued", worker_id=None, available_at=time.time())).rowcount
+            session.commit()
+        return released
+
+    def add_submit_listener(self, listener: Callable[[], None]):
+        self._submit_listeners.append(listener)
+
+    def remove_submit_listener(self, listener: Callable[[], None]):
+        if listener in self._submit_listeners:
+            self._submit_listeners.remove(listener)
+
+    def notify_finished(self, job_id: str):
+        """Wakes long-polls in this process (call on their event loop)."""
+        event = self._finished_events.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    # --- Internals ---
+
+    def _requeue_expired(self, session: Session, now: float):
+        expired = (AuditJob.status == "running", AuditJob.lease_expires_at <= now)
+        session.exec(update(AuditJob).where(*expired, AuditJob.attempts >= self.max_attempts).values(
+            status="failed", finished_at=now,
+            error=f"Audit job abandoned: its worker stopped responding {self.max_attempts} times."
+        ))
+        requeued = session.exec(update(AuditJob).where(*expired).values(
+            status="queued", worker_id=None, available_at=now
+        )).rowcount
+        if requeued:
+            logging.warning(f"JOB QUEUE: Requeued {requeued} job(s) whose worker stopped responding")
+
+    def _retry_or_fail(self, job: AuditJob, worker_id: str, error: str):
+        if job.attempts < self.max_attempts:
+            logging.warning(f"JOB QUEUE: Job {job.job_id} attempt {job.attempts} failed, retrying: {error}")
+            with Session(self.db_engine) as session:
+                session.exec(update(AuditJob).where(
+                    AuditJob.id == job.id, AuditJob.worker_id == worker_id, AuditJob.status == "running"
+                ).values(status="queued", worker_id=None, error=error,
+                         available_at=time.time() + RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)))
+                session.commit()
+            return
+        logging.error(f"JOB QUEUE: Job {job.job_id} failed after {job.attempts} attempts: {error}")
+        self._finish(job, worker_id, status="failed", result_json=None, error=error)
+
+    def _finish(self, job: AuditJob, worker_id: str, status: str, result_json: Optional[str], error: Optional[str]):
+        with Session(self.db_engine) as session:
+            session.exec(update(AuditJob).where(
+                AuditJob.id == job.id, AuditJob.worker_id == worker_id, AuditJob.status == "running"
+            ).values(status=status, result_json=result_json, error=error, finished_at=time.time(), lease_expires_at=None))
+            session.commit()
+
+
+def job_view(job: AuditJob) -> Dict[str, Any]:
+    """The client-facing representation served by GET /jobs/{job_id}."""
+    view = {
+        "job_id": job.job_id,
+        "user_id": job.user_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+    if job.result_json is not None:
+        view["result"] = json.loads(job.result_json)
+    if job.error is not None:
+        view["error"] = job.error
+    return view
+
+
+async def _wait_event(event: asyncio.Event, timeout: float):
+    """Waits until `event` is set or `timeout` passes. Unlike wait_for, a cancellation always propagates."""
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        await asyncio.wait({waiter}, timeout=timeout)
+    finally:
+        waiter.cancel()
+
+
+async def run_queued_audit(job: AuditJob) -> Dict[str, Any]:
+    """Default job runner: the async audit, at most once per job (or per the client's idempotency key)."""
+    key = job.idempotency_key or f"job:{job.job_id}"
+    fingerprint = request_fingerprint(job.user_id, job.expense_text) if job.idempotency_key else None
+    result, _ = await IDEMPOTENCY_STORE.run(
+        key, job.user_id, lambda: run_auditor_async(job.user_id, job.expense_text, timings=job.timings), fingerprint
+    )
+    return result
+
+
+class JobWorkerPool:
+    """`workers` asyncio workers on the current event loop, each running one job at a time."""
+
+    def __init__(self, queue: JobQueue, workers: int = 4,
+                 runner: Optional[Callable[[AuditJob], Awaitable[Dict[str, Any]]]] = None):
+        self.queue = queue
+        self.workers = workers
+        self.runner = runner or run_queued_audit
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._listener: Optional[Callable[[], None]] = None
+        self.completed = 0
+        self.failed = 0
+
+    def start(self):
+        if self._tasks or self.workers <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        # submit() may run in a threadpool thread
+        self._listener = lambda: loop.call_soon_threadsafe(self._wakeup.set)
+        self.queue.add_submit_listener(self._listener)
+        self._tasks = [asyncio.create_task(self._work(f"{self.worker_prefix}:{n}")) for n in range(self.workers)]
+        logging.info(f"JOB QUEUE: Started {self.workers} workers")
+
+    async def stop(self):
+        """Cancels the workers and requeues their unfinished jobs."""
+        if not self._tasks:
+            return
+        self.queue.remove_submit_listener(self._listener)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        released = await asyncio.to_thread(self.queue.release_worker, self.worker_prefix)
+        if released:
+            logging.info(f"JOB QUEUE: Requeued {released} unfinished job(s) on shutdown")
+
+    def stats(self) -> Dict[str, int]:
+        return {"workers": len(self._tasks), "completed": self.completed, "failed": self.failed}
+
+    async def _work(self, worker_id: str):
+        while True:
+            self._wakeup.clear()
+            try:
+                job = await asyncio.to_thread(self.queue.claim, worker_id)
+            except Exception as e:
+                logging.error(f"JOB QUEUE: Worker {worker_id} could not claim a job: {e}")
+                job = None
+
+            if job is None:
+                await _wait_event(self._wakeup, IDLE_POLL_SECONDS)
+                continue
+
+            await self._run(job, worker_id)
+            self.queue.notify_finished(job.job_id)
+            self._wakeup.set()  # The user's next job may be claimable now
+
+    async def _run(self, job: AuditJob, worker_id: str):
+        heartbeat = asyncio.create_task(self._heartbeat(job, worker_id))
+        try:
+            try:
+                result = await self.runner(job)
+            except Exception as e:
+                self.failed += 1
+                await asyncio.to_thread(self.queue.fail, job, worker_id, e)
+            else:
+                self.completed += 1
+                await asyncio.to_thread(self.queue.complete, job, worker_id, result)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job: AuditJob, worker_id: str):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                await asyncio.to_thread(self.queue.renew, job, worker_id)
+            except Exception as e:
+                logging.warning(f"JOB QUEUE: Could not renew the lease of job {job.job_id}: {e}")
+
+
+# The global queue and worker pool used by the API (on the main database, resolved on first use)
+JOB_QUEUE = JobQueue(
+    max_pending=JOB_QUEUE_MAX_PENDING,
+    max_per_user=JOB_QUEUE_MAX_PER_USER,
+    lease_seconds=JOB_LEASE_SECONDS,
+    max_attempts=JOB_MAX_ATTEMPTS,
+    retention_seconds=JOB_RETENTION_SECONDS
+)
+JOB_WORKER_POOL = JobWorkerPool(JOB_QUEUE, workers=JOB_WORKERS)
+
+
+async def _run_workers(workers: int):
+    pool = JobWorkerPool(JOB_QUEUE, workers=workers)
+    pool.start()
+    try:
+        await asyncio.Event().wait()  # Until interrupted
+    finally:
+        await pool.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run audit workers for the background job queue, or show its counts.")
+    parser.add_argument("command", choices=("worker", "stats"))
+    parser.add_argument("--workers", type=int, default=max(JOB_WORKERS, 1))
+    cli_args = parser.parse_args()
+
+    init_db()
+    if cli_args.command == "stats":
+        print(json.dumps(JOB_QUEUE.stats(), indent=2))
+    else:
+        try:
+            asyncio.run(_run_workers(cli_args.workers))
+        except KeyboardInterrupt:
+            pass
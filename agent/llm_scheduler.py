@@ -0,0 +1,348 @@
+# agent/llm_scheduler.py
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+from client_config import (
+    MODEL_RATE_LIMITS, LLM_MAX_RETRIES, LLM_BACKOFF_BASE_SECONDS, LLM_BACKOFF_MAX_SECONDS,
+)
+from . import metrics
+
+# Priority lanes, highest first: /process_expense traffic, expense reports, bulk/backfill jobs
+LANES = ("interactive", "batch", "backfill")
+
+_RETRY_DELAY_RE = re.compile(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s")
+
+_current_lane: contextvars.ContextVar[str] = contextvars.ContextVar("llm_lane", default="interactive")
+
+
+def current_lane() -> str:
+    """The lane LLM calls made in this context are scheduled in."""
+    return _current_lane.get()
+
+
+@contextmanager
+def llm_lane(lane: str) -> Iterator[None]:
+    """Runs the enclosed LLM calls in `lane` (see LANES)."""
+    if lane not in LANES:
+        raise ValueError(f"Unknown LLM lane '{lane}'. Expected one of {LANES}.")
+    token = _current_lane.set(lane)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+class TokenBucket:
+    """Refills `per_minute` units per minute up to one minute's worth; per_minute <= 0 never limits."""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(amount, self.capacity)  # A call larger than the bucket waits for a full one
+        return 0.0 if self.level >= needed else (needed - self.level) / self.rate
+
+    def take(self, amount: float):
+        if self.rate > 0:
+            self.level -= amount  # May go negative: the debt delays the next callers
+
+
+class LLMScheduler:
+    """
+    Central admission point for Gemini calls. Each model gets a request bucket (RPM) and a
+    token bucket (TPM); callers queue by lane priority and only the head of the queue may
+    take quota, so interactive calls overtake queued batch/backfill work. Calls failing with
+    429 or 5xx are retried with jittered exponential backoff (honouring the server's
+    retryDelay); once retries are exhausted the error propagates, so the planner still
+    aborts instead of running an unvalidated plan.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, int]] = MODEL_RATE_LIMITS, max_retries: int = LLM_MAX_RETRIES,
+                 backoff_base: float = LLM_BACKOFF_BASE_SECONDS, backoff_max: float = LLM_BACKOFF_MAX_SECONDS,
+                 seed: Optional[int] = None):
+        self.limits = dict(limits)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._queue: list = []  # heap of (lane priority, arrival number)
+        self._async_waiters: Dict[Tuple[int, int], Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = {}
+        self._arrivals = itertools.count()
+        self._cond = threading.Condition()
+        self._random = random.Random(seed)
+        self._stats = {
+            lane: {"calls": 0, "retries": 0, "failures": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+            for lane in LANES
+        }
+
+    # --- Public API ---
+
+    def call(self, model: str, tokens: int, send: Callable[[], Any]) -> Any:
+        lane = _current_lane.get()
+        for attempt in range(self.max_retries + 1):
+            self._acquire(model, tokens, lane)
+            try:
+                response = send()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, lane)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._settle(model, tokens, response)
+            return response
+
+    async def call_async(self, model: str, tokens: int, send: Callable[[], Awaitable[Any]]) -> Any:
+        lane = _current_lane.get()
+        for attempt in range(self.max_retries + 1):
+            await self._acquire_async(model, tokens, lane)
+            try:
+                response = await send()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, lane)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._settle(model, tokens, response)
+            return response
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            depth = {lane: 0 for lane in LANES}
+            for priority, _ in self._queue:
+                depth[LANES[priority]] += 1
+            return {
+                lane: {
+                    **stats,
+                    "queue_depth": depth[lane],
+                    "mean_wait_seconds": stats["wait_seconds"] / stats["calls"] if stats["calls"] else 0.0,
+                }
+                for lane, stats in self._stats.items()
+            }
+
+    # --- Admission ---
+
+    def _acquire(self, model: str, tokens: int, lane: str):
+        ticket, start = self._enqueue(lane), time.monotonic()
+        try:
+            while True:
+                wait = self._try_admit(ticket, model, tokens)
+                if wait == 0:
+                    break
+                with self._cond:
+                    if wait is not None:
+                        self._cond.wait(wait)
+                    elif self._queue[0] != ticket:
+                        self._cond.wait()  # Until a dequeue changes the head of the line
+        finally:
+            self._dequeue(ticket, lane)
+        self._record_wait(lane, time.monotonic() - start)
+
+    async def _acquire_async(self, model: str, tokens: int, lane: str):
+        # Never blocks the event loop: the turn is signalled through an asyncio.Event set by
+        # whichever thread dequeues the caller ahead, and quota is waited for with one sleep
+        turn = asyncio.Event()
+        ticket, start = self._enqueue(lane, (asyncio.get_running_loop(), turn)), time.monotonic()
+        try:
+            while True:
+                turn.clear()
+                wait = self._try_admit(ticket, model, tokens)
+                if wait == 0:
+                    break
+                if wait is None:
+                    await turn.wait()
+                else:
+                    await asyncio.sleep(wait)
+        finally:
+            self._dequeue(ticket, lane)
+        self._record_wait(lane, time.monotonic() - start)
+
+    def _enqueue(self, lane: str, waiter: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = None) -> Tuple[int, int]:
+        ticket = (LANES.index(lane), next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            if waiter is not None:
+                self._async_waiters[ticket] = waiter
+            self._publish_depth(lane)
+        return ticket
+
+    def _dequeue(self, ticket: Tuple[int, int], lane: str):
+        with self._cond:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+            self._async_waiters.pop(ticket, None)
+            self._publish_depth(lane)
+            self._cond.notify_all()
+            waiter = self._async_waiters.get(self._queue[0]) if self._queue else None
+        if waiter is not None:
+            loop, turn = waiter
+            loop.call_soon_threadsafe(turn.set)
+
+    def _try_admit(self, ticket: Tuple[int, int], model: str, tokens: int) -> Optional[float]:
+        """
+        0 when the call may go now (quota taken), None while another caller is ahead of it,
+        otherwise how long to wait for quota before retrying.
+        """
+        with self._cond:
+            if self._queue[0] != ticket:
+                return None
+            requests_bucket, tokens_bucket = self._buckets_for(model)
+            now = time.monotonic()
+            wait = max(requests_bucket.wait_time(1, now), tokens_bucket.wait_time(tokens, now))
+            if wait > 0:
+                return wait
+            requests_bucket.take(1)
+            tokens_bucket.take(tokens)
+            return 0.0
+
+    def _settle(self, model: str, estimated_tokens: int, response: Any):
+        """Corrects the token bucket with the response's actual usage."""
+        usage = getattr(response, "usage_metadata", None)
+        actual = getattr(usage, "total_token_count", None) if usage is not None else None
+        if actual:
+            with self._cond:
+                self._buckets_for(model)[1].take(actual - estimated_tokens)
+
+    def _buckets_for(self, model: str) -> Tuple[TokenBucket, TokenBucket]:
+        if model not in self._buckets:
+            rpm, tpm = self.limits.get(model, (0, 0))
+            self._buckets[model] = (TokenBucket(rpm), TokenBucket(tpm))
+        return self._buckets[model]
+
+    # --- Retries ---
+
+    def _retry_delay(self, e: Exception, attempt: int, lane: str) -> Optional[float]:
+        """Backoff before the next attempt, or None when the error is final."""
+        if not _is_retryable(e) or attempt >= self.max_retries:
+            with self._cond:
+                self._stats[lane]["failures"] += 1
+            return None
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        with self._cond:
+            delay = backoff * self._random.uniform(0.5, 1.5)
+            self._stats[lane]["retries"] += 1
+        server_delay = _server_retry_delay(e)
+        if server_delay is not None:
+            delay = max(delay, min(server_delay, self.backoff_max))
+        logging.warning(f"LLM SCHEDULER: {e} (attempt {attempt + 1}), retrying in {delay:.2f}s")
+        metrics.record_retry(lane)
+        return delay
+
+    def _record_wait(self, lane: str, seconds: float):
+        with self._cond:
+            stats = self._stats[lane]
+            stats["calls"] += 1
+            stats["wait_seconds"] += seconds
+            stats["max_wait_seconds"] = max(stats["max_wait_seconds"], seconds)
+        metrics.record_llm_wait(lane, seconds)
+
+    def _publish_depth(self, lane: str):
+        metrics.set_llm_queue_depth(lane, sum(1 for priority, _ in self._queue if LANES[priority] == lane))
+
+
+def _is_retryable(e: Exception) -> bool:
+    code = getattr(e, "code", None)
+    return isinstance(code, int) and (code == 429 or 500 <= code < 600)
+
+
+def _server_retry_delay(e: Exception) -> Optional[float]:
+    match = _RETRY_DELAY_RE.search(str(getattr(e, "details", "")) or str(e))
+    return float(match.group(1)) if match else None
+
+
+def estimate_tokens(contents: Any, config: Any = None) -> int:
+    """Rough prompt size (4 characters per token) used to reserve TPM quota before a call."""
+    instruction = getattr(config, "system_instruction", None) or ""
+    return max(1, (len(str(contents)) + len(str(instruction))) // 4)
+
+
+# --- Client wrapper ---
+
+class ScheduledClient:
+    """
+    genai.Client look-alike whose generate_content / generate_content_stream calls go through
+    an LLMScheduler. Every other attribute is read from the wrapped client.
+    """
+
+    def __init__(self, client, scheduler: LLMScheduler):
+        self.client = client
+        self.scheduler = scheduler
+        self.models = _ScheduledModels(client, scheduler)
+        self.aio = _ScheduledAio(_ScheduledAsyncModels(client, scheduler))
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.client, name)
+
+
+class _ScheduledModels:
+    def __init__(self, client, scheduler: LLMScheduler):
+        self._client = client
+        self._scheduler = scheduler
+
+    def generate_content(self, *, model: str, contents: Any, config: Any = None):
+        return self._scheduler.call(
+            model, estimate_tokens(contents, config),
+            lambda: self._client.models.generate_content(model=model, contents=contents, config=config)
+        )
+
+
+class _ScheduledAsyncModels:
+    def __init__(self, client, scheduler: LLMScheduler):
+        self._client = client
+        self._scheduler = scheduler
+
+    async def generate_content(self, *, model: str, contents: Any, config: Any = None):
+        return await self._scheduler.call_async(
+            model, estimate_tokens(contents, config),
+            lambda: self._client.aio.models.generate_content(model=model, contents=contents, config=config)
+        )
+
+    async def generate_content_stream(self, *, model: str, contents: Any, config: Any = None):
+        # Only opening the stream is retried; a stream that fails midway is not replayed
+        return await self._scheduler.call_async(
+            model, estimate_tokens(contents, config),
+            lambda: self._client.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+        )
+
+
+class _ScheduledAio:
+    def __init__(self, models: _ScheduledAsyncModels):
+        self.models = models
+
+
+# --- Registry (one scheduler per underlying client, so quota is shared by all its callers) ---
+
+# The wrapper is stored on the client it wraps: a registry keyed by client would keep every
+# client alive (the wrapper references it), and one keyed by id() could hand a new client the
+# wrapper of a collected one. The client <-> wrapper cycle is collected with the client.
+_SCHEDULED_ATTRIBUTE = "_llm_scheduled_client"
+_scheduled_lock = threading.Lock()
+
+
+def get_scheduled_client(client) -> Any:
+    """The shared ScheduledClient for `client` (None stays None, wrapped clients are returned as is)."""
+    if client is None or isinstance(client, ScheduledClient):
+        return client
+    with _scheduled_lock:
+        scheduled = getattr(client, _SCHEDULED_ATTRIBUTE, None)
+        if not isinstance(scheduled, ScheduledClient) or scheduled.client is not client:
+            scheduled = ScheduledClient(client, LLMScheduler())
+            setattr(client, _SCHEDULED_ATTRIBUTE, scheduled)
+        return scheduled
@@ -1,37 +1,45 @@
 # agent/main.py
 
-from google.genai import types
-import json
+import asyncio
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, AsyncIterator, List, Optional, Tuple
 
 # Import the core components
-from client_config import CLIENT, SUMMARY_MODEL
-from .planner import run_planner_auditor
-from .executor import execute_plan_step
-from .tools import get_available_tool_declarations
+from client_config import get_client
+from .planner import run_planner_auditor, run_planner_auditor_async
+from .executor import execute_plan, execute_plan_async, execute_batch_plan
+from .plan_cache import PLAN_CACHE
+from .vendor_index import VENDOR_INDEX
+from .coalescer import get_coalescer
+from .llm_scheduler import get_scheduled_client, llm_lane
+from .metrics import instrument_audit
+from .summarizer import summarize, summarize_async, stream_summary_async
 
 # Configure basic logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
 
-def run_auditor(user_id: str, expense_text: str, test_engine: Optional[Any] = None) -> Dict[str, Any]:
+@instrument_audit
+def run_auditor(user_id: str, expense_text: str, test_engine: Optional[Any] = None, client: Optional[Any] = None) -> Dict[str, Any]:
     """
     The main orchestrator function (entry point) that runs the Plan-Reflect-Execute cycle.
+    `client` overrides the configured LLM client (e.g. agent.fake_llm.FakeGeminiClient); every
+    call is paced and retried by agent.llm_scheduler.
+    `test_engine` is an engine or an agent.shards.ShardRouter; None uses the user's shard.
+    Pass timings=True to get a per-phase 'timings' block in the result (see agent.metrics).
     """
-    if not CLIENT:
-        logging.error("Gemini client not initialized.")
-        return {"final_report": "System Error: Gemini client not available.", "full_history": []}
+    client = get_scheduled_client(client or get_client())
+    if not client:
+        return _client_unavailable()
 
-    # 1. SETUP
-    tool_declarations = get_available_tool_declarations(CLIENT)
-
-    # 2. PHASE 1 & 2: PLAN AND REFLECT
+    # 1. PHASE 1 & 2: PLAN AND REFLECT
     planning_result = run_planner_auditor(
-        client=CLIENT,
+        client=client,
         user_id=user_id,
         expense_text=expense_text,
-        available_tools_declarations=tool_declarations
+        plan_cache=PLAN_CACHE,
+        coalescer=get_coalescer(client),
+        vendor_index=VENDOR_INDEX
     )
 
     final_steps = planning_result.get('plan_steps', [])
@@ -39,55 +47,180 @@ def run_auditor(user_id: str, expense_text: str, test_engine: Optional[Any] = No
         logging.error("Execution aborted: No valid plan steps were generated.")
         return planning_result
 
-    # 3. PHASE 3: EXECUTION
+    # 2. PHASE 3: EXECUTION
     logging.info(f"Starting execution of {len(final_steps)} plan steps...")
 
-    execution_history = []
-    for step in final_steps:
-        tool_name = step.get('tool_name', 'UNKNOWN')
-        args = step.get('arguments', {})
-
-        # Execute the tool
-        result = execute_plan_step(tool_name, args, user_id, db_engine=test_engine)
-
-        # 🟢 FIX: Clean the result before adding to history to avoid serialization errors
-        # We remove 'db_engine', 'test_engine', or 'engine' if they exist in the result
-        if isinstance(result, dict):
-            clean_result = {
-                k: v for k, v in result.items()
-                if k not in ['engine', 'db_engine', 'test_engine', 'arguments_used']
-            }
-            # Also ensure any nested dicts (like arguments_used) don't contain the engine
-            execution_history.append(clean_result)
+    # One session/transaction for the whole plan, group-committed with concurrent requests
+    execution_history = [
+        _clean_result(result)
+        for result in execute_plan(final_steps, user_id, db_engine=test_engine)
+    ]
+
+    # 3. PHASE 4: SUMMARIZATION (template, LLM or hybrid; see agent.summarizer)
+    final_report = summarize(client, execution_history)
+
+    return {
+        "final_report": final_report,
+        "full_history": execution_history,
+        "plan_details": planning_result.get('final_plan', {})
+    }
+
+
+@instrument_audit
+async def run_auditor_async(user_id: str, expense_text: str, test_engine: Optional[Any] = None, client: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Async counterpart of run_auditor. LLM calls go through `client.aio` and DB work through
+    an aiosqlite engine, so the event loop stays free while a request waits on Gemini.
+    `test_engine` must be an async engine (see agent.db.get_async_db_engine) or a ShardRouter.
+    """
+    client = get_scheduled_client(client or get_client())
+    if not client:
+        return _client_unavailable()
+
+    # 1. PHASE 1 & 2: PLAN AND REFLECT
+    planning_result = await run_planner_auditor_async(
+        client=client,
+        user_id=user_id,
+        expense_text=expense_text,
+        plan_cache=PLAN_CACHE,
+        coalescer=get_coalescer(client),
+        vendor_index=VENDOR_INDEX
+    )
+
+    final_steps = planning_result.get('plan_steps', [])
+    if not final_steps:
+        logging.error("Execution aborted: No valid plan steps were generated.")
+        return planning_result
+
+    # 2. PHASE 3: EXECUTION
+    logging.info(f"Starting execution of {len(final_steps)} plan steps...")
+
+    execution_history = [
+        _clean_result(result)
+        for result in await execute_plan_async(final_steps, user_id, db_engine=test_engine)
+    ]
+
+    # 3. PHASE 4: SUMMARIZATION (template, LLM or hybrid; see agent.summarizer)
+    final_report = await summarize_async(client, execution_history)
+
+    return {
+        "final_report": final_report,
+        "full_history": execution_history,
+        "plan_details": planning_result.get('final_plan', {})
+    }
+
+
+async def stream_auditor(user_id: str, expense_text: str, test_engine: Optional[Any] = None, client: Optional[Any] = None) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Streaming variant of run_auditor_async. Yields (event, data) pairs as each phase completes:
+    'plan' (planner output), 'critique' (validated plan), one 'step' per executed tool,
+    'summary' chunks, then 'done' with the same dict run_auditor_async returns.
+    Planning failures end the stream with 'error'.
+    """
+    client = get_scheduled_client(client or get_client())
+    if not client:
+        yield "error", _client_unavailable()
+        return
+
+    plan_events: asyncio.Queue = asyncio.Queue()
+
+    # 1. PHASE 1 & 2: PLAN AND REFLECT (the initial plan is emitted before the Judge returns)
+    planning_task = asyncio.create_task(run_planner_auditor_async(
+        client=client,
+        user_id=user_id,
+        expense_text=expense_text,
+        plan_cache=PLAN_CACHE,
+        coalescer=get_coalescer(client),
+        vendor_index=VENDOR_INDEX,
+        on_plan=plan_events.put_nowait
+    ))
+
+    plan_emitted = False
+    while not planning_task.done():
+        next_plan = asyncio.ensure_future(plan_events.get())
+        await asyncio.wait({next_plan, planning_task}, return_when=asyncio.FIRST_COMPLETED)
+        if next_plan.done():
+            plan_emitted = True
+            yield "plan", next_plan.result()
         else:
-            execution_history.append(result)
-
-    # 4. PHASE 4: SUMMARIZATION
-    logging.info("PHASE 4: SUMMARIZATION (Generating final report)")
-
-    # Serialize the CLEANED history
-    try:
-        history_json = json.dumps(execution_history, indent=2)
-    except TypeError as e:
-        logging.error(f"Serialization failed again: {e}")
-        history_json = str(execution_history)  # Fallback to string representation
-
-    final_summary_prompt = (
-        "Based on the following execution history, generate a final, concise, and "
-        "professional report for the user. Explicitly state the final budget status "
-        "(e.g., 'Status: Under Budget' or 'Warning: OVER BUDGET')."
-        f"\n\nEXECUTION HISTORY:\n{history_json}"
+            next_plan.cancel()
+    while not plan_events.empty():
+        plan_emitted = True
+        yield "plan", plan_events.get_nowait()
+
+    planning_result = planning_task.result()
+    final_steps = planning_result.get('plan_steps', [])
+    if not final_steps:
+        logging.error("Execution aborted: No valid plan steps were generated.")
+        yield "error", planning_result
+        return
+
+    final_plan = planning_result.get('final_plan', {})
+    if not plan_emitted:
+        # Fast path / plan cache: no separate planner output exists
+        yield "plan", final_plan
+    yield "critique", {"critique": planning_result.get('critique', ''), "plan_steps": final_steps}
+
+    # 2. PHASE 3: EXECUTION (step results, including the budget status, are sent once committed)
+    execution_history = []
+    results = await execute_plan_async(final_steps, user_id, db_engine=test_engine)
+    for step, result in zip(final_steps, results):
+        clean_result = _clean_result(result)
+        execution_history.append(clean_result)
+        yield "step", {"step_number": step.get('step_number'), **clean_result}
+
+    # 3. PHASE 4: SUMMARIZATION (streamed token by token in LLM mode)
+    report_chunks = []
+    async for chunk in stream_summary_async(client, execution_history):
+        report_chunks.append(chunk)
+        yield "summary", chunk
+
+    yield "done", {
+        "final_report": "".join(report_chunks),
+        "full_history": execution_history,
+        "plan_details": final_plan
+    }
+
+
+@instrument_audit
+@llm_lane("batch")
+def run_auditor_batch(user_id: str, expense_items: List[str], test_engine: Optional[Any] = None, client: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Audits a whole expense report with one planner call, one judge call and one summary.
+    All expenses are inserted in a single transaction and each category is checked once.
+    Its LLM calls queue in the scheduler's 'batch' lane, behind interactive audits.
+    """
+    client = get_scheduled_client(client or get_client())
+    if not client:
+        return _client_unavailable()
+
+    if not expense_items:
+        return {"final_report": "No expense items submitted.", "full_history": []}
+
+    numbered_items = "\n".join(f"{i}. {item}" for i, item in enumerate(expense_items, start=1))
+
+    # 1. PHASE 1 & 2: PLAN AND REFLECT (single round-trip each for the whole report)
+    planning_result = run_planner_auditor(
+        client=client,
+        user_id=user_id,
+        expense_text=f"Expense report with {len(expense_items)} line items:\n{numbered_items}",
+        batch=True
     )
 
-    try:
-        # Using flash-lite for summarization to save quota, or flash for speed
-        summary_response = CLIENT.models.generate_content(
-            model=SUMMARY_MODEL,
-            contents=final_summary_prompt
-        )
-        final_report = summary_response.text
-    except Exception as e:
-        final_report = f"SUMMARIZATION ERROR: Could not generate report. Error: {e}"
+    final_steps = planning_result.get('plan_steps', [])
+    if not final_steps:
+        logging.error("Execution aborted: No valid plan steps were generated.")
+        return planning_result
+
+    # 2. PHASE 3: EXECUTION
+    logging.info(f"Starting batch execution of {len(final_steps)} plan steps...")
+    execution_history = [
+        _clean_result(result)
+        for result in execute_batch_plan(final_steps, user_id, db_engine=test_engine)
+    ]
+
+    # 3. PHASE 4: SUMMARIZATION (template, LLM or hybrid; see agent.summarizer)
+    final_report = summarize(client, execution_history)
 
     return {
         "final_report": final_report,
@@ -96,6 +229,24 @@ def run_auditor(user_id: str, expense_text: str, test_engine: Optional[Any] = No
     }
 
 
+def _client_unavailable() -> Dict[str, Any]:
+    logging.error("Gemini client not initialized.")
+    return {"final_report": "System Error: Gemini client not available.", "full_history": []}
+
+
+def _clean_result(result: Any) -> Any:
+    """
+    🟢 FIX: Clean the result before adding to history to avoid serialization errors.
+    We remove 'db_engine', 'test_engine', or 'engine' if they exist in the result.
+    """
+    if isinstance(result, dict):
+        return {
+            k: v for k, v in result.items()
+            if k not in ['engine', 'db_engine', 'test_engine', 'arguments_used']
+        }
+    return result
+
+
 if __name__ == "__main__":
     # Internal test run logic
-    pass
\ No newline at end of file
+    pass
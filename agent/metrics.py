@@ -0,0 +1,406 @@
+# agent/metrics.py
+"""
+Lightweight per-phase instrumentation for the auditor pipeline.
+
+Every audit phase (planner, judge, execute, each executor step, summary) is timed into
+Prometheus-style histograms, together with Gemini token usage, DB time spent in the tool
+functions, cache/shortcut outcomes and error/retry counts. `render()` produces the text
+exposition served on /metrics.
+
+While an audit runs under `track_request()`, the same observations are also collected into a
+RequestTimings object, which `instrument_audit` can attach to the result as a 'timings' block.
+Set METRICS_ENABLED=false to turn all of it into no-ops.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from client_config import METRICS_ENABLED
+
+ENABLED = METRICS_ENABLED
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values (thread-safe)."""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...], buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List[float]] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for label_values, series in sorted(snapshot.items()):
+            labels = _format_labels(self.label_names, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    """Monotonic counter keyed by label values (thread-safe)."""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values: str) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for label_values, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{{{_format_labels(self.label_names, label_values)}}} {value}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge(Counter):
+    """Point-in-time value keyed by label values (thread-safe)."""
+
+    def set(self, value: float, *label_values: str):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+PHASE_SECONDS = Histogram("auditor_phase_seconds", "Wall time per audit phase.", ("phase",))
+STEP_SECONDS = Histogram("auditor_step_seconds", "Wall time per executed plan step.", ("tool",))
+DB_SECONDS = Histogram("auditor_db_seconds", "Time spent in tool DB operations.", ("operation",))
+LLM_TOKENS = Histogram("auditor_llm_tokens", "Gemini token usage per call.", ("phase", "kind"), TOKEN_BUCKETS)
+CACHE_LOOKUPS = Counter("auditor_cache_lookups_total", "Plan cache and local shortcut outcomes.", ("cache", "result"))
+ERRORS = Counter("auditor_errors_total", "Failed phases (LLM errors, parse errors, failed steps).", ("phase",))
+RETRIES = Counter("auditor_retries_total", "Retried LLM calls (429/5xx) per scheduler lane.", ("lane",))
+LLM_QUEUE_WAIT = Histogram("auditor_llm_queue_wait_seconds", "Time LLM calls waited for quota.", ("lane",))
+LLM_QUEUE_DEPTH = Gauge("auditor_llm_queue_depth", "LLM calls currently waiting for quota.", ("lane",))
+TOKENS_SAVED = Counter("auditor_prompt_tokens_saved_total", "Prompt tokens avoided by compaction and context caching.", ("phase", "source"))
+
+REGISTRY = (PHASE_SECONDS, STEP_SECONDS, DB_SECONDS, LLM_TOKENS, CACHE_LOOKUPS, ERRORS, RETRIES,
+            LLM_QUEUE_WAIT, LLM_QUEUE_DEPTH, TOKENS_SAVED)
+
+
+def render() -> str:
+    """Prometheus text exposition format (version 0.0.4) of every registered metric."""
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    for metric in REGISTRY:
+        metric.clear()
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# --- Per-request collection ---
+
+class RequestTimings:
+    """Everything observed while one audit ran (milliseconds, token counts, cache outcomes)."""
+
+    def __init__(self):
+        self.phases_ms: Dict[str, float] = {}
+        self.steps: List[Dict[str, Any]] = []
+        self.db_ms = 0.0
+        self.db_operations = 0
+        self.tokens: Dict[str, Dict[str, int]] = {}
+        self.tokens_saved: Dict[str, Dict[str, int]] = {}
+        self.cache: Dict[str, str] = {}
+        self.errors: Dict[str, int] = {}
+        self.retries: Dict[str, int] = {}
+        self._lock = threading.Lock()  # Steps and DB time are recorded on the writer thread
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "phases_ms": {phase: round(ms, 3) for phase, ms in self.phases_ms.items()},
+            "steps": list(self.steps),
+            "db_ms": round(self.db_ms, 3),
+            "db_operations": self.db_operations,
+            "tokens": {phase: dict(counts) for phase, counts in self.tokens.items()},
+            "tokens_saved": {phase: dict(counts) for phase, counts in self.tokens_saved.items()},
+            "cache": dict(self.cache),
+            "errors": dict(self.errors),
+            "retries": dict(self.retries),
+        }
+
+
+_current_request: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("audit_timings", default=None)
+
+
+@contextmanager
+def track_request() -> Iterator[Optional[RequestTimings]]:
+    """Collects this context's observations into a RequestTimings and records the 'total' phase."""
+    if not ENABLED:
+        yield None
+        return
+    timings = RequestTimings()
+    token = _current_request.set(timings)
+    try:
+        with phase("total"):
+            yield timings
+    finally:
+        _current_request.reset(token)
+
+
+def instrument_audit(func: Callable) -> Callable:
+    """
+    Wraps an auditor entry point in track_request() and adds a `timings: bool = False` keyword.
+    With timings=True (and metrics enabled) the result dict gets a 'timings' block.
+    """
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, timings: bool = False, **kwargs):
+            with track_request() as request_timings:
+                result = await func(*args, **kwargs)
+            return _attach(result, request_timings, timings)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, timings: bool = False, **kwargs):
+        with track_request() as request_timings:
+            result = func(*args, **kwargs)
+        return _attach(result, request_timings, timings)
+    return wrapper
+
+
+def _attach(result: Any, request_timings: Optional[RequestTimings], include: bool) -> Any:
+    if include and request_timings is not None and isinstance(result, dict):
+        return {**result, "timings": request_timings.to_dict()}
+    return result
+
+
+# --- Recording helpers (no-ops when disabled) ---
+
+class _PhaseTimer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        PHASE_SECONDS.observe(elapsed, self.name)
+        timings = _current_request.get()
+        if timings is not None:
+            with timings._lock:
+                timings.phases_ms[self.name] = timings.phases_ms.get(self.name, 0.0) + elapsed * 1000
+        if exc_type is not None:
+            record_error(self.name)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopTimer()
+
+
+def phase(name: str):
+    """Context manager timing one audit phase; an exception escaping it counts as an error."""
+    return _PhaseTimer(name) if ENABLED else _NOOP
+
+
+def record_step(tool_name: str, status: str, seconds: float):
+    if not ENABLED:
+        return
+    STEP_SECONDS.observe(seconds, tool_name)
+    if status != "SUCCESS":
+        ERRORS.inc(f"step:{tool_name}")
+    timings = _current_request.get()
+    if timings is not None:
+        with timings._lock:
+            timings.steps.append({"tool_name": tool_name, "status": status, "ms": round(seconds * 1000, 3)})
+            if status != "SUCCESS":
+                timings.errors[f"step:{tool_name}"] = timings.errors.get(f"step:{tool_name}", 0) + 1
+
+
+def timed_db(operation: str) -> Callable:
+    """Decorator recording the wrapped tool function's wall time as DB time."""
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                DB_SECONDS.observe(elapsed, operation)
+                timings = _current_request.get()
+                if timings is not None:
+                    with timings._lock:
+                        timings.db_ms += elapsed * 1000
+                        timings.db_operations += 1
+        return wrapper
+    return decorator
+
+
+def record_usage(phase_name: str, response: Any):
+    """Records prompt/response token counts from a Gemini response's usage_metadata."""
+    if not ENABLED:
+        return
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    counts = {
+        "prompt": usage.prompt_token_count or 0,
+        "response": usage.candidates_token_count or 0,
+    }
+    for kind, count in counts.items():
+        LLM_TOKENS.observe(count, phase_name, kind)
+    _add_request_tokens(phase_name, counts)
+
+    cached = getattr(usage, "cached_content_token_count", None) or 0
+    if cached:
+        record_tokens_saved(phase_name, "context_cache", cached)
+
+
+def record_shared_usage(phase_name: str, response: Any):
+    """
+    Adds the token counts of a call shared with other requests (agent.coalescer) to this
+    request's timings only; record_usage counted the call once in the process totals.
+    """
+    if not ENABLED:
+        return
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        _add_request_tokens(phase_name, {
+            "prompt": usage.prompt_token_count or 0,
+            "response": usage.candidates_token_count or 0,
+        })
+
+
+def _add_request_tokens(phase_name: str, counts: Dict[str, int]):
+    timings = _current_request.get()
+    if timings is not None:
+        with timings._lock:
+            totals = timings.tokens.setdefault(phase_name, {"prompt": 0, "response": 0})
+            for kind, count in counts.items():
+                totals[kind] += count
+
+
+def record_tokens_saved(phase_name: str, source: str, tokens: int):
+    """Prompt tokens a call did not send (source: 'compaction') or was not billed in full for ('context_cache')."""
+    if not ENABLED or tokens <= 0:
+        return
+    TOKENS_SAVED.inc(phase_name, source, amount=tokens)
+    timings = _current_request.get()
+    if timings is not None:
+        with timings._lock:
+            saved = timings.tokens_saved.setdefault(phase_name, {})
+            saved[source] = saved.get(source, 0) + tokens
+
+
+def record_cache(cache: str, hit: bool):
+    if not ENABLED:
+        return
+    result = "hit" if hit else "miss"
+    CACHE_LOOKUPS.inc(cache, result)
+    timings = _current_request.get()
+    if timings is not None:
+        timings.cache[cache] = result
+
+
+def record_error(phase_name: str):
+    if not ENABLED:
+        return
+    ERRORS.inc(phase_name)
+    timings = _current_request.get()
+    if timings is not None:
+        with timings._lock:
+            timings.errors[phase_name] = timings.errors.get(phase_name, 0) + 1
+
+
+def record_retry(lane: str):
+    if not ENABLED:
+        return
+    RETRIES.inc(lane)
+    timings = _current_request.get()
+    if timings is not None:
+        with timings._lock:
+            timings.retries[lane] = timings.retries.get(lane, 0) + 1
+
+
+def record_llm_wait(lane: str, seconds: float):
+    """Time an LLM call spent queued in the scheduler before it was admitted."""
+    if not ENABLED:
+        return
+    LLM_QUEUE_WAIT.observe(seconds, lane)
+    timings = _current_request.get()
+    if timings is not None:
+        with timings._lock:
+            timings.phases_ms["llm_queue"] = timings.phases_ms.get("llm_queue", 0.0) + seconds * 1000
+
+
+def set_llm_queue_depth(lane: str, depth: int):
+    if ENABLED:
+        LLM_QUEUE_DEPTH.set(depth, lane)
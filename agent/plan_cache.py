@@ -0,0 +1,277 @@
+# agent/plan_cache.py
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from sqlmodel import Session, select
+
+from client_config import PLAN_CACHE_MAX_SIZE, PLAN_CACHE_TTL_SECONDS, PLAN_CACHE_DB_URL
+from .db import PlanCacheEntry, get_db_engine
+from .planner import _VENDOR_RE, _NUMBER_RE, CATEGORY_KEYWORDS, validate_plan
+
+# Placeholders stored in cached plans instead of request-specific values
+_SLOT_RE = re.compile(r"^\{\{(user_id|vendor|amount_\d+)\}\}$")
+
+
+def normalize_expense_text(user_id: str, expense_text: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Masks the user id, the vendor ("at <Vendor>") and every number so that requests which
+    only differ in those values share one template. Returns (template, slots).
+    """
+    slots: Dict[str, Any] = {"user_id": user_id}
+    text = expense_text.replace(user_id, "<USER>") if user_id else expense_text
+
+    vendor_match = _VENDOR_RE.search(text)
+    if vendor_match:
+        slots["vendor"] = vendor_match.group(1).strip()
+        text = text[:vendor_match.start(1)] + "<VENDOR>" + text[vendor_match.end(1):]
+
+    amounts = []
+
+    def mask_number(match):
+        amounts.append(float(match.group(0).replace(",", "")))
+        return f"<AMOUNT_{len(amounts) - 1}>"
+
+    text = _NUMBER_RE.sub(mask_number, text)
+    slots.update({f"amount_{i}": amount for i, amount in enumerate(amounts)})
+
+    template = " ".join(text.lower().split()).rstrip(".!")
+    return template, slots
+
+
+class PlanCache:
+    """
+    LRU + TTL cache of judged plans keyed on normalized expense text.
+    A hit re-fills the cached plan with the new request's slots, so no planner/judge call is
+    needed. With a db_engine (or a db_url, whose engine is created on first use), entries are
+    also written to SQLite and read back on a miss, which lets the cache survive restarts;
+    lookup_async / store_async do that database I/O in a worker thread.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 86400, db_engine: Optional[Any] = None,
+                 db_url: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._db_engine = db_engine
+        self._db_url = db_url
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._engine_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @property
+    def db_engine(self):
+        if self._db_engine is None and self._db_url:
+            with self._engine_lock:
+                if self._db_engine is None:
+                    self._db_engine = get_db_engine(self._db_url)
+        return self._db_engine
+
+    @property
+    def persistent(self) -> bool:
+        """Whether entries are also kept in the database (without opening it)."""
+        return self._db_engine is not None or bool(self._db_url)
+
+    # --- Public API ---
+
+    def lookup(self, user_id: str, expense_text: str) -> Optional[Dict[str, Any]]:
+        """Returns a filled-in, re-validated plan for this request, or None on a miss."""
+        template, slots = normalize_expense_text(user_id, expense_text)
+        cached = self._get_memory(template)
+        if cached is None and self.persistent:
+            cached = self._load(template)
+        return self._fill(user_id, expense_text, slots, cached)
+
+    async def lookup_async(self, user_id: str, expense_text: str) -> Optional[Dict[str, Any]]:
+        """lookup() for the event loop: an in-memory hit is served inline, the database is read in a worker thread."""
+        template, slots = normalize_expense_text(user_id, expense_text)
+        cached = self._get_memory(template)
+        if cached is None and self.persistent:
+            cached = await asyncio.to_thread(self._load, template)
+        return self._fill(user_id, expense_text, slots, cached)
+
+    def store(self, user_id: str, expense_text: str, final_plan: Dict[str, Any]) -> bool:
+        """
+        Caches a judged plan. Plans whose amounts or vendor cannot be traced back to a slot of
+        the request are not cacheable (their values would be wrong for other requests).
+        """
+        entry = self._prepare(user_id, expense_text, final_plan)
+        if entry is None:
+            return False
+        if self.persistent:
+            self._persist(*entry)
+        return True
+
+    async def store_async(self, user_id: str, expense_text: str, final_plan: Dict[str, Any]) -> bool:
+        """store() for the event loop: the database write runs in a worker thread."""
+        entry = self._prepare(user_id, expense_text, final_plan)
+        if entry is None:
+            return False
+        if self.persistent:
+            await asyncio.to_thread(self._persist, *entry)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # --- Internals ---
+
+    def _fill(self, user_id: str, expense_text: str, slots: Dict[str, Any],
+              cached: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        plan = _fill_slots(cached, slots) if cached else None
+        if plan and not validate_plan(plan, user_id, expense_text)["valid"]:
+            plan = None
+
+        with self._lock:
+            if plan:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if plan:
+            logging.info("PLAN CACHE: Hit, re-filled cached plan")
+            plan["critique"] = "Plan is valid (re-filled from plan cache)."
+        return plan
+
+    def _prepare(self, user_id: str, expense_text: str,
+                 final_plan: Dict[str, Any]) -> Optional[Tuple[str, float, Dict[str, Any]]]:
+        """Stores the templated plan in memory; returns (template, created_at, plan) to persist, or None."""
+        template, slots = normalize_expense_text(user_id, expense_text)
+        templated = _extract_slots(final_plan, slots) if _categories_in_template(final_plan, template) else None
+        if templated is None:
+            logging.info("PLAN CACHE: Plan not cacheable (values not derived from request slots)")
+            return None
+
+        created_at = time.time()
+        self._put(template, created_at, templated)
+        with self._lock:
+            self.stores += 1
+        return template, created_at, templated
+
+    def _get_memory(self, template: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(template)
+            if entry and now - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(template)
+                return entry[1]
+            if entry:
+                del self._entries[template]
+        return None
+
+    def _load(self, template: str) -> Optional[Dict[str, Any]]:
+        """Reads a persisted entry into memory (blocking database I/O)."""
+        now = time.time()
+        with Session(self.db_engine) as session:
+            row = session.get(PlanCacheEntry, template)
+            if row is None or now - row.created_at > self.ttl_seconds:
+                return None
+            plan = json.loads(row.plan_json)
+
+        self._put(template, row.created_at, plan)
+        return plan
+
+    def _put(self, template: str, created_at: float, plan: Dict[str, Any]):
+        with self._lock:
+            self._entries[template] = (created_at, plan)
+            self._entries.move_to_end(template)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _persist(self, template: str, created_at: float, plan: Dict[str, Any]):
+        try:
+            with Session(self.db_engine) as session:
+                session.merge(PlanCacheEntry(template=template, plan_json=json.dumps(plan), created_at=created_at))
+                # Keep the table bounded by the same TTL as the in-memory cache
+                expired = select(PlanCacheEntry).where(PlanCacheEntry.created_at < created_at - self.ttl_seconds)
+                for row in session.exec(expired).all():
+                    session.delete(row)
+                session.commit()
+        except Exception as e:
+            # Persistence is best-effort; the in-memory entry is already stored
+            logging.error(f"PLAN CACHE: Could not persist entry: {e}")
+
+
+def _categories_in_template(final_plan: Dict[str, Any], template: str) -> bool:
+    """
+    A category is only safe to reuse if the unmasked text states it (or a keyword for it).
+    Categories inferred from the vendor would be wrong for the next vendor in the same slot.
+    """
+    words = set(re.findall(r"[a-z']+", template))
+    for step in final_plan.get('plan_steps', []):
+        category = str(step.get('arguments', {}).get('category', ''))
+        if category and category.lower() not in template and not words.intersection(CATEGORY_KEYWORDS.get(category, ())):
+            return False
+    return True
+
+
+def _extract_slots(final_plan: Dict[str, Any], slots: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Replaces slot values in the plan with {{slot}} placeholders, or returns None if not cacheable."""
+    amount_slots = {value: name for name, value in slots.items() if name.startswith("amount_")}
+    steps = []
+    for step in final_plan.get('plan_steps', []):
+        args = dict(step.get('arguments', {}))
+        args['user_id'] = "{{user_id}}"
+
+        if 'amount' in args:
+            try:
+                name = amount_slots.get(float(args['amount']))
+            except (TypeError, ValueError):
+                return None
+            if name is None:
+                return None
+            args['amount'] = "{{" + name + "}}"
+
+        if 'vendor' in args and "vendor" in slots:
+            if args['vendor'] != slots["vendor"]:
+                return None
+            args['vendor'] = "{{vendor}}"
+
+        steps.append({**step, "arguments": args})
+    return {"critique": final_plan.get('critique', ''), "plan_steps": steps}
+
+
+def _fill_slots(templated: Dict[str, Any], slots: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    steps = []
+    for step in templated['plan_steps']:
+        args = {}
+        for key, value in step['arguments'].items():
+            match = _SLOT_RE.match(value) if isinstance(value, str) else None
+            if match:
+                if match.group(1) not in slots:
+                    return None
+                value = slots[match.group(1)]
+            args[key] = value
+        steps.append({**step, "arguments": args})
+    return {"critique": templated.get('critique', ''), "plan_steps": steps}
+
+
+# The global cache used by the main application
+PLAN_CACHE = PlanCache(
+    max_size=PLAN_CACHE_MAX_SIZE,
+    ttl_seconds=PLAN_CACHE_TTL_SECONDS,
+    db_url=PLAN_CACHE_DB_URL
+)
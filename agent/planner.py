@@ -1,11 +1,14 @@
+import asyncio
 import json
 import logging
-from typing import Dict, Any
-from google.genai import types
+import re
+from typing import Dict, Any, Callable, List, Optional, Tuple
 
 # Import centralized configuration and schema
-from client_config import PLANNER_MODEL, JUDGE_MODEL
-from schemas.plan_schema import PLAN_SCHEMA
+from client_config import PLANNER_MODEL, JUDGE_MODEL, VENDOR_INDEX_MIN_CONFIDENCE
+from schemas.plan_schema import PLAN_SCHEMA, BATCH_PLAN_SCHEMA, COALESCED_PLAN_SCHEMA
+from .tools import TOOL_REGISTRY
+from . import metrics, prompts
 
 # --- TOOL DEFINITIONS (Text-based for JSON Mode) ---
 TOOL_DESCRIPTIONS = """
@@ -48,71 +51,606 @@ If the plan is flawed, explain why in the 'critique' field and provide the corre
 If perfect, put 'Plan is valid' in 'critique' and return the original plan steps.
 """
 
+# --- BATCH PROMPTS (one plan for a whole expense report) ---
 
-def run_planner_auditor(client, user_id: str, expense_text: str, available_tools_declarations: list) -> Dict[str, Any]:
+BATCH_PLANNER_PROMPT = f"""
+You are the Strategic Planner for a Financial Auditor. The user submitted an expense report 
+with several numbered line items. Produce ONE plan that covers every line.
+
+{TOOL_DESCRIPTIONS}
+
+STRATEGIC RULES:
+1. Emit exactly one 'log_expense_tool' call per line item, with 'line_item' set to its number.
+2. After ALL expenses are logged, emit exactly one 'check_budget_tool' call per distinct 
+   category that was logged. Never check the same category twice.
+3. Order: all Log Expense steps first -> then the Check Budget steps.
+
+You MUST output a JSON object that adheres strictly to the provided schema.
+CRITICAL: Every tool call must include the 'user_id' in its arguments.
+"""
+
+BATCH_JUDGE_PROMPT = f"""
+CRITIC: You are evaluating a multi-expense action plan for a Financial Auditor.
+{TOOL_DESCRIPTIONS}
+
+Check for:
+1. COVERAGE: Every numbered line item has exactly one 'log_expense_tool' call with the correct 
+   'line_item', vendor, amount and category. No line is skipped or duplicated.
+2. AUDITOR RULE: Every logged category MUST get exactly one 'check_budget_tool' call, placed 
+   after all 'log_expense_tool' calls. If this is missing, the plan is INVALID.
+3. Accuracy: Are the tool names and arguments (user_id, amount, category) extracted correctly?
+
+If the plan is flawed, explain why in the 'critique' field and provide the corrected plan. 
+If perfect, put 'Plan is valid' in 'critique' and return the original plan steps.
+"""
+
+# --- COALESCED PROMPTS (several users' requests in one call, see agent.coalescer) ---
+
+COALESCED_PLANNER_PROMPT = PLANNER_PROMPT + """
+BATCHED INPUT: You will receive several INDEPENDENT numbered requests, each with its own User ID.
+Plan every request separately (never mix expenses or user ids between requests) and return one 
+entry per request in 'plans', with 'request_number' set to the request's number.
+"""
+
+COALESCED_JUDGE_PROMPT = JUDGE_PROMPT + """
+BATCHED INPUT: You will receive several INDEPENDENT numbered requests, each with its proposed plan.
+Judge every plan separately against its own request and return one entry per request in 'plans', 
+with 'request_number' set to the request's number.
+"""
+
+
+# --- LOCAL FAST PATH (deterministic extraction, no LLM) ---
+
+# Plans built locally are only trusted above this score; anything lower goes to Gemini.
+FAST_PATH_MIN_CONFIDENCE = 0.9
+
+# Keyword hints used when the user does not name the category explicitly ("under Meals").
+CATEGORY_KEYWORDS = {
+    "Meals": ("lunch", "dinner", "breakfast", "brunch", "coffee", "meal", "restaurant", "snacks"),
+    "Hardware": ("monitor", "laptop", "keyboard", "mouse", "printer", "headphones", "webcam", "hardware"),
+    "Travel": ("flight", "airfare", "taxi", "uber", "lyft", "hotel", "train", "parking"),
+    "Software": ("subscription", "license", "licence", "software", "saas"),
+    "Office Supplies": ("paper", "pens", "stationery", "toner", "supplies"),
+}
+
+# Inputs containing these are never planned locally (refunds, splits, questions, ...).
+AMBIGUITY_MARKERS = re.compile(r"\b(refund|return(ed)?|split|cancel(led)?|not|don't|didn't|undo|delete)\b|\?", re.IGNORECASE)
+
+_AMOUNT_RE = re.compile(r"\$\s?(\d{1,3}(?:,\d{3})+(?:\.\d{1,2})?|\d+(?:\.\d{1,2})?)")
+_VENDOR_RE = re.compile(r"\bat\s+(?:the\s+)?([A-Z][\w&'-]*(?:\s+[A-Z0-9][\w&'-]*)*)")
+_EXPLICIT_CATEGORY_RE = re.compile(r"\b(?:under|category:?)\s+(?:the\s+)?([A-Z][\w&]*(?:\s+[A-Z][\w&]*)*)")
+
+# Confidence contributions per extracted field (sum to 1.0 for a fully explicit request)
+_AMOUNT_WEIGHT = 0.4
+_VENDOR_WEIGHT = 0.3
+_EXPLICIT_CATEGORY_WEIGHT = 0.3
+_KEYWORD_CATEGORY_WEIGHT = 0.2
+_VENDOR_HISTORY_WEIGHT = 0.2  # Category learned from the vendor's history (agent.vendor_index)
+
+
+def extract_expense_fields(expense_text: str, user_id: Optional[str] = None, vendor_index: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Parses amount, vendor and category out of a single-expense request with regexes and
+    keyword hints. Returns the fields found plus a 0-1 'confidence' score; any ambiguity
+    (several amounts, refunds, questions, conflicting categories) scores 0.
+    With a vendor_index (agent.vendor_index.VendorIndex), a known vendor fills in a missing
+    category, a keyword category its history agrees with counts as explicit, and one its
+    history contradicts is dropped (so the request goes to the planner LLM).
+    """
+    fields = {"amount": None, "vendor": None, "category": None, "confidence": 0.0}
+
+    if AMBIGUITY_MARKERS.search(expense_text):
+        return fields
+
+    amounts = _AMOUNT_RE.findall(expense_text)
+    if len(amounts) != 1:
+        return fields
+    fields["amount"] = float(amounts[0].replace(",", ""))
+    confidence = _AMOUNT_WEIGHT
+
+    vendor_match = _VENDOR_RE.search(expense_text)
+    if vendor_match:
+        fields["vendor"] = vendor_match.group(1).strip()
+        confidence += _VENDOR_WEIGHT
+
+    fields["category"], category_confidence = infer_category(expense_text)
+    if vendor_index is not None and fields["vendor"] and category_confidence < _EXPLICIT_CATEGORY_WEIGHT:
+        fields["category"], category_confidence = _apply_vendor_history(
+            vendor_index, fields["vendor"], user_id, fields["category"], category_confidence
+        )
+    confidence += category_confidence
+
+    fields["confidence"] = round(confidence, 2)
+    return fields
+
+
+def _apply_vendor_history(vendor_index, vendor: str, user_id: Optional[str], category: Optional[str],
+                          category_confidence: float) -> Tuple[Optional[str], float]:
+    match = vendor_index.lookup(vendor, user_id)
+    if match is None or match.confidence < VENDOR_INDEX_MIN_CONFIDENCE:
+        return category, category_confidence
+    if category is None:
+        logging.info(f"VENDOR INDEX: '{vendor}' -> {match.category} ({match.match} match, confidence {match.confidence})")
+        return match.category, _VENDOR_HISTORY_WEIGHT
+    if category.lower() == match.category.lower():
+        return category, _EXPLICIT_CATEGORY_WEIGHT
+    # The vendor's history confidently says otherwise: neither source is trusted, the LLM decides
+    logging.info(f"VENDOR INDEX: '{vendor}' is usually {match.category}, not {category}; deferring to the planner")
+    return None, 0.0
+
+
+def infer_category(expense_text: str) -> Tuple[Optional[str], float]:
+    """Returns (category, confidence contribution) from an explicit 'under X' or keyword hints."""
+    category_match = _EXPLICIT_CATEGORY_RE.search(expense_text)
+    if category_match:
+        return category_match.group(1).strip(), _EXPLICIT_CATEGORY_WEIGHT
+
+    words = set(re.findall(r"[a-z']+", expense_text.lower()))
+    hinted = [category for category, keywords in CATEGORY_KEYWORDS.items() if words.intersection(keywords)]
+    if len(hinted) == 1:
+        return hinted[0], _KEYWORD_CATEGORY_WEIGHT
+    return None, 0.0
+
+
+def build_fast_path_plan(user_id: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Builds the fixed log -> check plan (PLAN_SCHEMA) from extracted fields."""
+    return {
+        "critique": f"Plan is valid (built by the local fast path, confidence {fields['confidence']:.2f}).",
+        "plan_steps": [
+            {
+                "step_number": 1,
+                "tool_name": "log_expense_tool",
+                "arguments": {
+                    "user_id": user_id,
+                    "vendor": fields["vendor"],
+                    "amount": fields["amount"],
+                    "category": fields["category"]
+                }
+            },
+            {
+                "step_number": 2,
+                "tool_name": "check_budget_tool",
+                "arguments": {"user_id": user_id, "category": fields["category"]}
+            }
+        ]
+    }
+
+
+def _fast_path_plan(user_id: str, expense_text: str, vendor_index: Optional[Any] = None) -> Optional[Dict[str, Any]]:
+    """Returns a locally built plan when extraction is confident enough, else None."""
+    fields = extract_expense_fields(expense_text, user_id, vendor_index)
+    if fields["confidence"] < FAST_PATH_MIN_CONFIDENCE:
+        logging.info(f"FAST PATH: Confidence {fields['confidence']:.2f} too low, deferring to the planner LLM")
+        return None
+
+    logging.info(f"FAST PATH: Planned locally (confidence {fields['confidence']:.2f}), skipping planner and judge")
+    return build_fast_path_plan(user_id, fields)
+
+
+# --- LOCAL JUDGE (static validation + auto-repair, no LLM) ---
+
+REQUIRED_STRING_ARGS = {
+    "log_expense_tool": ("vendor", "category"),
+    "check_budget_tool": ("category",),
+}
+
+_NUMBER_RE = re.compile(r"\d[\d,]*(?:\.\d+)?")
+_LINE_ITEM_RE = re.compile(r"^\s*\d+\.\s+(.+)$", re.MULTILINE)
+
+
+def validate_plan(plan_data: Dict[str, Any], user_id: str, expense_text: str, batch: bool = False) -> Dict[str, Any]:
+    """
+    Statically checks a planner plan against the rules the Judge enforces and repairs what
+    can be repaired safely: wrong/missing user_id, numeric strings for amounts, step numbering
+    and missing budget checks. Unknown tools, missing vendor/category, non-numeric amounts,
+    amounts that do not appear in the request, and a number of log steps other than one per
+    expense (one per line item with batch=True; no expense logged twice) cannot be repaired.
+
+    Returns {"valid": bool, "plan": repaired plan or None, "repairs": [...], "problems": [...]}.
+    """
+    repairs, problems = [], []
+    raw_steps = plan_data.get('plan_steps') if isinstance(plan_data, dict) else None
+    if not isinstance(raw_steps, list) or not raw_steps:
+        return {"valid": False, "plan": None, "repairs": repairs, "problems": ["Plan has no steps."]}
+
+    request_amounts = _amounts(expense_text)
+    items = [_amounts(item) for item in _LINE_ITEM_RE.findall(expense_text)] if batch else []
+    items = items or [request_amounts]  # The amounts each expense of the request can log
+    logged: Dict[tuple, int] = {}
+    steps = []
+
+    for index, raw_step in enumerate(raw_steps, start=1):
+        if not isinstance(raw_step, dict) or not isinstance(raw_step.get('arguments', {}), dict):
+            problems.append(f"Step {index} is malformed.")
+            continue
+
+        step = {**raw_step, "arguments": dict(raw_step.get('arguments', {}))}
+        tool_name, args = step.get('tool_name'), step['arguments']
+
+        if tool_name not in TOOL_REGISTRY:
+            problems.append(f"Step {index} uses unknown tool '{tool_name}'.")
+            continue
+
+        if args.get('user_id') != user_id:
+            repairs.append(f"Step {index}: set user_id to '{user_id}'.")
+            args['user_id'] = user_id
+
+        for name in REQUIRED_STRING_ARGS[tool_name]:
+            if not isinstance(args.get(name), str) or not args[name].strip():
+                problems.append(f"Step {index} ({tool_name}) is missing '{name}'.")
+
+        if tool_name == "log_expense_tool":
+            amount = _coerce_amount(args.get('amount'))
+            if amount is None:
+                problems.append(f"Step {index}: amount {args.get('amount')!r} is not numeric.")
+            elif amount not in request_amounts:
+                problems.append(f"Step {index}: amount {amount} does not appear in the request.")
+            else:
+                if amount != args.get('amount'):
+                    repairs.append(f"Step {index}: coerced amount {args.get('amount')!r} to {amount}.")
+                    args['amount'] = amount
+                expense = (str(args.get('vendor')).strip().lower(), amount, str(args.get('category')).strip().lower())
+                logged[expense] = logged.get(expense, 0) + 1
+                if logged[expense] > sum(amount in item for item in items):
+                    problems.append(f"Step {index} logs the same expense twice.")
+
+        steps.append(step)
+
+    log_count = sum(1 for step in steps if step.get('tool_name') == "log_expense_tool")
+    if log_count != len(items):
+        problems.append(f"Plan has {log_count} log_expense_tool steps for {len(items)} expense(s).")
+
+    if problems:
+        return {"valid": False, "plan": None, "repairs": repairs, "problems": problems}
+
+    steps = _insert_missing_budget_checks(steps, user_id, batch, repairs)
+
+    for number, step in enumerate(steps, start=1):
+        if step.get('step_number') != number:
+            step['step_number'] = number
+            if "Renumbered steps." not in repairs:
+                repairs.append("Renumbered steps.")
+
+    critique = "Plan is valid (verified locally)."
+    if repairs:
+        critique = "Plan repaired locally: " + " ".join(repairs)
+    return {"valid": True, "plan": {"critique": critique, "plan_steps": steps}, "repairs": repairs, "problems": []}
+
+
+def plan_request_mismatches(plan_data: Dict[str, Any], user_id: str, expense_text: str) -> List[str]:
+    """
+    Checks that a Judge LLM plan belongs to its request: steps carry the request's user_id
+    (or none) and every logged amount appears in the request. Unlike validate_plan, the number
+    of log steps is the Judge's call. Returns the mismatches found (empty when it belongs).
+    """
+    raw_steps = plan_data.get('plan_steps') if isinstance(plan_data, dict) else None
+    if not isinstance(raw_steps, list):
+        return ["Plan has no step list."]
+
+    request_amounts = _amounts(expense_text)
+    mismatches = []
+    for index, step in enumerate(raw_steps, start=1):
+        args = step.get('arguments') if isinstance(step, dict) else None
+        if not isinstance(args, dict):
+            continue
+        if args.get('user_id') not in (None, user_id):
+            mismatches.append(f"Step {index} is for user '{args['user_id']}', not '{user_id}'.")
+        if step.get('tool_name') == "log_expense_tool":
+            amount = _coerce_amount(args.get('amount'))
+            if amount is not None and amount not in request_amounts:
+                mismatches.append(f"Step {index}: amount {amount} does not appear in the request.")
+    return mismatches
+
+
+def _amounts(text: str) -> set:
+    return {float(n.replace(",", "")) for n in _NUMBER_RE.findall(text)}
+
+
+def _coerce_amount(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.replace("$", "").replace(",", "").strip())
+        except ValueError:
+            return None
+    return None
+
+
+def _insert_missing_budget_checks(steps: list, user_id: str, batch: bool, repairs: list) -> list:
+    """
+    AUDITOR RULE: every logged category needs a later budget check. Single plans get the
+    check right after the category's last log; batch plans get it appended at the end.
+    """
+    result = list(steps)
+    for category in dict.fromkeys(s['arguments']['category'] for s in steps if s['tool_name'] == "log_expense_tool"):
+        last_log = max(i for i, s in enumerate(result)
+                       if s['tool_name'] == "log_expense_tool" and s['arguments']['category'] == category)
+        if any(s['tool_name'] == "check_budget_tool" and s['arguments']['category'] == category
+               for s in result[last_log + 1:]):
+            continue
+
+        check = {
+            "step_number": 0,
+            "tool_name": "check_budget_tool",
+            "arguments": {"user_id": user_id, "category": category}
+        }
+        result.insert(len(result) if batch else last_log + 1, check)
+        repairs.append(f"Inserted missing budget check for '{category}'.")
+    return result
+
+
+def _local_judge(initial_plan_data: Dict[str, Any], user_id: str, expense_text: str, batch: bool) -> Optional[Dict[str, Any]]:
+    """Returns the locally validated/repaired plan, or None when the Judge LLM must decide."""
+    validation = validate_plan(initial_plan_data, user_id, expense_text, batch)
+    if not validation["valid"]:
+        logging.info(f"LOCAL JUDGE: Cannot prove plan valid ({' '.join(validation['problems'])}), calling Judge LLM")
+        return None
+
+    logging.info(f"LOCAL JUDGE: {validation['plan']['critique']} Skipping Judge LLM")
+    return validation["plan"]
+
+
+def run_planner_auditor(client, user_id: str, expense_text: str, available_tools_declarations: Optional[list] = None, batch: bool = False, fast_path: bool = True, local_judge: bool = True, plan_cache: Optional[Any] = None, coalescer: Optional[Any] = None, vendor_index: Optional[Any] = None) -> Dict[str, Any]:
     """
     Orchestrates the Planning and Reflection phases.
     Fails fast on system errors to prevent unvalidated plan execution.
+    With batch=True, `expense_text` holds numbered line items and a single multi-expense
+    plan (BATCH_PLAN_SCHEMA) is produced for all of them.
+    Well-formed single expenses are planned locally (see extract_expense_fields) unless
+    fast_path=False; the LLMs only see requests the extractor cannot parse confidently.
+    Planner output is then checked by validate_plan; the Judge LLM only runs when the plan
+    cannot be proven valid or repaired locally (or local_judge=False).
+    An optional plan_cache (agent.plan_cache.PlanCache) is consulted before the planner LLM
+    and receives every judged plan. With a coalescer (agent.coalescer.LLMCoalescer), single
+    requests share their planner/judge calls with concurrent requests. A vendor_index
+    (agent.vendor_index.VendorIndex) lets the fast path take categories from vendor history.
     """
 
+    # --- PHASE 0: LOCAL FAST PATH / PLAN CACHE ---
+    if fast_path and not batch:
+        fast_plan = _fast_path_plan(user_id, expense_text, vendor_index)
+        metrics.record_cache("fast_path", fast_plan is not None)
+        if fast_plan:
+            return _planning_result(fast_plan)
+
+    cached_plan = _cache_lookup(plan_cache, user_id, expense_text, batch)
+    if cached_plan:
+        return _planning_result(cached_plan)
+
     # --- PHASE 1: INITIAL PLANNING ---
     logging.info("PHASE 1: Generating Initial Plan")
 
     try:
-        plan_response = client.models.generate_content(
-            model=PLANNER_MODEL,
-            contents=f"User ID: {user_id}\nRequest: {expense_text}",
-            config=types.GenerateContentConfig(
-                system_instruction=PLANNER_PROMPT,
-                # Tools are omitted here because we use TOOL_DESCRIPTIONS in prompt + JSON mode
-                response_mime_type="application/json",
-                response_schema=PLAN_SCHEMA
-            )
-        )
-        initial_plan_data = json.loads(plan_response.text)
+        with metrics.phase("planner"):
+            plan_text = _call_planner(client, coalescer, user_id, expense_text, batch)
+            initial_plan_data = json.loads(plan_text)
     except Exception as e:
-        logging.error(f"PLANNING CRITICAL ERROR: {e}")
-        return {
-            "final_report": f"Audit aborted: Initial planning failed due to system error: {e}",
-            "plan_steps": [],
-            "final_plan": {}
-        }
+        return _planning_failure(e)
+
+    # --- PHASE 2a: LOCAL VALIDATION/REPAIR ---
+    if local_judge:
+        validated_plan = _local_judge(initial_plan_data, user_id, expense_text, batch)
+        metrics.record_cache("local_judge", validated_plan is not None)
+        if validated_plan:
+            return _cache_and_return(plan_cache, user_id, expense_text, batch, validated_plan)
 
     # --- PHASE 2: JUDGE/REFLECTION ---
     logging.info("PHASE 2: Judging/Correcting Plan")
 
-    judge_contents = [
-        f"Request: {expense_text}",
-        f"Proposed Plan: {plan_response.text}"
-    ]
+    try:
+        with metrics.phase("judge"):
+            final_plan_data = json.loads(_call_judge(client, coalescer, user_id, expense_text, plan_text, batch))
+        logging.info(f"Judge Reflection: {final_plan_data.get('critique', 'No critique provided.')}")
+
+    except Exception as e:
+        return _reflection_failure(e)
+
+    return _cache_and_return(plan_cache, user_id, expense_text, batch, final_plan_data)
+
+
+async def run_planner_auditor_async(client, user_id: str, expense_text: str, available_tools_declarations: Optional[list] = None, batch: bool = False, fast_path: bool = True, local_judge: bool = True, plan_cache: Optional[Any] = None, on_plan: Optional[Callable[[Dict[str, Any]], None]] = None, coalescer: Optional[Any] = None, vendor_index: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Async counterpart of run_planner_auditor using the client's `aio` surface.
+    Same fail-fast guarantees: a failed Judge call never falls back to the initial plan.
+    `on_plan` is called with the planner LLM's initial plan before it is judged (streaming).
+    """
+
+    # --- PHASE 0: LOCAL FAST PATH / PLAN CACHE ---
+    if fast_path and not batch:
+        fast_plan = _fast_path_plan(user_id, expense_text, vendor_index)
+        metrics.record_cache("fast_path", fast_plan is not None)
+        if fast_plan:
+            return _planning_result(fast_plan)
+
+    cached_plan = await _cache_lookup_async(plan_cache, user_id, expense_text, batch)
+    if cached_plan:
+        return _planning_result(cached_plan)
+
+    # --- PHASE 1: INITIAL PLANNING ---
+    logging.info("PHASE 1: Generating Initial Plan")
 
     try:
-        judge_response = client.models.generate_content(
-            model=JUDGE_MODEL,
-            contents=judge_contents,
-            config=types.GenerateContentConfig(
-                system_instruction=JUDGE_PROMPT,
-                response_mime_type="application/json",
-                response_schema=PLAN_SCHEMA
-            )
-        )
-        final_plan_data = json.loads(judge_response.text)
+        with metrics.phase("planner"):
+            plan_text = await _call_planner_async(client, coalescer, user_id, expense_text, batch)
+            initial_plan_data = json.loads(plan_text)
+    except Exception as e:
+        return _planning_failure(e)
+
+    if on_plan:
+        on_plan(initial_plan_data)
+
+    # --- PHASE 2a: LOCAL VALIDATION/REPAIR ---
+    if local_judge:
+        validated_plan = _local_judge(initial_plan_data, user_id, expense_text, batch)
+        metrics.record_cache("local_judge", validated_plan is not None)
+        if validated_plan:
+            return await _cache_and_return_async(plan_cache, user_id, expense_text, batch, validated_plan)
+
+    # --- PHASE 2: JUDGE/REFLECTION ---
+    logging.info("PHASE 2: Judging/Correcting Plan")
+
+    try:
+        with metrics.phase("judge"):
+            final_plan_data = json.loads(await _call_judge_async(client, coalescer, user_id, expense_text, plan_text, batch))
         logging.info(f"Judge Reflection: {final_plan_data.get('critique', 'No critique provided.')}")
 
     except Exception as e:
-        # 🟢 FAIL FAST: Do not "fallback" to the initial plan if the system is failing (e.g., 429 Quota)
-        # This prevents unvalidated actions from being executed.
-        error_msg = f"Audit aborted: Reflection phase failed due to system error: {e}"
-        logging.error(error_msg)
-        return {
-            "final_report": error_msg,
-            "plan_steps": [],
-            "final_plan": {},
-            "critique": "SYSTEM FAILURE"
-        }
+        return _reflection_failure(e)
+
+    return await _cache_and_return_async(plan_cache, user_id, expense_text, batch, final_plan_data)
+
+
+# --- REQUEST/RESULT HELPERS (shared by the sync and async paths) ---
+
+def _call_planner(client, coalescer, user_id: str, expense_text: str, batch: bool) -> str:
+    if coalescer and not batch:
+        return coalescer.plan(user_id, expense_text).result()
+    plan_response = client.models.generate_content(**_planner_request(user_id, expense_text, batch, client))
+    metrics.record_usage("planner", plan_response)
+    return plan_response.text
+
+
+async def _call_planner_async(client, coalescer, user_id: str, expense_text: str, batch: bool) -> str:
+    if coalescer and not batch:
+        return await asyncio.wrap_future(coalescer.plan(user_id, expense_text))
+    await prompts.prepare_async(client, PLANNER_MODEL, BATCH_PLANNER_PROMPT if batch else PLANNER_PROMPT)
+    plan_response = await client.aio.models.generate_content(**_planner_request(user_id, expense_text, batch, client))
+    metrics.record_usage("planner", plan_response)
+    return plan_response.text
+
+
+def _call_judge(client, coalescer, user_id: str, expense_text: str, proposed_plan_text: str, batch: bool) -> str:
+    if coalescer and not batch:
+        return coalescer.judge(user_id, expense_text, proposed_plan_text).result()
+    judge_response = client.models.generate_content(**_judge_request(expense_text, proposed_plan_text, batch, client))
+    metrics.record_usage("judge", judge_response)
+    return judge_response.text
+
+
+async def _call_judge_async(client, coalescer, user_id: str, expense_text: str, proposed_plan_text: str, batch: bool) -> str:
+    if coalescer and not batch:
+        return await asyncio.wrap_future(coalescer.judge(user_id, expense_text, proposed_plan_text))
+    await prompts.prepare_async(client, JUDGE_MODEL, BATCH_JUDGE_PROMPT if batch else JUDGE_PROMPT)
+    judge_response = await client.aio.models.generate_content(**_judge_request(expense_text, proposed_plan_text, batch, client))
+    metrics.record_usage("judge", judge_response)
+    return judge_response.text
+
+
+def _json_config(system_instruction: str, response_schema: Dict[str, Any], client=None, model: str = PLANNER_MODEL, phase_name: str = "planner"):
+    # Compacted and, where Gemini context caching is available for `client`, sent by handle
+    return prompts.json_config(client, model, system_instruction, response_schema, phase_name)
+
+
+def _planner_request(user_id: str, expense_text: str, batch: bool = False, client=None) -> Dict[str, Any]:
+    return {
+        "model": PLANNER_MODEL,
+        "contents": f"User ID: {user_id}\nRequest: {expense_text}",
+        # Tools are omitted here because we use TOOL_DESCRIPTIONS in prompt + JSON mode
+        "config": _json_config(BATCH_PLANNER_PROMPT if batch else PLANNER_PROMPT, BATCH_PLAN_SCHEMA if batch else PLAN_SCHEMA,
+                               client, PLANNER_MODEL, "planner")
+    }
+
+
+def _judge_request(expense_text: str, proposed_plan_text: str, batch: bool = False, client=None) -> Dict[str, Any]:
+    return {
+        "model": JUDGE_MODEL,
+        "contents": [
+            f"Request: {expense_text}",
+            f"Proposed Plan: {_compact_plan(proposed_plan_text)}"
+        ],
+        "config": _json_config(BATCH_JUDGE_PROMPT if batch else JUDGE_PROMPT, BATCH_PLAN_SCHEMA if batch else PLAN_SCHEMA,
+                               client, JUDGE_MODEL, "judge")
+    }
+
+
+def _coalesced_planner_request(items: List[Tuple[str, str]], client=None) -> Dict[str, Any]:
+    """One planner request for several (user_id, expense_text) items."""
+    blocks = [
+        f"### Request {number}\nUser ID: {user_id}\nRequest: {expense_text}"
+        for number, (user_id, expense_text) in enumerate(items, start=1)
+    ]
+    return {
+        "model": PLANNER_MODEL,
+        "contents": "\n\n".join(blocks),
+        "config": _json_config(COALESCED_PLANNER_PROMPT, COALESCED_PLAN_SCHEMA, client, PLANNER_MODEL, "planner")
+    }
+
+
+def _coalesced_judge_request(items: List[Tuple[str, str]], client=None) -> Dict[str, Any]:
+    """One judge request for several (expense_text, proposed_plan_text) items."""
+    blocks = [
+        f"### Request {number}\nRequest: {expense_text}\nProposed Plan: {_compact_plan(proposed_plan_text)}"
+        for number, (expense_text, proposed_plan_text) in enumerate(items, start=1)
+    ]
+    return {
+        "model": JUDGE_MODEL,
+        "contents": "\n\n".join(blocks),
+        "config": _json_config(COALESCED_JUDGE_PROMPT, COALESCED_PLAN_SCHEMA, client, JUDGE_MODEL, "judge")
+    }
+
+
+def _compact_plan(proposed_plan_text: str) -> str:
+    compact = prompts.compact_plan_text(proposed_plan_text)
+    prompts.record_compaction("judge", proposed_plan_text, compact)
+    return compact
+
+
+def _planning_failure(e: Exception) -> Dict[str, Any]:
+    logging.error(f"PLANNING CRITICAL ERROR: {e}")
+    return {
+        "final_report": f"Audit aborted: Initial planning failed due to system error: {e}",
+        "plan_steps": [],
+        "final_plan": {}
+    }
+
+
+def _reflection_failure(e: Exception) -> Dict[str, Any]:
+    # 🟢 FAIL FAST: Do not "fallback" to the initial plan if the system is failing (e.g., 429 Quota)
+    # This prevents unvalidated actions from being executed.
+    error_msg = f"Audit aborted: Reflection phase failed due to system error: {e}"
+    logging.error(error_msg)
+    return {
+        "final_report": error_msg,
+        "plan_steps": [],
+        "final_plan": {},
+        "critique": "SYSTEM FAILURE"
+    }
+
+
+def _cache_lookup(plan_cache, user_id: str, expense_text: str, batch: bool) -> Optional[Dict[str, Any]]:
+    if not plan_cache or batch:
+        return None
+    cached_plan = plan_cache.lookup(user_id, expense_text)
+    metrics.record_cache("plan_cache", cached_plan is not None)
+    return cached_plan
+
+
+def _cache_and_return(plan_cache, user_id: str, expense_text: str, batch: bool, final_plan_data: Dict[str, Any]) -> Dict[str, Any]:
+    if plan_cache and not batch and final_plan_data.get('plan_steps'):
+        plan_cache.store(user_id, expense_text, final_plan_data)
+    return _planning_result(final_plan_data)
+
+
+async def _cache_lookup_async(plan_cache, user_id: str, expense_text: str, batch: bool) -> Optional[Dict[str, Any]]:
+    if not plan_cache or batch:
+        return None
+    cached_plan = await plan_cache.lookup_async(user_id, expense_text)
+    metrics.record_cache("plan_cache", cached_plan is not None)
+    return cached_plan
+
+
+async def _cache_and_return_async(plan_cache, user_id: str, expense_text: str, batch: bool, final_plan_data: Dict[str, Any]) -> Dict[str, Any]:
+    if plan_cache and not batch and final_plan_data.get('plan_steps'):
+        await plan_cache.store_async(user_id, expense_text, final_plan_data)
+    return _planning_result(final_plan_data)
+
 
+def _planning_result(final_plan_data: Dict[str, Any]) -> Dict[str, Any]:
     return {
         "final_plan": final_plan_data,
         "plan_steps": final_plan_data.get('plan_steps', []),
         "critique": final_plan_data.get('critique', '')
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,243 @@
+# agent/prompts.py
+"""
+Prompt building shared by every Gemini call: compact encodings of what varies per request
+and explicit context caching of what does not.
+
+* compact_json / compact_history / compact_plan_text minify JSON (no indentation, no
+  fields the model does not need);
+* json_config / text_config compact the static system instruction once and, when Gemini
+  context caching is available for it, send a cached-content handle instead of the text.
+  Handles are created once per (client, model, instruction) and reused until their TTL.
+  Caching is opt-in (PROMPT_CACHE_ENABLED): the shipped instructions are below Gemini's
+  1024-token cacheable minimum, so only compaction applies to them.
+  Async callers await prepare_async first, so the create call never runs on the event loop.
+
+Tokens saved by both are reported per phase (metrics.record_tokens_saved).
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from client_config import (
+    PROMPT_CACHE_ENABLED, PROMPT_CACHE_TTL_SECONDS, PROMPT_CACHE_MIN_TOKENS, PROMPT_CACHE_RETRY_SECONDS,
+)
+from . import metrics
+
+# Fields of a check_budget_tool result the summarizer needs (its 'message' restates them)
+SUMMARY_BUDGET_FIELDS = ("category", "total_spent", "limit", "status", "period")
+# Handles are refreshed this long before Gemini expires them
+CACHE_REFRESH_MARGIN_SECONDS = 60
+
+_SPACE_RUN_RE = re.compile(r"[ \t]+")
+
+
+def estimate_prompt_tokens(text: str) -> int:
+    """Same 4-characters-per-token estimate the scheduler uses."""
+    return len(text) // 4
+
+
+# --- Compact encodings ---
+
+def compact_json(value: Any) -> str:
+    return json.dumps(value, separators=(",", ":"), default=str)
+
+
+@functools.lru_cache(maxsize=64)
+def compact_instruction(text: str) -> Tuple[str, int]:
+    """Strips indentation-like whitespace from a static prompt; returns (text, tokens saved)."""
+    lines = [_SPACE_RUN_RE.sub(" ", line).strip() for line in text.strip().splitlines()]
+    compact = "\n".join(line for line in lines if line)
+    return compact, estimate_prompt_tokens(text) - estimate_prompt_tokens(compact)
+
+
+def compact_history(execution_history: List[Any]) -> List[Any]:
+    """The execution history without fields the summary model does not need."""
+    compacted = []
+    for entry in execution_history:
+        if not isinstance(entry, dict):
+            compacted.append(entry)
+            continue
+        entry = {key: value for key, value in entry.items() if value not in (None, "", [], {})}
+        result = entry.get('result')
+        if entry.get('tool_name') == "check_budget_tool" and isinstance(result, dict):
+            entry['result'] = {key: result[key] for key in SUMMARY_BUDGET_FIELDS if key in result}
+        compacted.append(entry)
+    return compacted
+
+
+def compact_plan_text(plan_text: str) -> str:
+    """Minifies a planner response for the Judge, dropping the planner's (empty) critique."""
+    try:
+        plan = json.loads(plan_text)
+    except (TypeError, ValueError):
+        return plan_text
+    if isinstance(plan, dict) and not plan.get('critique'):
+        plan.pop('critique', None)
+    return compact_json(plan)
+
+
+def record_compaction(phase_name: str, original: str, compact: str):
+    saved = estimate_prompt_tokens(original) - estimate_prompt_tokens(compact)
+    if saved > 0:
+        metrics.record_tokens_saved(phase_name, "compaction", saved)
+
+
+# --- Request configs ---
+
+def json_config(client, model: str, system_instruction: str, response_schema: Dict[str, Any], phase_name: str):
+    """GenerateContentConfig for a JSON-mode call (cached system instruction when possible)."""
+    return _config(client, model, system_instruction, phase_name,
+                   response_mime_type="application/json", response_schema=response_schema)
+
+
+def text_config(client, model: str, system_instruction: str, phase_name: str):
+    """GenerateContentConfig for a free-text call (the summary)."""
+    return _config(client, model, system_instruction, phase_name)
+
+
+async def prepare_async(client, model: str, system_instruction: str):
+    """
+    Makes sure this instruction's context-cache handle exists, creating it in a worker thread.
+    Await it before json_config / text_config on the event loop, which then only reuse it.
+    """
+    await CONTEXT_CACHE.handle_async(client, model, compact_instruction(system_instruction)[0])
+
+
+def _config(client, model: str, system_instruction: str, phase_name: str, **kwargs):
+    # Imported lazily: google.genai is slow to load and fast-path requests never need it
+    from google.genai import types
+
+    instruction, saved = compact_instruction(system_instruction)
+    if saved > 0:
+        metrics.record_tokens_saved(phase_name, "compaction", saved)
+
+    cache_name = CONTEXT_CACHE.handle(client, model, instruction)
+    if cache_name:
+        return types.GenerateContentConfig(cached_content=cache_name, **kwargs)
+    return types.GenerateContentConfig(system_instruction=instruction, **kwargs)
+
+
+# --- Explicit context caching ---
+
+class ContextCache:
+    """
+    Registers static system instructions with Gemini context caching (client.caches.create)
+    and hands out the cache name for later calls. Instructions below `min_tokens` (Gemini's
+    minimum cacheable size), clients without a `caches` API and failed creations fall back to
+    plain prompts; a failure is remembered for `retry_seconds` so it is not retried per request.
+    """
+
+    def __init__(self, enabled: bool = True, ttl_seconds: float = 3600, min_tokens: int = 1024, retry_seconds: float = 600):
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.retry_seconds = retry_seconds
+        self._handles: Dict[Tuple[int, str, str], Tuple[Any, Optional[str], float]] = {}
+        self._creating: Dict[Tuple[int, str, str], threading.Lock] = {}  # Per-instruction create locks
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.created = 0
+        self.failures = 0
+        self.skipped = 0
+
+    def handle(self, client, model: str, system_instruction: str) -> Optional[str]:
+        """The cached-content name to use for this instruction, or None to send it inline."""
+        key = self._key(client, model, system_instruction)
+        if key is None:
+            return None
+        found, name = self._lookup(key, client)
+        if found:
+            return name
+
+        with self._lock:
+            creating = self._creating.setdefault(key, threading.Lock())
+        # At most one create call per instruction and TTL; the network call holds no global
+        # lock, so lookups of other instructions (and from the event loop) never wait on it
+        with creating:
+            found, name = self._lookup(key, client)
+            if found:
+                return name
+            name, valid_until = self._create(client, model, system_instruction, key[2], time.time())
+            with self._lock:
+                self._handles[key] = (client, name, valid_until)
+                self._creating.pop(key, None)
+            return name
+
+    async def handle_async(self, client, model: str, system_instruction: str) -> Optional[str]:
+        """handle() for the event loop: a live handle is returned inline, a missing one is created in a worker thread."""
+        key = self._key(client, model, system_instruction)
+        if key is None:
+            return None
+        found, name = self._lookup(key, client)
+        if found:
+            return name
+        return await asyncio.to_thread(self.handle, client, model, system_instruction)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "handles": sum(1 for _, name, _ in self._handles.values() if name),
+                "hits": self.hits,
+                "created": self.created,
+                "failures": self.failures,
+                "skipped": self.skipped,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._handles.clear()
+
+    def _key(self, client, model: str, system_instruction: str) -> Optional[Tuple[int, str, str]]:
+        """The handle key, or None when the instruction is sent inline anyway."""
+        if not self.enabled or client is None:
+            return None
+        if estimate_prompt_tokens(system_instruction) < self.min_tokens:
+            with self._lock:
+                self.skipped += 1
+            return None
+        return id(client), model, hashlib.sha256(system_instruction.encode()).hexdigest()
+
+    def _lookup(self, key: Tuple[int, str, str], client) -> Tuple[bool, Optional[str]]:
+        """(found, name): found is False when the handle is missing or due for renewal."""
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is None or entry[0] is not client or time.time() >= entry[2]:
+                return False, None
+            if entry[1]:
+                self.hits += 1
+            return True, entry[1]
+
+    def _create(self, client, model: str, system_instruction: str, digest: str, now: float) -> Tuple[Optional[str], float]:
+        from google.genai import types
+
+        try:
+            cache = client.caches.create(model=model, config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                ttl=f"{int(self.ttl_seconds)}s",
+                display_name=f"expense-auditor-{digest[:12]}"
+            ))
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            logging.warning(f"PROMPT CACHE: Context caching unavailable for {model}, sending prompts inline: {e}")
+            return None, now + self.retry_seconds
+
+        with self._lock:
+            self.created += 1
+        logging.info(f"PROMPT CACHE: Registered system instruction as {cache.name}")
+        return cache.name, now + max(0.0, self.ttl_seconds - CACHE_REFRESH_MARGIN_SECONDS)
+
+
+# The global context cache used by every request builder
+CONTEXT_CACHE = ContextCache(
+    enabled=PROMPT_CACHE_ENABLED,
+    ttl_seconds=PROMPT_CACHE_TTL_SECONDS,
+    min_tokens=PROMPT_CACHE_MIN_TOKENS,
+    retry_seconds=PROMPT_CACHE_RETRY_SECONDS
+)
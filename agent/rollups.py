@@ -0,0 +1,157 @@
+# agent/rollups.py
+"""
+Per-user/category/period spend rollups.
+
+`_log_expense_core` updates the rollups in the same transaction as the Expense insert, so a
+budget check is a single indexed lookup instead of a scan over the user's history.
+init_db backfills them when it adds the table to an existing database; rebuild them (e.g.
+after manual edits to Expense rows) with:
+
+    python -m agent.rollups rebuild [--db sqlite:///poc_main.db]
+"""
+import argparse
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, select
+
+from .budget_cache import BUDGET_CACHE
+from .db import Expense, SpendRollup, get_db_engine, utc_now
+
+ALL_TIME = "all"
+BUDGET_PERIODS = ("all", "month", "quarter")
+
+
+def _build_rollup_upsert():
+    statement = insert(SpendRollup)
+    return statement.on_conflict_do_update(
+        index_elements=["user_id", "category", "period"],
+        set_={
+            "total": SpendRollup.total + statement.excluded.total,
+            "count": SpendRollup.count + statement.excluded.count,
+        }
+    )
+
+
+# Built once so SQLAlchemy compiles it once (a multi-VALUES insert is recompiled per call)
+_ROLLUP_UPSERT = _build_rollup_upsert()
+
+
+def month_key(ts: datetime) -> str:
+    return f"{ts.year:04d}-{ts.month:02d}"
+
+
+def quarter_key(ts: datetime) -> str:
+    return f"{ts.year:04d}-Q{(ts.month - 1) // 3 + 1}"
+
+
+def period_keys(ts: Optional[datetime]) -> List[str]:
+    """Every rollup bucket an expense at `ts` contributes to."""
+    if ts is None:
+        return [ALL_TIME]
+    return [ALL_TIME, month_key(ts), quarter_key(ts)]
+
+
+def current_period_key(budget_period: str, now: Optional[datetime] = None) -> str:
+    """Maps a Budget.period ('all', 'month', 'quarter') to the rollup key for the current window."""
+    now = now or utc_now()
+    if budget_period == "month":
+        return month_key(now)
+    if budget_period == "quarter":
+        return quarter_key(now)
+    return ALL_TIME
+
+
+def apply_to_rollups(session: Session, entries: Iterable[Tuple[str, str, float, Optional[datetime]]]):
+    """
+    Adds (user_id, category, amount, created_at) entries to their rollup rows with one
+    executemany of INSERT ... ON CONFLICT DO UPDATE, inside the caller's transaction.
+    """
+    deltas: Dict[Tuple[str, str, str], List[float]] = defaultdict(lambda: [0.0, 0])
+    for user_id, category, amount, created_at in entries:
+        for period in period_keys(created_at):
+            delta = deltas[(user_id, category, period)]
+            delta[0] += amount
+            delta[1] += 1
+
+    if not deltas:
+        return
+
+    BUDGET_CACHE.mark_written(session, {user_id for user_id, _, _ in deltas})
+    session.exec(_ROLLUP_UPSERT, params=[
+        {"user_id": user_id, "category": category, "period": period, "total": total, "count": count}
+        for (user_id, category, period), (total, count) in deltas.items()
+    ])
+
+
+def get_period_total(session: Session, user_id: str, category: str, period: str) -> float:
+    """O(1) lookup of the spend for one rollup bucket (0.0 if nothing was logged)."""
+    statement = select(SpendRollup.total).where(
+        SpendRollup.user_id == user_id, SpendRollup.category == category, SpendRollup.period == period
+    )
+    total = session.exec(statement).first()
+    return total if total is not None else 0.0
+
+
+def rebuild_rollups(db_engine) -> int:
+    """
+    Recomputes every rollup row from the Expense table in one transaction (backfill for
+    databases created before rollups existed, or repair after manual edits).
+    Returns the number of rollup rows written.
+    """
+    with Session(db_engine) as session:
+        written = recompute_rollups(session)
+        session.commit()
+
+    logging.info(f"ROLLUPS: Rebuilt {written} rollup rows")
+    return written
+
+
+def recompute_rollups(session: Session, user_ids: Optional[List[str]] = None) -> int:
+    """
+    Replaces the rollup rows of `user_ids` (every user if None) with totals recomputed from
+    their Expense rows, inside the caller's transaction. Returns the number of rows written.
+    """
+    month = func.strftime("%Y-%m", Expense.created_at)
+    grouped = (
+        select(Expense.user_id, Expense.category, month, func.sum(Expense.amount), func.count())
+        .group_by(Expense.user_id, Expense.category, month)
+    )
+    stale = delete(SpendRollup)
+    if user_ids is not None:
+        grouped = grouped.where(Expense.user_id.in_(user_ids))
+        stale = stale.where(SpendRollup.user_id.in_(user_ids))
+
+    totals: Dict[Tuple[str, str, str], List[float]] = defaultdict(lambda: [0.0, 0])
+    for user_id, category, month_value, total, count in session.exec(grouped).all():
+        periods = [ALL_TIME]
+        if month_value:
+            year, month_number = (int(part) for part in month_value.split("-"))
+            periods += [month_value, f"{year:04d}-Q{(month_number - 1) // 3 + 1}"]
+        for period in periods:
+            bucket = totals[(user_id, category, period)]
+            bucket[0] += total
+            bucket[1] += count
+
+    session.exec(stale)
+    BUDGET_CACHE.mark_written(session, user_ids)
+    session.add_all([
+        SpendRollup(user_id=user_id, category=category, period=period, total=total, count=count)
+        for (user_id, category, period), (total, count) in totals.items()
+    ])
+    return len(totals)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the spend rollup table.")
+    parser.add_argument("command", choices=["rebuild"], help="'rebuild' recomputes all rollups from Expense rows")
+    parser.add_argument("--db", default=None, help="Database URL (defaults to the main poc_main.db)")
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    rows = rebuild_rollups(get_db_engine(cli_args.db))
+    print(f"Rebuilt {rows} rollup rows.")
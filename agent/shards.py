@@ -0,0 +1,343 @@
+# agent/shards.py
+"""
+Per-tenant sharding of the expense data over several SQLite files.
+
+SQLite allows one writer per file, so with a single database write throughput stays flat
+however many workers run. Every audit touches one user only, so the user-owned tables
+(Expense, Budget, SpendRollup) are spread over DB_SHARDS files by a jump consistent hash of
+user_id. Each shard has its own engine, connection pool and group-commit writer thread.
+Shard 0 is the main database, which also keeps the global tables (plan cache, idempotency
+records, background jobs). Statement imports keep one checkpoint per shard.
+
+The TOOL_REGISTRY core functions, the executor and run_auditor(test_engine=...) find the
+shard with resolve_engine(): None routes through SHARD_ROUTER, a ShardRouter through that
+router, and a plain engine is used as is (a single unsharded database).
+
+Growing from N to N+1 shards only moves the ~1/(N+1) of users whose hash lands on the new
+shard. Move them (and drain removed shards when shrinking) with the rebalance command:
+
+    python -m agent.shards stats
+    python -m agent.shards rebalance --from 1 [--dry-run]      # after raising DB_SHARDS
+    python -m agent.shards report [--by category|user] [--period 2026-10] [--top 20]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, func, insert, union
+from sqlmodel import Session, select
+
+from client_config import DB_SHARDS, DB_SHARD_URL_TEMPLATE
+from .budget_cache import BUDGET_CACHE
+from .db import (
+    Budget, Expense, SpendRollup, get_async_db_engine, get_async_engine, get_db_engine, get_engine, init_db,
+)
+from .rollups import ALL_TIME, recompute_rollups
+from .writer import get_writer
+
+# Users moved per rebalance transaction (their rows are held in memory while copied)
+REBALANCE_BATCH_USERS = 200
+
+_JUMP_MULTIPLIER = 2862933555777941757
+_UINT64_MASK = (1 << 64) - 1
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """
+    Lamping & Veach's jump consistent hash: maps a 64-bit key to [0, buckets). Adding a
+    bucket only moves the keys that land on the new one.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * _JUMP_MULTIPLIER + 1) & _UINT64_MASK
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_index(user_id: str, shards: int) -> int:
+    """The shard that owns `user_id` out of `shards` (stable across processes and restarts)."""
+    digest = hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, "big"), shards)
+
+
+class ShardRouter:
+    """
+    Maps user ids to shard engines. Engines are created on first use with their schema in
+    place; shard 0 is `main_url`, or the application's main engine (get_engine) if unset.
+    """
+
+    def __init__(self, count: int = DB_SHARDS, url_template: str = DB_SHARD_URL_TEMPLATE,
+                 main_url: Optional[str] = None):
+        if count < 1:
+            raise ValueError(f"A shard router needs at least one shard, got {count}")
+        self.count = count
+        self.url_template = url_template
+        self.main_url = main_url
+        self._engines: Dict[int, Any] = {}
+        self._async_engines: Dict[int, Any] = {}
+        self._lock = threading.Lock()
+
+    def shard_for(self, user_id: str) -> int:
+        return shard_index(user_id, self.count) if self.count > 1 else 0
+
+    def url(self, index: int) -> Optional[str]:
+        if index == 0:
+            return self.main_url
+        return self.url_template.format(index=index)
+
+    def engine(self, index: int):
+        """The sync engine of shard `index` (also past `count`, for draining removed shards)."""
+        if index == 0 and self.main_url is None:
+            return get_engine()
+        with self._lock:
+            if index not in self._engines:
+                self._engines[index] = get_db_engine(self.url(index))
+            return self._engines[index]
+
+    def async_engine(self, index: int):
+        """The aiosqlite engine for the same file as engine(index)."""
+        if index == 0 and self.main_url is None:
+            return get_async_engine()
+        sync_engine = self.engine(index)  # Creates the schema, which init_async_db would have to await
+        with self._lock:
+            if index not in self._async_engines:
+                self._async_engines[index] = get_async_db_engine(
+                    str(sync_engine.url.set(drivername="sqlite+aiosqlite"))
+                )
+            return self._async_engines[index]
+
+    def engine_for(self, user_id: str):
+        return self.engine(self.shard_for(user_id))
+
+    def async_engine_for(self, user_id: str):
+        return self.async_engine(self.shard_for(user_id))
+
+    def engines(self) -> List[Any]:
+        return [self.engine(index) for index in range(self.count)]
+
+    def init(self) -> "ShardRouter":
+        """Startup hook: brings every shard's schema up to date (see agent.db.init_db)."""
+        for engine in self.engines():
+            init_db(engine)
+        return self
+
+
+# The application's router (DB_SHARDS=1 routes everything to the main database)
+SHARD_ROUTER = ShardRouter()
+
+
+def resolve_engine(db_engine: Optional[Any], user_id: str):
+    """The sync engine holding `user_id`'s rows: db_engine may be None, a ShardRouter or an engine."""
+    if db_engine is None:
+        return SHARD_ROUTER.engine_for(user_id)
+    if isinstance(db_engine, ShardRouter):
+        return db_engine.engine_for(user_id)
+    return db_engine
+
+
+def resolve_async_engine(db_engine: Optional[Any], user_id: str):
+    """Async counterpart of resolve_engine (a plain db_engine must be an aiosqlite engine)."""
+    if db_engine is None:
+        return SHARD_ROUTER.async_engine_for(user_id)
+    if isinstance(db_engine, ShardRouter):
+        return db_engine.async_engine_for(user_id)
+    return db_engine
+
+
+def shard_engines(db_engine: Optional[Any] = None, user_id: Optional[str] = None) -> List[Any]:
+    """
+    The engines a maintenance job has to visit: the user's shard if `user_id` is given,
+    otherwise every shard of the router (a plain engine is the only one).
+    """
+    if db_engine is not None and not isinstance(db_engine, ShardRouter):
+        return [db_engine]
+    router = db_engine or SHARD_ROUTER
+    return [router.engine_for(user_id)] if user_id else router.engines()
+
+
+# --- Cross-shard queries ---
+
+def map_shards(fn: Callable[[Session], Any], router: Optional[ShardRouter] = None) -> List[Any]:
+    """Runs fn(session) on every shard in parallel and returns the results in shard order."""
+    router = router or SHARD_ROUTER
+
+    def run(engine):
+        with Session(engine) as session:
+            return fn(session)
+
+    engines = router.engines()
+    with ThreadPoolExecutor(max_workers=len(engines), thread_name_prefix="shard-query") as pool:
+        return list(pool.map(run, engines))
+
+
+def spend_report(router: Optional[ShardRouter] = None, by: str = "category", period: str = ALL_TIME,
+                 top: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Total spend and expense count per category (or per user) in a rollup period ('all', a
+    month like '2026-10' or a quarter like '2026-Q4'), merged over every shard, largest first.
+    """
+    if by not in ("category", "user"):
+        raise ValueError(f"Unknown report grouping '{by}'. Expected 'category' or 'user'.")
+    column = SpendRollup.category if by == "category" else SpendRollup.user_id
+    grouped = (
+        select(column, func.sum(SpendRollup.total), func.sum(SpendRollup.count))
+        .where(SpendRollup.period == period)
+        .group_by(column)
+    )
+
+    merged: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+    for rows in map_shards(lambda session: session.exec(grouped).all(), router):
+        for key, total, count in rows:
+            merged[key][0] += total
+            merged[key][1] += count
+
+    report = [{by: key, "total": round(total, 2), "count": count} for key, (total, count) in merged.items()]
+    report.sort(key=lambda row: row["total"], reverse=True)
+    return report[:top] if top else report
+
+
+def shard_stats(router: Optional[ShardRouter] = None) -> List[Dict[str, Any]]:
+    """Users, expenses and logged spend per shard, to check the hash spreads load evenly."""
+    router = router or SHARD_ROUTER
+
+    def count(session):
+        users, expenses, total = session.exec(
+            select(func.count(func.distinct(Expense.user_id)), func.count(), func.coalesce(func.sum(Expense.amount), 0.0))
+        ).one()
+        return {"users": users, "expenses": expenses, "total": round(total, 2)}
+
+    return [
+        {"shard": index, "url": str(engine.url), **counts}
+        for index, (engine, counts) in enumerate(zip(router.engines(), map_shards(count, router)))
+    ]
+
+
+# --- Rebalancing ---
+
+def rebalance(router: Optional[ShardRouter] = None, from_count: Optional[int] = None,
+              batch_users: int = REBALANCE_BATCH_USERS, dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Moves every user whose rows sit on a shard other than the one `router` assigns them to.
+    Visits shards 0..max(router.count, from_count)-1, so shrinking drains the removed shards.
+
+    Each batch is copied to its new shard in one transaction, then deleted from the old one.
+    The copy skips rows the target already holds and recomputes the users' rollups there,
+    so re-running after a crash between the two commits neither duplicates nor loses rows.
+    """
+    router = router or SHARD_ROUTER
+    report = {"shards": router.count, "users_moved": 0, "expenses_moved": 0, "moves": {}, "dry_run": dry_run}
+
+    for source in range(max(router.count, from_count or router.count)):
+        source_engine = router.engine(source)
+        misplaced: Dict[int, List[str]] = defaultdict(list)
+        for user_id in _shard_users(source_engine):
+            target = router.shard_for(user_id)
+            if target != source:
+                misplaced[target].append(user_id)
+
+        for target, users in sorted(misplaced.items()):
+            report["moves"][f"{source}->{target}"] = len(users)
+            report["users_moved"] += len(users)
+            if dry_run:
+                continue
+            for start in range(0, len(users), batch_users):
+                report["expenses_moved"] += _move_users(source_engine, router.engine(target),
+                                                        users[start:start + batch_users])
+        if misplaced:
+            logging.info(f"SHARDS: Shard {source} moves {sum(map(len, misplaced.values()))} users "
+                         f"to shards {sorted(misplaced)}")
+
+    return report
+
+
+def _shard_users(db_engine) -> List[str]:
+    owners = union(select(Expense.user_id), select(Budget.user_id), select(SpendRollup.user_id))
+    with Session(db_engine) as session:
+        return [user_id for (user_id,) in session.exec(owners)]
+
+
+def _move_users(source_engine, target_engine, users: List[str]) -> int:
+    with Session(source_engine) as session:
+        expenses = [
+            {"user_id": row.user_id, "vendor": row.vendor, "amount": row.amount, "category": row.category,
+             "is_flagged": row.is_flagged, "created_at": row.created_at}
+            for row in session.exec(select(Expense).where(Expense.user_id.in_(users)).order_by(Expense.id))
+        ]
+        budgets = [
+            {"user_id": row.user_id, "limit": row.limit, "category": row.category, "period": row.period}
+            for row in session.exec(select(Budget).where(Budget.user_id.in_(users)))
+        ]
+
+    copied = get_writer(target_engine).run(lambda session: _copy_users(session, users, expenses, budgets))
+    get_writer(source_engine).run(lambda session: _delete_users(session, users))
+    return copied
+
+
+def _expense_key(row: Dict[str, Any]):
+    return row["user_id"], row["vendor"], row["amount"], row["category"], row["created_at"]
+
+
+def _copy_users(session: Session, users: List[str], expenses: List[Dict[str, Any]],
+                budgets: List[Dict[str, Any]]) -> int:
+    # Rows an interrupted earlier run already copied are matched by content and skipped
+    present = Counter(
+        _expense_key(row._mapping) for row in session.exec(
+            select(Expense.user_id, Expense.vendor, Expense.amount, Expense.category, Expense.created_at)
+            .where(Expense.user_id.in_(users))
+        )
+    )
+    missing = []
+    for row in expenses:
+        key = _expense_key(row)
+        if present[key]:
+            present[key] -= 1
+        else:
+            missing.append(row)
+    if missing:
+        session.exec(insert(Expense), params=missing)
+
+    # A budget set since the switch (already on the new shard) is newer than the moved one
+    has_budget = set(session.exec(select(Budget.user_id).where(Budget.user_id.in_(users))))
+    session.add_all([Budget(**row) for row in budgets if row["user_id"] not in has_budget])
+
+    recompute_rollups(session, users)
+    return len(missing)
+
+
+def _delete_users(session: Session, users: List[str]):
+    for table in (Expense, Budget, SpendRollup):
+        session.exec(delete(table).where(table.user_id.in_(users)))
+    BUDGET_CACHE.mark_written(session, users)
+
+
+def _print_rows(rows: Iterable[Dict[str, Any]]):
+    for row in rows:
+        print(json.dumps(row, default=str))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect, rebalance and query the SQLite shards.")
+    parser.add_argument("command", choices=["stats", "rebalance", "report"])
+    parser.add_argument("--shards", type=int, default=DB_SHARDS, help="Shard count to route with (default DB_SHARDS)")
+    parser.add_argument("--from", dest="from_count", type=int, default=None,
+                        help="rebalance: the previous shard count, so removed shards are drained too")
+    parser.add_argument("--dry-run", action="store_true", help="rebalance: only report which users would move")
+    parser.add_argument("--by", choices=["category", "user"], default="category", help="report: grouping")
+    parser.add_argument("--period", default=ALL_TIME, help="report: 'all', a month (2026-10) or a quarter (2026-Q4)")
+    parser.add_argument("--top", type=int, default=None, help="report: only the largest N rows")
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    cli_router = ShardRouter(cli_args.shards).init()
+    if cli_args.command == "stats":
+        _print_rows(shard_stats(cli_router))
+    elif cli_args.command == "rebalance":
+        print(json.dumps(rebalance(cli_router, cli_args.from_count, dry_run=cli_args.dry_run), indent=2))
+    else:
+        _print_rows(spend_report(cli_router, by=cli_args.by, period=cli_args.period, top=cli_args.top))
@@ -0,0 +1,486 @@
+# agent/statement_import.py
+"""
+Bulk import of card statements (CSV or JSONL) into the Expense table.
+
+The input is streamed, so memory stays constant however many rows the statement has:
+
+* rows with an amount, a vendor and a category (given in the row, or inferred locally from
+  the vendor's history in a VendorIndex or from vendor/description keywords) are inserted
+  IMPORT_CHUNK_SIZE at a time;
+* only rows whose category cannot be resolved go to Gemini, IMPORT_LLM_BATCH_SIZE rows per
+  call, in the scheduler's 'backfill' lane so interactive audits keep priority;
+* every chunk is committed together with its ImportCheckpoint, so re-running an interrupted
+  import with the same import id resumes after the last committed chunk. With several shards
+  (agent.shards) each shard commits its rows with its own checkpoint, in parallel, and a
+  resumed import skips the rows each shard already holds;
+* budgets are checked once per affected (user_id, category) when the import completes.
+
+    python -m agent.statement_import statement.csv --user U1 [--import-id 2026-10] [--db sqlite:///poc_main.db]
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sys
+from dataclasses import asdict, dataclass, field, replace
+from functools import partial
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Any, Callable, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import func, insert
+from sqlmodel import Session, select
+
+from client_config import (
+    IMPORT_CHUNK_SIZE, IMPORT_LLM_BATCH_SIZE, PRIMARY_MODEL, VENDOR_INDEX_MIN_CONFIDENCE, get_client,
+)
+from schemas.plan_schema import CATEGORY_BATCH_SCHEMA
+from .db import Expense, ImportCheckpoint, get_db_engine, utc_now
+from .llm_scheduler import get_scheduled_client, llm_lane
+from .planner import CATEGORY_KEYWORDS, infer_category, _json_config
+from .rollups import apply_to_rollups
+from .shards import SHARD_ROUTER, ShardRouter
+from .tools import _check_budget_in_session
+from .vendor_index import VENDOR_INDEX
+from .writer import get_writer
+from . import metrics
+
+FORMATS = ("csv", "jsonl")
+
+# Accepted column names, first match wins (headers are compared case-insensitively)
+USER_FIELDS = ("user_id", "user", "cardholder")
+VENDOR_FIELDS = ("vendor", "merchant", "payee", "description")
+AMOUNT_FIELDS = ("amount", "debit")
+CATEGORY_FIELDS = ("category",)
+DATE_FIELDS = ("date", "transaction_date", "posted_date", "created_at")
+# Free text searched for category keywords besides the vendor
+DESCRIPTION_FIELDS = ("description", "memo", "details")
+
+# Used when Gemini returns no category for a row
+FALLBACK_CATEGORY = "Uncategorized"
+
+CATEGORIZER_PROMPT = f"""
+CATEGORIZER: You assign spending categories to card statement rows for a Financial Auditor.
+
+Known categories: {", ".join(CATEGORY_KEYWORDS)}.
+Prefer a known category. Only if none fits, use a short Title Case category name (1-2 words).
+
+You will receive numbered rows with the vendor, amount and any description. Return exactly
+one entry per row in 'categories', with 'row' set to the row's number.
+"""
+
+
+@dataclass
+class ImportProgress:
+    """Counters reported after every committed chunk (and returned in the final report)."""
+    import_id: str
+    rows_done: int = 0
+    rows_imported: int = 0
+    rows_skipped: int = 0
+    llm_resolved: int = 0
+    llm_calls: int = 0
+    resumed_from: int = 0
+    affected: List[Tuple[str, str]] = field(default_factory=list)
+
+
+def import_statement(stream: IO[str], fmt: str = "csv", user_id: Optional[str] = None, import_id: Optional[str] = None,
+                     db_engine: Optional[Any] = None, client: Optional[Any] = None,
+                     chunk_size: int = IMPORT_CHUNK_SIZE, llm_batch_size: int = IMPORT_LLM_BATCH_SIZE,
+                     on_progress: Optional[Callable[[ImportProgress], None]] = None, restart: bool = False,
+                     vendor_index: Optional[Any] = None) -> Dict[str, Any]:
+    """
+    Streams a statement into Expense. `user_id` is used for rows without a user column, and
+    a vendor_index (agent.vendor_index.VendorIndex) resolves categories from vendor history.
+    Re-running with the same `import_id` skips the rows an earlier run already committed
+    (restart=True starts over). A failed Gemini call aborts the import with the checkpoint
+    intact; the report then has status 'aborted' and an 'error'. db_engine is an engine, a
+    ShardRouter or None (the application's shards).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown statement format '{fmt}'. Expected one of {FORMATS}.")
+
+    router = SHARD_ROUTER if db_engine is None else db_engine if isinstance(db_engine, ShardRouter) else None
+    engines = router.engines() if router else [db_engine]
+    shard_of = router.shard_for if router else (lambda row_user_id: 0)
+    import_id = import_id or f"import-{utc_now():%Y%m%dT%H%M%S}"
+
+    # Shards commit independently, so an interrupted run may have left them at different rows:
+    # resume from the least advanced one and skip rows a shard already committed
+    checkpoints = [_load_checkpoint(engine, import_id, restart) for engine in engines]
+    shard_done = [shard_checkpoint.rows_done for shard_checkpoint in checkpoints]
+    checkpoint = min(checkpoints, key=lambda shard_checkpoint: shard_checkpoint.rows_done)
+    progress = ImportProgress(
+        import_id=import_id,
+        rows_done=checkpoint.rows_done,
+        rows_imported=checkpoint.rows_imported,
+        rows_skipped=checkpoint.rows_skipped,
+        llm_resolved=checkpoint.llm_resolved,
+        resumed_from=checkpoint.rows_done,
+        # Pairs touched by rows that only the more advanced shards committed are in their checkpoints
+        affected=list(dict.fromkeys(tuple(pair) for shard_checkpoint in checkpoints
+                                    for pair in json.loads(shard_checkpoint.affected_json))),
+    )
+
+    if all(shard_checkpoint.completed for shard_checkpoint in checkpoints):
+        logging.info(f"IMPORT {import_id}: Already completed ({checkpoint.rows_done} rows), nothing to do")
+        return _import_report(progress, "completed", budgets=[])
+
+    if progress.resumed_from:
+        logging.info(f"IMPORT {import_id}: Resuming after row {progress.resumed_from}")
+
+    rows = islice(iter_statement_rows(stream, fmt), progress.resumed_from, None)
+    affected = dict.fromkeys(progress.affected)
+
+    with metrics.phase("import"):
+        for chunk in _chunks(rows, chunk_size):
+            expenses, skipped = [], 0
+            shard_rows: List[List[Dict[str, Any]]] = [[] for _ in engines]
+            written, unresolved = [], []  # Rows this run commits (in statement order), those needing the LLM
+            for offset, raw_row in enumerate(chunk, start=progress.rows_done + 1):
+                row, problem = parse_row(raw_row, user_id, vendor_index)
+                if problem:
+                    skipped += 1
+                    logging.warning(f"IMPORT {import_id}: Skipping row {offset}: {problem}")
+                    continue
+                expenses.append(row)
+                shard = shard_of(row["user_id"])
+                if offset <= shard_done[shard]:
+                    continue  # Committed (and categorized) by an interrupted earlier run
+                shard_rows[shard].append(row)
+                written.append(row)
+                if row["category"] is None:
+                    unresolved.append(row)
+
+            llm_calls = 0
+            if unresolved:
+                try:
+                    llm_calls = _categorize_with_llm(client, unresolved, llm_batch_size)
+                except Exception as e:
+                    return _import_failure(progress, "categorization", e)
+
+            affected.update(((row["user_id"], row["category"]), None) for row in written)
+            committed = replace(
+                progress,
+                rows_done=progress.rows_done + len(chunk),
+                rows_imported=progress.rows_imported + len(expenses),
+                rows_skipped=progress.rows_skipped + skipped,
+                llm_resolved=progress.llm_resolved + len(unresolved),
+                llm_calls=progress.llm_calls + llm_calls,
+                affected=list(affected),
+            )
+            try:
+                _run_on_shards(engines, [partial(_insert_chunk, expenses=rows, progress=committed)
+                                         for rows in shard_rows])
+            except Exception as e:
+                return _import_failure(progress, "the chunk commit", e)
+            progress = committed
+
+            logging.info(f"IMPORT {import_id}: {progress.rows_done} rows done, {progress.rows_imported} imported, "
+                         f"{progress.rows_skipped} skipped, {progress.llm_resolved} categorized by the LLM")
+            if on_progress:
+                on_progress(progress)
+
+        # One budget check per affected (user_id, category) on its shard, then mark the import done
+        shard_pairs: List[List[Tuple[str, str]]] = [[] for _ in engines]
+        for pair in progress.affected:
+            shard_pairs[shard_of(pair[0])].append(pair)
+        try:
+            results = _run_on_shards(engines, [partial(_finish_import, progress=progress, pairs=pairs)
+                                               for pairs in shard_pairs])
+        except Exception as e:
+            return _import_failure(progress, "the final budget check", e)
+        order = {pair: position for position, pair in enumerate(progress.affected)}
+        budgets = sorted((budget for shard_budgets in results for budget in shard_budgets),
+                         key=lambda budget: order[(budget["user_id"], budget["category"])])
+
+    return _import_report(progress, "completed", budgets)
+
+
+def iter_statement_rows(stream: IO[str], fmt: str) -> Iterator[Dict[str, Any]]:
+    """Yields one dict per statement row with lower-cased keys, reading the stream lazily."""
+    if fmt == "csv":
+        for record in csv.DictReader(stream):
+            yield {(key or "").strip().lower(): value for key, value in record.items()}
+        return
+
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield {"__error__": f"invalid JSON ({e.msg})"}
+            continue
+        if not isinstance(record, dict):
+            yield {"__error__": "JSON line is not an object"}
+            continue
+        yield {str(key).strip().lower(): value for key, value in record.items()}
+
+
+def parse_row(raw_row: Dict[str, Any], default_user_id: Optional[str] = None,
+              vendor_index: Optional[Any] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Extracts (row, None) with user_id, vendor, amount, category (None when it has to be
+    resolved by the LLM), created_at and description, or (None, problem) for unusable rows.
+    """
+    if "__error__" in raw_row:
+        return None, raw_row["__error__"]
+
+    user_id = _first_text(raw_row, USER_FIELDS) or default_user_id
+    if not user_id:
+        return None, "no user_id column and no default user"
+
+    vendor = _first_text(raw_row, VENDOR_FIELDS)
+    if not vendor:
+        return None, "missing vendor"
+
+    amount = _parse_amount(_first_value(raw_row, AMOUNT_FIELDS))
+    if amount is None:
+        return None, "missing or non-numeric amount"
+
+    created_at = utc_now()
+    raw_date = _first_text(raw_row, DATE_FIELDS)
+    if raw_date:
+        created_at = _parse_date(raw_date)
+        if created_at is None:
+            return None, f"unparseable date {raw_date!r}"
+
+    description = " ".join(filter(None, (_first_text(raw_row, (name,)) for name in DESCRIPTION_FIELDS)))
+    row = {
+        "user_id": user_id,
+        "vendor": vendor,
+        "amount": amount,
+        "category": None,
+        "created_at": created_at,
+        "description": description,
+    }
+    row["category"] = resolve_category(_first_text(raw_row, CATEGORY_FIELDS), vendor, description, user_id, vendor_index)
+    return row, None
+
+
+def resolve_category(category: Optional[str], vendor: str, description: str = "", user_id: Optional[str] = None,
+                     vendor_index: Optional[Any] = None) -> Optional[str]:
+    """
+    The row's own category (matched to a known one ignoring case), else a confident match in
+    the vendor's history, else keyword hints, else None.
+    """
+    if category:
+        known = {name.lower(): name for name in CATEGORY_KEYWORDS}
+        return known.get(category.lower(), category)
+    if vendor_index is not None:
+        match = vendor_index.lookup(vendor, user_id)
+        if match and match.confidence >= VENDOR_INDEX_MIN_CONFIDENCE:
+            return match.category
+    return infer_category(f"{vendor} {description}")[0]
+
+
+def _first_value(raw_row: Dict[str, Any], names: Iterable[str]) -> Any:
+    for name in names:
+        value = raw_row.get(name)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def _first_text(raw_row: Dict[str, Any], names: Iterable[str]) -> Optional[str]:
+    value = _first_value(raw_row, names)
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+
+def _parse_amount(value: Any) -> Optional[float]:
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace("$", "").replace(",", "")
+    negative = text.startswith("(") and text.endswith(")")  # Accounting notation for credits
+    try:
+        amount = float(text.strip("()"))
+    except ValueError:
+        return None
+    return -amount if negative else amount
+
+
+def _parse_date(value: str) -> Optional[datetime]:
+    for parse in (datetime.fromisoformat, lambda v: datetime.strptime(v, "%m/%d/%Y")):
+        try:
+            parsed = parse(value)
+        except ValueError:
+            continue
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+
+def _chunks(rows: Iterator[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# --- LLM fallback for unresolved categories ---
+
+def _categorize_with_llm(client, rows: List[Dict[str, Any]], batch_size: int) -> int:
+    """Fills in row['category'] in place, batch_size rows per Gemini call. Returns the call count."""
+    client = get_scheduled_client(client or get_client())
+    if not client:
+        raise RuntimeError("Gemini client not available to categorize unresolved rows.")
+
+    calls = 0
+    with llm_lane("backfill"):
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            with metrics.phase("categorize"):
+                response = client.models.generate_content(**_categorizer_request(batch, client))
+                metrics.record_usage("categorize", response)
+                entries = json.loads(response.text).get("categories", [])
+            calls += 1
+
+            answers = {}
+            for entry in entries:
+                if isinstance(entry, dict) and isinstance(entry.get("category"), str) and entry["category"].strip():
+                    answers[entry.get("row")] = entry["category"].strip()
+            for number, row in enumerate(batch, start=1):
+                row["category"] = resolve_category(answers.get(number), row["vendor"]) or FALLBACK_CATEGORY
+    logging.info(f"IMPORT: Categorized {len(rows)} rows with {calls} LLM calls")
+    return calls
+
+
+def _categorizer_request(rows: List[Dict[str, Any]], client=None) -> Dict[str, Any]:
+    lines = []
+    for number, row in enumerate(rows, start=1):
+        line = f"{number}. Vendor: {row['vendor']} | Amount: {row['amount']}"
+        if row["description"]:
+            line += f" | Description: {row['description']}"
+        lines.append(line)
+    return {
+        "model": PRIMARY_MODEL,
+        "contents": "Statement rows:\n" + "\n".join(lines),
+        "config": _json_config(CATEGORIZER_PROMPT, CATEGORY_BATCH_SCHEMA, client, PRIMARY_MODEL, "categorize")
+    }
+
+
+# --- DB jobs (run on the group-commit writer, which owns the commit) ---
+
+def _run_on_shards(engines: List[Any], jobs: List[Callable]) -> List[Any]:
+    """Runs one job per shard on that shard's writer, all at once. Raises the first failure."""
+    futures = [get_writer(engine).submit(job) for engine, job in zip(engines, jobs)]
+    results, error = [], None
+    for future in futures:  # Every future is awaited, so no job is still in flight on return
+        try:
+            results.append(future.result())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+    return results
+
+
+def _load_checkpoint(db_engine, import_id: str, restart: bool) -> ImportCheckpoint:
+    with Session(db_engine) as session:
+        checkpoint = session.get(ImportCheckpoint, import_id)
+        if checkpoint is None or restart:
+            return ImportCheckpoint(import_id=import_id)
+        session.expunge(checkpoint)
+        return checkpoint
+
+
+def _insert_chunk(session: Session, expenses: List[Dict[str, Any]], progress: ImportProgress):
+    if expenses:
+        # Core executemany: no ORM objects or per-row primary key round-trips
+        session.exec(insert(Expense), params=[
+            {"user_id": row["user_id"], "vendor": row["vendor"], "amount": row["amount"],
+             "category": row["category"], "is_flagged": False, "created_at": row["created_at"]}
+            for row in expenses
+        ])
+        apply_to_rollups(session, [
+            (row["user_id"], row["category"], row["amount"], row["created_at"]) for row in expenses
+        ])
+        # Teach the vendor index, counted once per (user, vendor, category) in the chunk
+        last_id = session.exec(select(func.max(Expense.id))).one()
+        learned: Dict[Tuple[str, str, str], int] = {}
+        for row in expenses:
+            key = (row["user_id"], row["vendor"], row["category"])
+            learned[key] = learned.get(key, 0) + 1
+        for (user_id, vendor, category), count in learned.items():
+            VENDOR_INDEX.record_on_commit(session, user_id, vendor, category, count, expense_id=last_id)
+    _save_checkpoint(session, progress, completed=False)
+
+
+def _finish_import(session: Session, progress: ImportProgress, pairs: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+    budgets = [
+        {"user_id": user_id, **_check_budget_in_session(session, user_id, category)}
+        for user_id, category in pairs
+    ]
+    _save_checkpoint(session, progress, completed=True)
+    return budgets
+
+
+def _save_checkpoint(session: Session, progress: ImportProgress, completed: bool):
+    session.merge(ImportCheckpoint(
+        import_id=progress.import_id,
+        rows_done=progress.rows_done,
+        rows_imported=progress.rows_imported,
+        rows_skipped=progress.rows_skipped,
+        llm_resolved=progress.llm_resolved,
+        affected_json=json.dumps(progress.affected),
+        completed=completed,
+        updated_at=utc_now(),
+    ))
+
+
+# --- Reports ---
+
+def _import_report(progress: ImportProgress, status: str, budgets: List[Dict[str, Any]]) -> Dict[str, Any]:
+    report = {**asdict(progress), "status": status, "budgets": budgets}
+    report["affected"] = [list(pair) for pair in progress.affected]
+    report["over_budget"] = [b for b in budgets if b["status"] == "OVER BUDGET"]
+    return report
+
+
+def _import_failure(progress: ImportProgress, stage: str, e: Exception) -> Dict[str, Any]:
+    # Re-running with the same import id resumes here (skipping rows a shard already committed)
+    error_msg = f"Import aborted after row {progress.rows_done}: {stage} failed due to system error: {e}"
+    logging.error(error_msg)
+    return {**_import_report(progress, "aborted", budgets=[]), "error": error_msg}
+
+
+def _print_progress(progress: ImportProgress):
+    print(f"\r{progress.rows_done} rows: {progress.rows_imported} imported, {progress.rows_skipped} skipped, "
+          f"{progress.llm_resolved} categorized by Gemini ({progress.llm_calls} calls)", end="", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a card statement (CSV or JSONL) into the Expense table.")
+    parser.add_argument("path", help="Statement file; '-' reads stdin")
+    parser.add_argument("--format", choices=FORMATS, default=None, help="Defaults to the file extension (csv otherwise)")
+    parser.add_argument("--user", default=None, help="user_id for rows without a user column")
+    parser.add_argument("--import-id", default=None, help="Checkpoint key; defaults to the file name and size")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint and import from the first row")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    parser.add_argument("--db", default=None, help="Database URL (defaults to every DB_SHARDS shard)")
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+    fmt = cli_args.format or ("jsonl" if cli_args.path.endswith((".jsonl", ".ndjson")) else "csv")
+    import_id = cli_args.import_id
+    if import_id is None and cli_args.path != "-":
+        # Name and size, so next month's 'statement.csv' does not resume this one's checkpoint
+        import_id = f"{os.path.basename(cli_args.path)}:{os.path.getsize(cli_args.path)}"
+    source = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig") if cli_args.path == "-" else \
+        open(cli_args.path, newline="", encoding="utf-8-sig")
+
+    with source:
+        result = import_statement(source, fmt, user_id=cli_args.user, import_id=import_id,
+                                  db_engine=get_db_engine(cli_args.db) if cli_args.db else SHARD_ROUTER.init(),
+                                  chunk_size=cli_args.chunk_size,
+                                  on_progress=_print_progress, restart=cli_args.restart,
+                                  vendor_index=VENDOR_INDEX)
+    print(file=sys.stderr)
+    print(json.dumps(result, indent=2, default=str))
+    sys.exit(0 if result["status"] == "completed" else 1)
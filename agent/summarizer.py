@@ -0,0 +1,199 @@
+# agent/summarizer.py
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List
+
+from client_config import SUMMARY_MODEL, SUMMARY_MODE
+from . import metrics, prompts
+
+SUMMARY_MODES = ("template", "llm", "hybrid")
+
+KNOWN_TOOLS = ("log_expense_tool", "check_budget_tool")
+BUDGET_FIELDS = ("category", "total_spent", "limit", "status")
+
+# Static, so it can be registered once with context caching; only the history varies per call
+SUMMARY_PROMPT = (
+    "Based on the execution history you are given, generate a final, concise, and "
+    "professional report for the user. Explicitly state the final budget status "
+    "(e.g., 'Status: Under Budget' or 'Warning: OVER BUDGET')."
+)
+
+
+def summarize(client, execution_history: List[Any], mode: str = SUMMARY_MODE) -> str:
+    """Phase 4: turns the execution history into the final report using the configured backend."""
+    if _use_template(execution_history, mode):
+        logging.info(f"PHASE 4: SUMMARIZATION ({mode} mode, rendered locally)")
+        with metrics.phase("summary"):
+            return render_template_summary(execution_history)
+
+    logging.info(f"PHASE 4: SUMMARIZATION ({mode} mode, generating report with {SUMMARY_MODEL})")
+    try:
+        # Using flash-lite for summarization to save quota, or flash for speed
+        with metrics.phase("summary"):
+            summary_response = client.models.generate_content(
+                model=SUMMARY_MODEL,
+                contents=build_summary_prompt(execution_history),
+                config=prompts.text_config(client, SUMMARY_MODEL, SUMMARY_PROMPT, "summary")
+            )
+        metrics.record_usage("summary", summary_response)
+        return summary_response.text
+    except Exception as e:
+        return _llm_failure(execution_history, mode, e)
+
+
+async def summarize_async(client, execution_history: List[Any], mode: str = SUMMARY_MODE) -> str:
+    """Async counterpart of summarize (uses `client.aio` when the LLM is needed)."""
+    if _use_template(execution_history, mode):
+        logging.info(f"PHASE 4: SUMMARIZATION ({mode} mode, rendered locally)")
+        with metrics.phase("summary"):
+            return render_template_summary(execution_history)
+
+    logging.info(f"PHASE 4: SUMMARIZATION ({mode} mode, generating report with {SUMMARY_MODEL})")
+    try:
+        with metrics.phase("summary"):
+            await prompts.prepare_async(client, SUMMARY_MODEL, SUMMARY_PROMPT)
+            summary_response = await client.aio.models.generate_content(
+                model=SUMMARY_MODEL,
+                contents=build_summary_prompt(execution_history),
+                config=prompts.text_config(client, SUMMARY_MODEL, SUMMARY_PROMPT, "summary")
+            )
+        metrics.record_usage("summary", summary_response)
+        return summary_response.text
+    except Exception as e:
+        return _llm_failure(execution_history, mode, e)
+
+
+async def stream_summary_async(client, execution_history: List[Any], mode: str = SUMMARY_MODE) -> AsyncIterator[str]:
+    """
+    Yields the final report in chunks: the whole template at once, or the LLM's tokens as
+    they arrive via generate_content_stream.
+    """
+    if _use_template(execution_history, mode):
+        logging.info(f"PHASE 4: SUMMARIZATION ({mode} mode, rendered locally)")
+        with metrics.phase("summary"):
+            report = render_template_summary(execution_history)
+        yield report
+        return
+
+    logging.info(f"PHASE 4: SUMMARIZATION ({mode} mode, streaming report from {SUMMARY_MODEL})")
+    streamed_any, last_chunk = False, None
+    with metrics.phase("summary"):
+        try:
+            await prompts.prepare_async(client, SUMMARY_MODEL, SUMMARY_PROMPT)
+            stream = await client.aio.models.generate_content_stream(
+                model=SUMMARY_MODEL,
+                contents=build_summary_prompt(execution_history),
+                config=prompts.text_config(client, SUMMARY_MODEL, SUMMARY_PROMPT, "summary")
+            )
+            async for chunk in stream:
+                last_chunk = chunk
+                if chunk.text:
+                    streamed_any = True
+                    yield chunk.text
+        except Exception as e:
+            metrics.record_error("summary")
+            # After partial output a fallback would duplicate the report; just report the error
+            yield _llm_failure(execution_history, mode if not streamed_any else "llm", e)
+    if last_chunk is not None:
+        metrics.record_usage("summary", last_chunk)  # The final chunk carries the totals
+
+
+def render_template_summary(execution_history: List[Any]) -> str:
+    """
+    Builds the audit report straight from the structured tool results. Every budget line
+    carries 'Status: Under Budget' or 'Status: OVER BUDGET', the phrases downstream parsers
+    rely on.
+    """
+    logged, budgets, failures = [], [], []
+    for number, entry in enumerate(execution_history, start=1):
+        if not isinstance(entry, dict):
+            failures.append(f"Step {number}: unexpected result {entry!r}")
+            continue
+        if entry.get('status') != "SUCCESS":
+            failures.append(f"Step {number} ({entry.get('tool_name', 'UNKNOWN')}) FAILED: {entry.get('result')}")
+        elif _is_budget_result(entry):
+            budgets.append(entry['result'])
+        else:
+            logged.append(str(entry.get('result', '')))
+
+    lines = ["Expense Audit Report", ""]
+    if logged:
+        lines.append("Expenses recorded:")
+        lines += [f"- {message}" for message in logged]
+        lines.append("")
+
+    over_budget = [b for b in budgets if b['status'] == "OVER BUDGET"]
+    if budgets:
+        lines.append("Budget status:")
+        for budget in budgets:
+            window = budget.get('period', 'all')
+            window_label = "all-time" if window == "all" else window
+            lines.append(
+                f"- {budget['category']}: ${budget['total_spent']:.2f} spent of ${budget['limit']:.2f} limit "
+                f"({window_label}). Status: {budget['status']}"
+            )
+        lines.append("")
+
+    if failures:
+        lines.append("Problems:")
+        lines += [f"- {failure}" for failure in failures]
+        lines.append("")
+
+    if over_budget:
+        categories = ", ".join(b['category'] for b in over_budget)
+        lines.append(f"Warning: OVER BUDGET in {categories}. Please review before further spending.")
+    elif budgets:
+        lines.append("Status: Under Budget")
+    else:
+        lines.append("Budget status could not be determined.")
+
+    return "\n".join(lines)
+
+
+def needs_llm_summary(execution_history: List[Any]) -> bool:
+    """Hybrid mode escalates failed steps, unknown tools and histories without a budget check."""
+    if not execution_history:
+        return True
+    for entry in execution_history:
+        if not isinstance(entry, dict) or entry.get('status') != "SUCCESS":
+            return True
+        if entry.get('tool_name') not in KNOWN_TOOLS:
+            return True
+        if entry['tool_name'] == "check_budget_tool" and not _is_budget_result(entry):
+            return True
+    return not any(entry['tool_name'] == "check_budget_tool" for entry in execution_history)
+
+
+def build_summary_prompt(execution_history: List[Any]) -> str:
+    """The per-call contents: the history, minified and without fields the report does not use."""
+    try:
+        history_json = prompts.compact_json(prompts.compact_history(execution_history))
+        prompts.record_compaction("summary", json.dumps(execution_history, indent=2, default=str), history_json)
+    except (TypeError, ValueError) as e:
+        logging.error(f"Serialization failed again: {e}")
+        history_json = str(execution_history)  # Fallback to string representation
+
+    return f"EXECUTION HISTORY:\n{history_json}"
+
+
+def _use_template(execution_history: List[Any], mode: str) -> bool:
+    if mode not in SUMMARY_MODES:
+        raise ValueError(f"Unknown summary mode '{mode}'. Expected one of {SUMMARY_MODES}.")
+    return mode == "template" or (mode == "hybrid" and not needs_llm_summary(execution_history))
+
+
+def _is_budget_result(entry: Dict[str, Any]) -> bool:
+    result = entry.get('result')
+    return (
+        entry.get('tool_name') == "check_budget_tool"
+        and isinstance(result, dict)
+        and all(field in result for field in BUDGET_FIELDS)
+    )
+
+
+def _llm_failure(execution_history: List[Any], mode: str, e: Exception) -> str:
+    if mode == "hybrid":
+        # The structured results are still valid; never lose the report to a quota error
+        logging.error(f"SUMMARIZATION: LLM failed ({e}), falling back to template")
+        return render_template_summary(execution_history)
+    return f"SUMMARIZATION ERROR: Could not generate report. Error: {e}"
@@ -1,48 +1,151 @@
 # agent/tools.py
+import weakref
 from sqlmodel import select
-from .db import Expense, Budget, get_db_engine, Session, engine
-from google import genai
-from google.genai import types
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .budget_cache import BUDGET_CACHE, BudgetEntry
+from .db import Expense, Budget, SpendRollup, Session
+from .rollups import ALL_TIME, BUDGET_PERIODS, apply_to_rollups, current_period_key, get_period_total
+from .metrics import timed_db
+from .shards import resolve_engine, resolve_async_engine
+from .vendor_index import VENDOR_INDEX
 
 # ----------------------------------------------------
-# 1. CORE Tool Functions (Private, accepts all args: user_id, db_engine)
+# 1. SESSION-LEVEL Tool Logic (shared by the sync and async paths)
 # ----------------------------------------------------
 
-def _log_expense_core(user_id: str, vendor: str, amount: float, category: str, db_engine=engine):
+@timed_db("log_expense")
+def _log_expense_in_session(session: Session, user_id: str, vendor: str, amount: float, category: str):
+    """Adds a new expense to an open session. The caller owns the commit."""
+    expense = Expense(user_id=user_id, vendor=vendor, amount=amount, category=category)
+    session.add(expense)
+    session.flush()  # Assigns the primary key without a post-commit refresh
+    apply_to_rollups(session, [(user_id, category, amount, expense.created_at)])
+    VENDOR_INDEX.record_on_commit(session, user_id, vendor, category, expense_id=expense.id)
+    return f"Successfully logged expense ID {expense.id} for ${amount} at {vendor}. Now checking budget."
+
+@timed_db("log_expenses")
+def _log_expenses_in_session(session: Session, user_id: str, expenses: list):
+    """Adds several expenses to an open session with a single flush. The caller owns the commit."""
+    rows = [
+        Expense(user_id=user_id, vendor=e["vendor"], amount=e["amount"], category=e["category"])
+        for e in expenses
+    ]
+    session.add_all(rows)
+    session.flush()  # One multi-row INSERT assigns every primary key
+    apply_to_rollups(session, [(user_id, row.category, row.amount, row.created_at) for row in rows])
+    for row in rows:
+        VENDOR_INDEX.record_on_commit(session, user_id, row.vendor, row.category, expense_id=row.id)
+    return [
+        f"Successfully logged expense ID {row.id} for ${e['amount']} at {e['vendor']}."
+        for row, e in zip(rows, expenses)
+    ]
+
+@timed_db("check_budget")
+def _check_budget_in_session(session: Session, user_id: str, category: str):
+    """
+    Checks the spending in the budget's current window (all-time, month or quarter) against the limit.
+    Served from BUDGET_CACHE unless a write to the user is pending or has committed since.
+    """
+    entry, token = BUDGET_CACHE.lookup(session, user_id, category)
+    if entry is None or entry.period != current_period_key(entry.budget_period):
+        entry = _read_budget_entry(session, user_id, category)
+        BUDGET_CACHE.store(session, user_id, category, token, entry)
+    return _budget_status(category, entry)
+
+def _read_budget_entry(session: Session, user_id: str, category: str) -> BudgetEntry:
+    # 1. Get the budget limit
+    budget_statement = select(Budget).where(Budget.user_id == user_id, Budget.category == category)
+    budget = session.exec(budget_statement).first()
+    limit = budget.limit if budget else 0.0 
+    budget_period = budget.period if budget else "all"
+    period = current_period_key(budget_period)
+    
+    # 2. Read current total spent from the rollup (single indexed row, no history scan)
+    total_spent = get_period_total(session, user_id, category, period)
+    return BudgetEntry(limit=limit, budget_period=budget_period, period=period, total_spent=total_spent)
+
+def _budget_status(category: str, entry: BudgetEntry):
+    status = "Under Budget"
+    if entry.total_spent > entry.limit:
+        status = "OVER BUDGET"
+    
+    return {
+        "category": category, 
+        "total_spent": entry.total_spent, 
+        "limit": entry.limit, 
+        "status": status,
+        "period": entry.period,
+        "message": f"Total spent on {category} is ${entry.total_spent}. Limit is ${entry.limit}. Status: {status}."
+    }
+
+def _budget_statuses_in_session(session: Session, user_id: str):
+    """The status of every category the user has a budget for or has spent in."""
+    categories, token = BUDGET_CACHE.lookup_categories(session, user_id)
+    if categories is None:
+        budgeted = session.exec(select(Budget.category).where(Budget.user_id == user_id)).all()
+        spent = session.exec(select(SpendRollup.category).where(
+            SpendRollup.user_id == user_id, SpendRollup.period == ALL_TIME
+        )).all()
+        categories = sorted(set(budgeted) | set(spent))
+        BUDGET_CACHE.store_categories(session, user_id, token, categories)
+    return [_check_budget_in_session(session, user_id, category) for category in categories]
+
+def _set_budget_in_session(session: Session, user_id: str, category: str, limit: float, period: str = "all"):
+    """Creates or replaces the user's budget (one per user for now). The caller owns the commit."""
+    if period not in BUDGET_PERIODS:
+        raise ValueError(f"Unknown budget period '{period}'. Expected one of {BUDGET_PERIODS}.")
+    budget = session.exec(select(Budget).where(Budget.user_id == user_id)).first()
+    if budget is None:
+        budget = Budget(user_id=user_id, limit=limit, category=category, period=period)
+    budget.limit, budget.category, budget.period = limit, category, period
+    session.add(budget)
+    session.flush()
+    BUDGET_CACHE.mark_written(session, [user_id])
+    return _check_budget_in_session(session, user_id, category)
+
+# ----------------------------------------------------
+# 2. CORE Tool Functions (Private, accepts all args: user_id, db_engine)
+# db_engine may be an engine, a ShardRouter or None (the user's shard; see agent.shards)
+# ----------------------------------------------------
+
+def _log_expense_core(user_id: str, vendor: str, amount: float, category: str, db_engine=None):
     """Core logic: Logs a new expense to the database."""
-    with Session(db_engine) as session:
-        expense = Expense(user_id=user_id, vendor=vendor, amount=amount, category=category)
-        session.add(expense)
+    with Session(resolve_engine(db_engine, user_id)) as session:
+        message = _log_expense_in_session(session, user_id, vendor, amount, category)
         session.commit()
-        session.refresh(expense)
-        return f"Successfully logged expense ID {expense.id} for ${amount} at {vendor}. Now checking budget."
+        return message
 
-def _check_budget_core(user_id: str, category: str, db_engine=engine):
+def _check_budget_core(user_id: str, category: str, db_engine=None):
     """Core logic: Checks the total spending for a given category against the user's limit."""
-    with Session(db_engine) as session:
-        # 1. Get the budget limit
-        budget_statement = select(Budget).where(Budget.user_id == user_id, Budget.category == category)
-        budget = session.exec(budget_statement).first()
-        limit = budget.limit if budget else 0.0 
-        
-        # 2. Calculate current total spent
-        expense_statement = select(Expense.amount).where(Expense.user_id == user_id, Expense.category == category)
-        total_spent = sum(session.exec(expense_statement).all())
-        
-        status = "Under Budget"
-        if total_spent > limit:
-            status = "OVER BUDGET"
-        
-        return {
-            "category": category, 
-            "total_spent": total_spent, 
-            "limit": limit, 
-            "status": status,
-            "message": f"Total spent on {category} is ${total_spent}. Limit is ${limit}. Status: {status}."
-        }
+    with Session(resolve_engine(db_engine, user_id)) as session:
+        return _check_budget_in_session(session, user_id, category)
+
+def _budget_statuses_core(user_id: str, db_engine=None):
+    """Core logic: The budget status of every category the user has a budget for or spent in."""
+    with Session(resolve_engine(db_engine, user_id)) as session:
+        return _budget_statuses_in_session(session, user_id)
+
+def _set_budget_core(user_id: str, category: str, limit: float, period: str = "all", db_engine=None):
+    """Core logic: Sets the user's budget and returns the resulting status."""
+    with Session(resolve_engine(db_engine, user_id)) as session:
+        status = _set_budget_in_session(session, user_id, category, limit, period)
+        session.commit()
+        return status
+
+async def _log_expense_core_async(user_id: str, vendor: str, amount: float, category: str, db_engine=None):
+    """Async core logic: Logs a new expense through an aiosqlite engine."""
+    async with AsyncSession(resolve_async_engine(db_engine, user_id)) as session:
+        message = await session.run_sync(_log_expense_in_session, user_id, vendor, amount, category)
+        await session.commit()
+        return message
+
+async def _check_budget_core_async(user_id: str, category: str, db_engine=None):
+    """Async core logic: Checks the budget status through an aiosqlite engine."""
+    async with AsyncSession(resolve_async_engine(db_engine, user_id)) as session:
+        return await session.run_sync(_check_budget_in_session, user_id, category)
 
 # ----------------------------------------------------
-# 2. PUBLIC Wrapper Functions (Signatures for Gemini to see)
+# 3. PUBLIC Wrapper Functions (Signatures for Gemini to see)
 # ----------------------------------------------------
 def say_hello_tool():
     """Prints a message and requires no input parameters."""
@@ -63,8 +166,32 @@ TOOL_REGISTRY = {
     "check_budget_tool": _check_budget_core,
 }
 
-def get_available_tool_declarations(client: genai.Client) -> list:
-    """Generates the list of Gemini API Tool declarations."""
+# Session-level variants used by the executor's group-commit path (one session per plan)
+SESSION_TOOL_REGISTRY = {
+    "log_expense_tool": _log_expense_in_session,
+    "check_budget_tool": _check_budget_in_session,
+}
+
+ASYNC_TOOL_REGISTRY = {
+    "log_expense_tool": _log_expense_core_async,
+    "check_budget_tool": _check_budget_core_async,
+}
+
+# Keyed weakly by client (the declarations depend on its API variant), so cached declarations
+# never keep a client alive
+_TOOL_DECLARATIONS = weakref.WeakKeyDictionary()
+
+def get_available_tool_declarations(client) -> list:
+    """
+    Generates the list of Gemini API Tool declarations (memoized per client). The SDK is only
+    imported here, so processes that never build declarations do not pay for loading it.
+    """
+    cached = _TOOL_DECLARATIONS.get(client)
+    if cached is not None:
+        return cached
+
+    from google.genai import types
+
     log_expense_declaration = types.FunctionDeclaration.from_callable(
         callable=log_expense_tool,
         client=client
@@ -81,4 +208,5 @@ def get_available_tool_declarations(client: genai.Client) -> list:
             check_budget_declaration
         ]),
     ]
+    _TOOL_DECLARATIONS[client] = available_tools
     return available_tools
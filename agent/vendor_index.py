@@ -0,0 +1,355 @@
+# agent/vendor_index.py
+"""
+Vendor -> category index learned from the Expense table.
+
+Known vendors ("BestBuy" -> Hardware) get their category from history instead of an LLM.
+Lookups try the user's own history first (a per-user override of the global consensus),
+then an exact, prefix and fuzzy match on the normalized vendor name. Memory is bounded:
+vendors and user entries are evicted least-recently-used, and each vendor keeps its most
+frequent categories only. A JSON snapshot (VENDOR_INDEX_SNAPSHOT) makes warm starts cheap;
+only Expense rows added after the snapshot are replayed (tracked per database, since every
+shard numbers its expenses independently).
+
+    python -m agent.vendor_index snapshot [--db sqlite:///poc_main.db] [--path vendor_index.json]
+"""
+import argparse
+import bisect
+import difflib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session, select
+
+from client_config import (
+    VENDOR_INDEX_MAX_VENDORS, VENDOR_INDEX_MAX_USER_ENTRIES, VENDOR_INDEX_SNAPSHOT,
+)
+from .db import Expense, database_name, get_db_engine
+
+SNAPSHOT_VERSION = 2
+
+# Categories kept per vendor (the least frequent one is dropped when a new one arrives)
+MAX_CATEGORIES_PER_VENDOR = 8
+# Observations needed before a vendor's share counts at full confidence. A single entry in
+# the user's own history is enough: it overrides the global consensus for that user.
+CONFIDENT_OBSERVATIONS = 3
+CONFIDENT_USER_OBSERVATIONS = 1
+# Prefix matches need this many characters; fuzzy matches this difflib ratio
+MIN_PREFIX_LENGTH = 4
+FUZZY_CUTOFF = 0.85
+# Fuzzy candidates are the known vendors sharing the first character, at most this many
+MAX_FUZZY_CANDIDATES = 2000
+MATCH_WEIGHTS = {"user": 1.0, "exact": 1.0, "prefix": 0.9, "fuzzy": 0.85}
+
+# session.info key: [(index, transaction, record() args)] observed by uncommitted writes
+_PENDING = "vendor_index_pending"
+
+_STORE_NUMBER_RE = re.compile(r"#\s*\d+")
+_TOKEN_RE = re.compile(r"[a-z0-9&]+")
+_SUFFIXES = {"inc", "llc", "ltd", "corp", "co", "plc", "gmbh", "com", "store", "stores"}
+
+
+def normalize_vendor(vendor: str) -> str:
+    """'Best Buy #123', 'BestBuy Inc.' and 'bestbuy.com' all become 'bestbuy'."""
+    tokens = _TOKEN_RE.findall(_STORE_NUMBER_RE.sub(" ", vendor.lower()))
+    while len(tokens) > 1 and (tokens[-1] in _SUFFIXES or tokens[-1].isdigit()):
+        tokens.pop()
+    return "".join(tokens)
+
+
+@dataclass
+class VendorMatch:
+    category: str
+    confidence: float  # Category share x evidence x match quality, 0-1
+    match: str  # 'user', 'exact', 'prefix' or 'fuzzy'
+    vendor: str  # The normalized vendor the answer came from
+    observations: int
+
+
+class VendorIndex:
+    """
+    Bounded in-memory map of normalized vendor -> {category: count}, plus a per-user layer
+    keyed on (user_id, vendor). Every logged expense is recorded once its transaction commits
+    (`record_on_commit`); `lookup` returns the best supported category or None.
+    """
+
+    def __init__(self, max_vendors: int = 50000, max_user_entries: int = 100000, snapshot_path: Optional[str] = None):
+        self.max_vendors = max_vendors
+        self.max_user_entries = max_user_entries
+        self.snapshot_path = snapshot_path
+        self.high_water: Dict[str, int] = {}  # Highest Expense.id folded in, per database file
+        self._vendors: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        self._users: "OrderedDict[Tuple[str, str], Dict[str, int]]" = OrderedDict()
+        self._sorted: List[str] = []  # Vendor keys in order, for prefix and fuzzy lookups
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # --- Public API ---
+
+    def record(self, user_id: str, vendor: str, category: str, count: int = 1, expense_id: Optional[int] = None,
+               database: str = ""):
+        """
+        Adds `count` observations of vendor -> category (globally and for user_id). Pass the
+        Expense id and its database (agent.db.database_name) so a snapshot knows which rows
+        it already covers.
+        """
+        key = normalize_vendor(vendor or "")
+        if not key or not category:
+            return
+        with self._lock:
+            if expense_id is not None and expense_id > self.high_water.get(database, 0):
+                self.high_water[database] = expense_id
+            if key not in self._vendors:
+                bisect.insort(self._sorted, key)
+            _add(self._vendors, key, category, count)
+            while len(self._vendors) > self.max_vendors:
+                evicted, _ = self._vendors.popitem(last=False)
+                del self._sorted[bisect.bisect_left(self._sorted, evicted)]
+                self.evictions += 1
+
+            if user_id:
+                _add(self._users, (user_id, key), category, count)
+                while len(self._users) > self.max_user_entries:
+                    self._users.popitem(last=False)
+                    self.evictions += 1
+
+    def record_on_commit(self, session: OrmSession, user_id: str, vendor: str, category: str, count: int = 1,
+                         expense_id: Optional[int] = None):
+        """
+        `record` for rows written in an open session, applied once the session commits.
+        Observations of rows that are rolled back (the transaction or the job's SAVEPOINT)
+        never reach the index, and the high-water mark never covers ids SQLite may reuse.
+        """
+        transaction = session.get_nested_transaction() or session.get_transaction()
+        session.info.setdefault(_PENDING, []).append(
+            (self, transaction, (user_id, vendor, category, count, expense_id, database_name(session)))
+        )
+
+    def lookup(self, vendor: str, user_id: Optional[str] = None) -> Optional[VendorMatch]:
+        """The most likely category for `vendor` (the user's own history wins), or None."""
+        key = normalize_vendor(vendor or "")
+        match = self._find(key, user_id) if key else None
+        with self._lock:
+            if match:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return match
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "vendors": len(self._vendors),
+                "user_entries": len(self._users),
+                "max_vendors": self.max_vendors,
+                "high_water": dict(self.high_water),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+    def clear(self):
+        with self._lock:
+            self._vendors.clear()
+            self._users.clear()
+            self._sorted.clear()
+            self.high_water = {}
+
+    # --- Building and persistence ---
+
+    def build_from_db(self, db_engine, after_id: int = 0) -> int:
+        """
+        Folds Expense rows with id > after_id into the index, streamed as grouped counts.
+        Returns the number of (user, vendor, category) groups read.
+        """
+        database = database_name(db_engine)
+        grouped = (
+            select(Expense.user_id, Expense.vendor, Expense.category, func.count(), func.max(Expense.id))
+            .where(Expense.id > after_id)
+            .group_by(Expense.user_id, Expense.vendor, Expense.category)
+            .execution_options(yield_per=5000)
+        )
+        groups = 0
+        with Session(db_engine) as session:
+            for user_id, vendor, category, count, max_id in session.exec(grouped):
+                self.record(user_id, vendor, category, count, expense_id=max_id, database=database)
+                groups += 1
+        logging.info(f"VENDOR INDEX: Folded {groups} vendor groups from {database or 'memory'} "
+                     f"(up to expense {self.high_water.get(database, 0)})")
+        return groups
+
+    def warm_start(self, db_engine, path: Optional[str] = None) -> int:
+        """
+        Loads the snapshot (if any), then replays only the Expense rows added since.
+        `db_engine` may be a list of engines (every shard of an agent.shards.ShardRouter).
+        """
+        path = path or self.snapshot_path
+        if path and os.path.exists(path):
+            try:
+                self.load_snapshot(path)
+            except (OSError, ValueError, KeyError) as e:
+                logging.error(f"VENDOR INDEX: Ignoring unreadable snapshot {path}: {e}")
+                self.clear()
+        engines = db_engine if isinstance(db_engine, (list, tuple)) else [db_engine]
+        return sum(self.build_from_db(engine, after_id=self.high_water.get(database_name(engine), 0))
+                   for engine in engines)
+
+    def save_snapshot(self, path: Optional[str] = None):
+        path = path or self.snapshot_path
+        with self._lock:
+            snapshot = {
+                "version": SNAPSHOT_VERSION,
+                "high_water": self.high_water,
+                "vendors": list(self._vendors.items()),  # LRU order, oldest first
+                "users": [[user_id, key, counts] for (user_id, key), counts in self._users.items()],
+            }
+        # Written next to the target and renamed, so a crash never leaves a torn snapshot
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+        logging.info(f"VENDOR INDEX: Saved snapshot of {len(snapshot['vendors'])} vendors to {path}")
+
+    def load_snapshot(self, path: str):
+        with open(path) as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {snapshot.get('version')}")
+
+        self.clear()
+        with self._lock:
+            # Oldest entries first, so trimming to a smaller limit keeps the most recent ones
+            self._vendors.update((key, dict(counts)) for key, counts in snapshot["vendors"][-self.max_vendors:])
+            self._users.update(((user_id, key), dict(counts))
+                               for user_id, key, counts in snapshot["users"][-self.max_user_entries:])
+            self._sorted = sorted(self._vendors)
+            self.high_water = dict(snapshot["high_water"])
+        logging.info(f"VENDOR INDEX: Loaded {len(self._vendors)} vendors from {path}")
+
+    # --- Internals ---
+
+    def _find(self, key: str, user_id: Optional[str]) -> Optional[VendorMatch]:
+        with self._lock:
+            if user_id and (user_id, key) in self._users:
+                self._users.move_to_end((user_id, key))
+                return _best(self._users[(user_id, key)], "user", key)
+
+            if key in self._vendors:
+                self._vendors.move_to_end(key)
+                return _best(self._vendors[key], "exact", key)
+
+            prefixed = self._prefix_matches(key)
+            if prefixed:
+                merged: Dict[str, int] = {}
+                for known in prefixed:
+                    for category, count in self._vendors[known].items():
+                        merged[category] = merged.get(category, 0) + count
+                return _best(merged, "prefix", prefixed[0])
+
+            close = difflib.get_close_matches(key, self._fuzzy_candidates(key), n=1, cutoff=FUZZY_CUTOFF)
+            if close:
+                return _best(self._vendors[close[0]], "fuzzy", close[0])
+        return None
+
+    def _prefix_matches(self, key: str) -> List[str]:
+        """Known vendors that extend `key` ('starbucks' -> 'starbuckscoffee'), or the longest one it extends."""
+        if len(key) < MIN_PREFIX_LENGTH:
+            return []
+        start = bisect.bisect_left(self._sorted, key)
+        extended = []
+        for known in self._sorted[start:start + MAX_FUZZY_CANDIDATES]:
+            if not known.startswith(key):
+                break
+            extended.append(known)
+        if extended:
+            return extended
+        for length in range(len(key) - 1, MIN_PREFIX_LENGTH - 1, -1):
+            if key[:length] in self._vendors:
+                return [key[:length]]
+        return []
+
+    def _fuzzy_candidates(self, key: str) -> List[str]:
+        head = key[:1]
+        start = bisect.bisect_left(self._sorted, head)
+        end = bisect.bisect_left(self._sorted, head + "\uffff", lo=start)
+        return self._sorted[start:min(end, start + MAX_FUZZY_CANDIDATES)]
+
+
+def _add(table: OrderedDict, key: Any, category: str, count: int):
+    counts = table.get(key)
+    if counts is None:
+        counts = table[key] = {}
+    table.move_to_end(key)
+    counts[category] = counts.get(category, 0) + count
+    if len(counts) > MAX_CATEGORIES_PER_VENDOR:
+        del counts[min(counts, key=counts.get)]
+
+
+def _best(counts: Dict[str, int], match: str, vendor: str) -> Optional[VendorMatch]:
+    if not counts:
+        return None
+    category = max(counts, key=counts.get)
+    total = sum(counts.values())
+    evidence = min(1.0, total / (CONFIDENT_USER_OBSERVATIONS if match == "user" else CONFIDENT_OBSERVATIONS))
+    confidence = counts[category] / total * evidence * MATCH_WEIGHTS[match]
+    return VendorMatch(category, round(confidence, 3), match, vendor, total)
+
+
+def _within(transaction, ancestor) -> bool:
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+# Registered on the ORM Session class, like agent.budget_cache's listeners. Releasing a
+# SAVEPOINT also fires after_commit; only the outermost commit makes the rows visible.
+@event.listens_for(OrmSession, "after_commit")
+def _apply_committed(session: OrmSession):
+    if session.in_nested_transaction():
+        return
+    for index, _, args in session.info.pop(_PENDING, ()):
+        index.record(*args)
+
+
+@event.listens_for(OrmSession, "after_soft_rollback")
+def _discard_rolled_back(session: OrmSession, previous_transaction):
+    # A rolled-back SAVEPOINT drops its own observations; the rest of the transaction may commit
+    pending = session.info.get(_PENDING)
+    if pending:
+        session.info[_PENDING] = [p for p in pending if not _within(p[1], previous_transaction)]
+
+
+# The global index used by the main application (filled at startup, see main.py's lifespan)
+VENDOR_INDEX = VendorIndex(
+    max_vendors=VENDOR_INDEX_MAX_VENDORS,
+    max_user_entries=VENDOR_INDEX_MAX_USER_ENTRIES,
+    snapshot_path=VENDOR_INDEX_SNAPSHOT
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the vendor -> category index snapshot.")
+    parser.add_argument("command", choices=["snapshot"], help="'snapshot' rebuilds the index from Expense rows and saves it")
+    parser.add_argument("--db", default=None, help="Database URL (defaults to every DB_SHARDS shard)")
+    parser.add_argument("--path", default=VENDOR_INDEX_SNAPSHOT or "vendor_index.json", help="Snapshot file")
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    from .shards import SHARD_ROUTER
+    for shard_engine in ([get_db_engine(cli_args.db)] if cli_args.db else SHARD_ROUTER.init().engines()):
+        VENDOR_INDEX.build_from_db(shard_engine)
+    VENDOR_INDEX.save_snapshot(cli_args.path)
+    print(f"Saved {VENDOR_INDEX.stats()['vendors']} vendors to {cli_args.path}.")
@@ -0,0 +1,266 @@
+# agent/writer.py
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .db import get_engine, get_async_engine
+
+# A job receives the shared Session and returns its result; it must not commit.
+Job = Callable[[Session], Any]
+
+# Group commit tuning: a flush happens when the batch is full or the window has elapsed.
+MAX_BATCH_SIZE = 128
+MAX_BATCH_WAIT_SECONDS = 0.002
+
+
+def run_job_batch(session: Session, jobs: List[Job]) -> List[Tuple[bool, Any]]:
+    """
+    Runs every job inside its own SAVEPOINT of one transaction, so a failing job is rolled
+    back without affecting the others. Returns (ok, result_or_exception) per job.
+    """
+    outcomes = []
+    for job in jobs:
+        try:
+            with session.begin_nested():
+                outcomes.append((True, job(session)))
+        except Exception as e:
+            outcomes.append((False, e))
+    return outcomes
+
+
+def _in_caller_context(job: Job) -> Job:
+    """Runs the job in the submitter's contextvars (e.g. its per-request metrics), not the writer's."""
+    context = contextvars.copy_context()
+    return lambda session: context.run(job, session)
+
+
+class GroupCommitWriter:
+    """
+    Single writer thread for one engine. Jobs submitted from any thread are drained in
+    batches and committed together, so N concurrent plans cost one fsync instead of N and
+    never contend for SQLite's write lock. Futures resolve only after the commit.
+    """
+
+    def __init__(self, db_engine, max_batch: int = MAX_BATCH_SIZE, max_wait: float = MAX_BATCH_WAIT_SECONDS):
+        self._engine = weakref.ref(db_engine)  # Not kept alive by the writer (see get_writer)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[Optional[Tuple[Job, Future]]]" = queue.Queue()
+        self._stats = {"jobs": 0, "batches": 0, "largest_batch": 0, "failed_commits": 0}
+        self._thread = threading.Thread(target=self._run, name="db-group-commit", daemon=True)
+        self._thread.start()
+
+    @property
+    def db_engine(self):
+        return self._engine()
+
+    def submit(self, job: Job) -> Future:
+        future: Future = Future()
+        self._queue.put((_in_caller_context(job), future))
+        return future
+
+    def run(self, job: Job) -> Any:
+        """Submits a job and blocks until its batch is committed."""
+        return self.submit(job).result()
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "queue_depth": self._queue.qsize()}
+
+    def stop(self):
+        """Lets the thread exit once the jobs queued so far are committed."""
+        self._queue.put(None)
+
+    def close(self, timeout: Optional[float] = None):
+        self.stop()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch, stop = [first], False
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._commit_batch(batch)
+            if stop:
+                return
+
+    def _commit_batch(self, batch: List[Tuple[Job, Future]]):
+        jobs = [job for job, _ in batch]
+        try:
+            with Session(self.db_engine) as session:
+                outcomes = run_job_batch(session, jobs)
+                session.commit()
+        except Exception as e:
+            logging.error(f"WRITER: Group commit of {len(batch)} jobs failed: {e}")
+            self._stats["failed_commits"] += 1
+            outcomes = [(False, e)] * len(batch)
+
+        self._stats["jobs"] += len(batch)
+        self._stats["batches"] += 1
+        self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+
+        for (_, future), (ok, value) in zip(batch, outcomes):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+class AsyncGroupCommitWriter:
+    """
+    Event-loop counterpart of GroupCommitWriter for aiosqlite engines: one background task
+    drains queued jobs and commits each batch through a single AsyncSession.
+    """
+
+    def __init__(self, db_engine, max_batch: int = MAX_BATCH_SIZE, max_wait: float = MAX_BATCH_WAIT_SECONDS):
+        self._engine = weakref.ref(db_engine)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.loop = asyncio.get_running_loop()
+        self._queue: "asyncio.Queue[Optional[Tuple[Job, asyncio.Future]]]" = asyncio.Queue()
+        self._stats = {"jobs": 0, "batches": 0, "largest_batch": 0, "failed_commits": 0}
+        self._task = self.loop.create_task(self._run())
+
+    @property
+    def db_engine(self):
+        return self._engine()
+
+    async def run(self, job: Job) -> Any:
+        future = self.loop.create_future()
+        self._queue.put_nowait((_in_caller_context(job), future))
+        return await future
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, "queue_depth": self._queue.qsize()}
+
+    def stop(self):
+        """Lets the task finish once the jobs queued so far are committed (callable from any thread)."""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._queue.put_nowait, None)
+
+    async def close(self):
+        self.stop()
+        await asyncio.shield(self._task)
+
+    async def _run(self):
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+
+            batch, stop = [first], False
+            deadline = self.loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), max(0.0, deadline - self.loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            await self._commit_batch(batch)
+            if stop:
+                return
+
+    async def _commit_batch(self, batch: List[Tuple[Job, asyncio.Future]]):
+        jobs = [job for job, _ in batch]
+        try:
+            async with AsyncSession(self.db_engine) as session:
+                outcomes = await session.run_sync(run_job_batch, jobs)
+                await session.commit()
+        except Exception as e:
+            logging.error(f"WRITER: Async group commit of {len(batch)} jobs failed: {e}")
+            self._stats["failed_commits"] += 1
+            outcomes = [(False, e)] * len(batch)
+
+        self._stats["jobs"] += len(batch)
+        self._stats["batches"] += 1
+        self._stats["largest_batch"] = max(self._stats["largest_batch"], len(batch))
+
+        for (_, future), (ok, value) in zip(batch, outcomes):
+            if future.cancelled():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+# --- Writer registry (one writer per engine, and per event loop for async engines) ---
+# Keyed weakly: a writer only holds a weak reference to its engine, so an engine nobody else
+# uses (e.g. a test's in-memory database) is collected and its writer stops. close_writer /
+# close_writers stop them explicitly (before disposing an engine, and on shutdown).
+
+_writers: "weakref.WeakKeyDictionary[Any, GroupCommitWriter]" = weakref.WeakKeyDictionary()
+_async_writers: "weakref.WeakKeyDictionary[Any, AsyncGroupCommitWriter]" = weakref.WeakKeyDictionary()
+_writers_lock = threading.Lock()
+
+
+def get_writer(db_engine: Optional[Any] = None) -> GroupCommitWriter:
+    db_engine = db_engine if db_engine is not None else get_engine()
+    with _writers_lock:
+        writer = _writers.get(db_engine)
+        if writer is None:
+            writer = _writers[db_engine] = GroupCommitWriter(db_engine)
+            weakref.finalize(db_engine, writer.stop)
+        return writer
+
+
+def get_async_writer(db_engine: Optional[Any] = None) -> AsyncGroupCommitWriter:
+    db_engine = db_engine if db_engine is not None else get_async_engine()
+    writer = _async_writers.get(db_engine)
+    loop = asyncio.get_running_loop()
+    if writer is None or writer.loop is not loop or writer._task.done():
+        if writer is not None:
+            writer.stop()  # Its event loop is gone or no longer the caller's
+        writer = _async_writers[db_engine] = AsyncGroupCommitWriter(db_engine)
+        weakref.finalize(db_engine, writer.stop)
+    return writer
+
+
+def close_writer(db_engine: Any, timeout: Optional[float] = None):
+    """Commits the engine's queued jobs and stops its writer thread (e.g. before engine.dispose())."""
+    with _writers_lock:
+        writer = _writers.pop(db_engine, None)
+    if writer is not None:
+        writer.close(timeout)
+
+
+async def close_writers():
+    """Shutdown hook: drains and stops every writer (async ones of other event loops are only told to stop)."""
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    await asyncio.to_thread(lambda: [writer.close() for writer in writers])
+
+    loop = asyncio.get_running_loop()
+    async_writers = list(_async_writers.values())
+    _async_writers.clear()
+    for writer in async_writers:
+        if writer.loop is loop:
+            await writer.close()
+        else:
+            writer.stop()
@@ -0,0 +1,3 @@
+# benchmarks/__init__.py
+
+# Performance benchmarks. Run from the project root, e.g. `python -m benchmarks.bench_writes`.
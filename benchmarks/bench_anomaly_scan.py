@@ -0,0 +1,87 @@
+# benchmarks/bench_anomaly_scan.py
+"""
+Throughput and memory of the batch anomaly scan (agent/anomaly_scan.py) at several table sizes.
+
+For each size a fresh SQLite file is filled with synthetic expenses (users with a few
+categories and vendors, ~1% injected duplicates and outliers), then scan_expenses runs over
+it. Peak memory is the traced Python/NumPy allocation during the scan, which should stay
+flat as the table grows because partitions are capped at --chunk-rows.
+
+Usage: python -m benchmarks.bench_anomaly_scan [--sizes 10000,100000,1000000] [--chunk-rows 250000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert
+
+from agent.anomaly_scan import scan_expenses
+from agent.db import Expense, get_db_engine
+
+CATEGORIES = ("Meals", "Hardware", "Travel", "Office Supplies", "Software")
+VENDORS = ("Bistro", "BestBuy", "Delta", "Staples", "GitHub", "Cafe Luna", "Amazon", "Uber")
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+INSERT_BATCH = 50_000
+
+
+def fill(engine, rows: int, users: int, seed: int = 7):
+    rng = random.Random(seed)
+    with engine.begin() as connection:
+        batch = []
+        for i in range(rows):
+            category = CATEGORIES[i % len(CATEGORIES)]
+            amount = round(rng.lognormvariate(3.5, 0.4), 2)
+            if rng.random() < 0.005:
+                amount *= 20  # Outlier
+            row = {
+                "user_id": f"U{rng.randrange(users):06d}", "vendor": rng.choice(VENDORS), "amount": amount,
+                "category": category, "is_flagged": False,
+                "created_at": START + timedelta(minutes=rng.randrange(525_600)),
+            }
+            batch.append(row)
+            if rng.random() < 0.005:
+                batch.append({**row, "created_at": row["created_at"] + timedelta(minutes=3)})  # Duplicate
+            if len(batch) >= INSERT_BATCH:
+                connection.execute(insert(Expense), batch)
+                batch = []
+        if batch:
+            connection.execute(insert(Expense), batch)
+
+
+def measure(rows: int, chunk_rows: int, rows_per_user: int, trace_memory: bool):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_db_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        start = time.perf_counter()
+        fill(engine, rows, users=max(1, rows // rows_per_user))
+        fill_seconds = time.perf_counter() - start
+
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        report = scan_expenses(engine, chunk_rows=chunk_rows)
+        elapsed = time.perf_counter() - start
+        memory = ""
+        if trace_memory:
+            memory = f"  peak {tracemalloc.get_traced_memory()[1] / 2**20:7.1f} MiB"
+            tracemalloc.stop()
+        engine.dispose()
+
+    print(f"{report['rows_scanned']:>10,} rows  {report['partitions']:>4} partitions  scan {elapsed:7.2f}s "
+          f"-> {report['rows_scanned'] / elapsed:>10,.0f} rows/s{memory}  "
+          f"flagged {report['flagged']:,} {report['reasons']}  (fill {fill_seconds:.1f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated row counts")
+    parser.add_argument("--chunk-rows", type=int, default=250_000)
+    parser.add_argument("--rows-per-user", type=int, default=200)
+    parser.add_argument("--memory", action="store_true", help="Trace peak allocations during the scan")
+    args = parser.parse_args()
+
+    for size in args.sizes.split(","):
+        measure(int(size), args.chunk_rows, args.rows_per_user, args.memory)
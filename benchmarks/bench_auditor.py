@@ -0,0 +1,180 @@
+# benchmarks/bench_auditor.py
+"""
+End-to-end benchmark of run_auditor_async against the offline FakeGeminiClient.
+
+For every DB size and concurrency level it reports p50/p95/p99 latency, audits per second,
+errors and the mean time per phase from the result's timings block (agent.metrics). Results are written as JSON and can be compared against a baseline:
+
+  python -m benchmarks.bench_auditor --save benchmarks/results/baseline.json
+  python -m benchmarks.bench_auditor --baseline benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from sqlmodel import Session
+
+import agent.main as auditor
+from agent.db import Budget, Expense, get_async_db_engine, get_db_engine
+from agent.fake_llm import FakeGeminiClient
+from agent.llm_scheduler import LLMScheduler, ScheduledClient
+from agent.plan_cache import PLAN_CACHE
+from agent.rollups import rebuild_rollups
+from client_config import PRIMARY_MODEL
+
+USERS = 100
+CATEGORIES = ("Meals", "Hardware", "Travel")
+WORKLOADS = ("fast", "llm", "mixed")
+
+
+def expense_text(i: int, workload: str) -> str:
+    vendor = f"Vendor{i % 500}"
+    amount = 5 + i % 90
+    if workload == "fast" or (workload == "mixed" and i % 2 == 0):
+        return f"Log ${amount}.50 for lunch at {vendor} under Meals."
+    # No '$' and no explicit category: the fast path declines and the planner LLM runs
+    return f"Spent {amount} bucks on a taxi ride with {vendor}"
+
+
+def populate(db_path: str, rows: int):
+    engine = get_db_engine(f"sqlite:///{db_path}")
+    rng = random.Random(0)
+    with Session(engine) as session:
+        for u in range(USERS):
+            for category in CATEGORIES[:1]:
+                session.add(Budget(user_id=f"U{u}", limit=1000.0, category=category))
+        for start in range(0, rows, 10_000):
+            session.add_all([
+                Expense(user_id=f"U{rng.randrange(USERS)}", vendor=f"Vendor{rng.randrange(500)}",
+                        amount=round(rng.uniform(1, 200), 2), category=rng.choice(CATEGORIES))
+                for _ in range(min(10_000, rows - start))
+            ])
+            session.flush()
+        session.commit()
+    rebuild_rollups(engine)
+    engine.dispose()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_level(db_url: str, concurrency: int, requests: int, workload: str, client_kwargs: Dict[str, Any],
+                    rate_limits: Dict[str, Any]) -> Dict[str, Any]:
+    engine = get_async_db_engine(db_url)
+    fake = FakeGeminiClient(**client_kwargs)
+    client = ScheduledClient(fake, LLMScheduler(limits=rate_limits))
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors, phase_ms = [], 0, {}
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            report = await auditor.run_auditor_async(f"U{i % USERS}", expense_text(i, workload),
+                                                     test_engine=engine, client=client, timings=True)
+            latencies.append(time.perf_counter() - start)
+            if not report.get('full_history'):
+                errors += 1
+            for phase, ms in report.get('timings', {}).get('phases_ms', {}).items():
+                phase_ms.setdefault(phase, []).append(ms)
+
+    try:
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        wall = time.perf_counter() - wall_start
+    finally:
+        await engine.dispose()
+
+    stats = fake.stats()
+    phases = {phase: statistics.mean(values) for phase, values in sorted(phase_ms.items())}
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+        "audits_per_sec": requests / wall,
+        "errors": errors,
+        "llm_calls": stats["calls"],
+        "phase_mean_ms": phases,
+    }
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {(r["db_size"], r["concurrency"]): r for r in json.load(f)["results"]}
+
+    print(f"\nComparison against {baseline_path}:")
+    for result in results:
+        base = baseline.get((result["db_size"], result["concurrency"]))
+        if not base:
+            continue
+        deltas = []
+        for key in ("p50_ms", "p95_ms", "audits_per_sec"):
+            change = (result[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+            deltas.append(f"{key} {change:+.1f}%")
+        print(f"  db={result['db_size']:>7} c={result['concurrency']:>4}: " + ", ".join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,8,32,128", help="Comma-separated concurrency levels")
+    parser.add_argument("--db-sizes", default="0,10000,100000", help="Comma-separated pre-existing Expense row counts")
+    parser.add_argument("--requests", type=int, default=200, help="Audits per concurrency level")
+    parser.add_argument("--workload", choices=WORKLOADS, default="mixed")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake LLM latency per call (seconds)")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of LLM calls failing with 429")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="Fraction of LLM calls timing out")
+    parser.add_argument("--rpm", type=int, default=0, help="Scheduler requests/minute limit (0 = unlimited)")
+    parser.add_argument("--tpm", type=int, default=0, help="Scheduler tokens/minute limit (0 = unlimited)")
+    parser.add_argument("--no-plan-cache", action="store_true", help="Disable the plan cache for this run")
+    parser.add_argument("--save", default="benchmarks/results/latest.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", default=None, help="Previous results JSON to compare against")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    if args.no_plan_cache:
+        PLAN_CACHE.max_size = 0
+
+    client_kwargs = {"latency": args.latency, "jitter": args.jitter, "error_rate": args.error_rate,
+                     "timeout_rate": args.timeout_rate, "timeout": 1.0}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for db_size in (int(n) for n in args.db_sizes.split(",")):
+            db_path = os.path.join(tmp, f"bench_{db_size}.db")
+            populate(db_path, db_size)
+            for concurrency in (int(n) for n in args.concurrency.split(",")):
+                PLAN_CACHE.clear()
+                result = asyncio.run(run_level(f"sqlite+aiosqlite:///{db_path}", concurrency,
+                                               args.requests, args.workload, client_kwargs,
+                                               {PRIMARY_MODEL: (args.rpm, args.tpm)}))
+                result["db_size"] = db_size
+                results.append(result)
+                print(f"db={db_size:>7} c={concurrency:>4}  p50={result['p50_ms']:7.1f}ms  "
+                      f"p95={result['p95_ms']:7.1f}ms  p99={result['p99_ms']:7.1f}ms  "
+                      f"{result['audits_per_sec']:7.1f} audits/s  errors={result['errors']}  "
+                      f"phases(ms)={ {k: round(v, 1) for k, v in result['phase_mean_ms'].items()} }")
+
+    os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+    with open(args.save, "w") as f:
+        json.dump({"config": vars(args), "results": results}, f, indent=2)
+    print(f"\nSaved results to {args.save}")
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
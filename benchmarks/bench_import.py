@@ -0,0 +1,83 @@
+# benchmarks/bench_import.py
+"""
+Import-time benchmark: how long a fresh interpreter takes to import the agent.
+
+Each run starts a new `python -X importtime` process, so nothing is cached between runs.
+Reports the median cumulative import time per module, the slowest dependencies, and exits
+non-zero when --max-ms is exceeded (use it in CI to catch regressions):
+
+  python -m benchmarks.bench_import --runs 10 --max-ms 600
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_IMPORTTIME_RE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure(module: str) -> Tuple[float, Dict[str, int]]:
+    """Imports `module` in a fresh interpreter; returns (cumulative ms, self time in us per module)."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    cumulative_us, self_us = 0, {}
+    for line in result.stderr.splitlines():
+        match = _IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        self_time, cumulative, indent, name = int(match.group(1)), int(match.group(2)), match.group(3), match.group(4)
+        self_us[name] = self_time
+        if name == module and len(indent) == 1:
+            cumulative_us = cumulative
+    return cumulative_us / 1000, self_us
+
+
+def top_packages(samples: List[Dict[str, int]], limit: int) -> List[Tuple[str, float]]:
+    """Median self time per top-level package, slowest first."""
+    per_package: Dict[str, List[int]] = {}
+    for sample in samples:
+        totals: Dict[str, int] = {}
+        for name, self_time in sample.items():
+            package = ".".join(name.split(".")[:2]) if name.startswith("google.") else name.split(".")[0]
+            totals[package] = totals.get(package, 0) + self_time
+        for package, total in totals.items():
+            per_package.setdefault(package, []).append(total)
+    ranked = sorted(((p, statistics.median(v) / 1000) for p, v in per_package.items()), key=lambda x: -x[1])
+    return ranked[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", default="agent.main,main", help="Comma-separated modules to import")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="Slowest packages to list")
+    parser.add_argument("--max-ms", type=float, default=None, help="Fail if any module's median exceeds this")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules.split(","):
+        timings, samples = [], []
+        for _ in range(args.runs):
+            cumulative_ms, self_us = measure(module)
+            timings.append(cumulative_ms)
+            samples.append(self_us)
+
+        median = statistics.median(timings)
+        print(f"{module}: median {median:.1f} ms, min {min(timings):.1f} ms over {args.runs} runs")
+        for package, ms in top_packages(samples, args.top):
+            print(f"    {package:<28} {ms:8.1f} ms")
+        if args.max_ms is not None and median > args.max_ms:
+            print(f"  FAIL: {median:.1f} ms exceeds --max-ms {args.max_ms:.1f}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# benchmarks/bench_shards.py
+"""
+Write throughput of the executor at several shard counts (agent/shards.py).
+
+Every run gets fresh SQLite files in a temporary directory. --processes workers each route
+their plans through their own ShardRouter and group-commit writers (one thread per shard),
+like API processes sharing the same shard files. A single file admits one writer
+at a time, so with one shard the processes queue on its lock. With N shards, plans for
+users on different shards commit in parallel.
+
+Usage: python -m benchmarks.bench_shards [--shards 1,2,4,8] [--processes 4] [--threads 8] [--plans 2000]
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from agent.executor import execute_plan
+from agent.shards import ShardRouter
+
+USERS = 1000
+
+
+def make_plan(i):
+    category = ("Meals", "Hardware", "Travel")[i % 3]
+    return [
+        {"step_number": 1, "tool_name": "log_expense_tool",
+         "arguments": {"vendor": f"Vendor {i}", "amount": 10.0 + i % 7, "category": category}},
+        {"step_number": 2, "tool_name": "check_budget_tool", "arguments": {"category": category}},
+    ]
+
+
+def router_for(directory, shards):
+    return ShardRouter(shards, f"sqlite:///{os.path.join(directory, 'shard{index}.db')}",
+                       main_url=f"sqlite:///{os.path.join(directory, 'main.db')}")
+
+
+def worker(directory, shards, worker_index, workers, threads, plans):
+    """Runs this worker's share of the plans; returns the number of failed steps."""
+    logging.disable(logging.INFO)
+    router = router_for(directory, shards)
+
+    def one(i):
+        history = execute_plan(make_plan(i), f"U{i % USERS}", router)
+        return sum(1 for h in history if h["status"] != "SUCCESS")
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return sum(pool.map(one, range(worker_index, plans, workers)))
+
+
+def measure(shards, processes, threads, plans):
+    with tempfile.TemporaryDirectory() as directory:
+        router_for(directory, shards).init()  # Schemas exist before the workers race to create them
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(worker, directory, shards, index, processes, threads, plans)
+                       for index in range(processes)]
+            failures = sum(future.result() for future in futures)
+        elapsed = time.perf_counter() - start
+
+    print(f"{shards:>2} shards  {plans} plans ({plans} expense writes) in {elapsed:6.2f}s "
+          f"-> {plans / elapsed:>8,.0f} writes/s, {failures} failed steps")
+    return plans / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", default="1,2,4,8", help="Comma-separated shard counts")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="Concurrent plans per process")
+    parser.add_argument("--plans", type=int, default=2000)
+    args = parser.parse_args()
+
+    results = {int(count): measure(int(count), args.processes, args.threads, args.plans)
+               for count in args.shards.split(",")}
+    baseline = results[min(results)]
+    print("scaling: " + ", ".join(f"{count} shards {rate / baseline:.1f}x" for count, rate in results.items()))
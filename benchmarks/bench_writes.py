@@ -0,0 +1,73 @@
+# benchmarks/bench_writes.py
+"""
+Write throughput of the executor's DB path, before and after group commit.
+
+  before: default SQLite engine (rollback journal, synchronous=FULL), one session and commit
+          per tool call, as execute_plan_step does.
+  after:  get_db_engine (WAL + tuned pragmas) and execute_plan, which runs each plan in one
+          session and group-commits concurrent plans through a single writer thread.
+
+Usage: python -m benchmarks.bench_writes [--threads 16] [--plans 400]
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlmodel import SQLModel, create_engine
+
+from agent.db import get_db_engine
+from agent.executor import execute_plan, execute_plan_step
+
+
+def make_plan(i):
+    category = ("Meals", "Hardware", "Travel")[i % 3]
+    return [
+        {"step_number": 1, "tool_name": "log_expense_tool",
+         "arguments": {"vendor": f"Vendor {i}", "amount": 10.0 + i % 7, "category": category}},
+        {"step_number": 2, "tool_name": "check_budget_tool", "arguments": {"category": category}},
+    ]
+
+
+def run_before(engine, user_id, plan):
+    return [execute_plan_step(s["tool_name"], s["arguments"], user_id, engine) for s in plan]
+
+
+def run_after(engine, user_id, plan):
+    return execute_plan(plan, user_id, engine)
+
+
+def measure(label, engine, runner, threads, plans):
+    def one(i):
+        history = runner(engine, f"U{i % 50}", make_plan(i))
+        return sum(1 for h in history if h["status"] != "SUCCESS")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        failures = sum(pool.map(one, range(plans)))
+    elapsed = time.perf_counter() - start
+
+    print(f"{label:<8} {plans} plans ({plans} expense writes) in {elapsed:.2f}s "
+          f"-> {plans / elapsed:,.0f} writes/s, {failures} failed steps")
+    return plans / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--plans", type=int, default=400)
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        before_engine = create_engine(f"sqlite:///{os.path.join(tmp, 'before.db')}",
+                                      connect_args={"check_same_thread": False})
+        SQLModel.metadata.create_all(before_engine)
+        after_engine = get_db_engine(f"sqlite:///{os.path.join(tmp, 'after.db')}")
+
+        before = measure("before", before_engine, run_before, args.threads, args.plans)
+        after = measure("after", after_engine, run_after, args.threads, args.plans)
+        print(f"speedup: {after / before:.1f}x")
@@ -1,6 +1,6 @@
 # client_config.py
 import os
-from google import genai
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,9 +12,147 @@ PLANNER_MODEL = PRIMARY_MODEL
 JUDGE_MODEL = PRIMARY_MODEL
 SUMMARY_MODEL = PRIMARY_MODEL
 
-# Initialize the global client
-CLIENT = None
-if os.getenv("GEMINI_API_KEY"):
-    CLIENT = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-else:
-    print("WARNING: GEMINI_API_KEY not found in environment.")
\ No newline at end of file
+# --- SUMMARIZER ---
+# 'template': local report from structured tool results (no LLM call)
+# 'llm':      always ask SUMMARY_MODEL
+# 'hybrid':   template, falling back to the LLM only for failed or unusual histories
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "hybrid")
+
+# --- PLAN CACHE ---
+# Judged plans are reused for requests that only differ in amount, vendor or user id
+PLAN_CACHE_MAX_SIZE = int(os.getenv("PLAN_CACHE_MAX_SIZE", "1024"))
+PLAN_CACHE_TTL_SECONDS = float(os.getenv("PLAN_CACHE_TTL_SECONDS", "86400"))
+PLAN_CACHE_DB_URL = os.getenv("PLAN_CACHE_DB_URL")  # e.g. sqlite:///plan_cache.db (unset = in-memory only)
+
+# --- IDEMPOTENCY ---
+# /process_expense results are stored per Idempotency-Key header for IDEMPOTENCY_TTL_SECONDS
+# (agent/idempotency.py). By default only an explicit header dedupes: two identical texts are
+# two purchases. IDEMPOTENCY_WINDOW_SECONDS > 0 also treats the same user_id + expense_text
+# as a retry if it arrives within that many seconds of the execution it repeats.
+# The running worker renews its claim every third of IDEMPOTENCY_LOCK_TIMEOUT_SECONDS; a
+# claim not renewed for that long is taken over (its worker died).
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_WINDOW_SECONDS = float(os.getenv("IDEMPOTENCY_WINDOW_SECONDS", "0"))
+IDEMPOTENCY_LOCK_TIMEOUT_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT_SECONDS", "120"))
+
+# --- SHARDING ---
+# User-owned rows (Expense, Budget, SpendRollup) are spread over DB_SHARDS SQLite files by a
+# consistent hash of user_id (agent/shards.py), so writes for different users do not queue on
+# one file's write lock. Shard 0 is the main poc_main.db, which also keeps the global tables;
+# shard i > 0 lives at DB_SHARD_URL_TEMPLATE.format(index=i). After changing DB_SHARDS move
+# the affected users with: python -m agent.shards rebalance --from <old count>
+DB_SHARDS = int(os.getenv("DB_SHARDS", "1"))
+DB_SHARD_URL_TEMPLATE = os.getenv("DB_SHARD_URL_TEMPLATE", "sqlite:///poc_main.shard{index}.db")
+
+# --- BACKGROUND JOBS ---
+# /process_expense?background=true queues the audit in SQLite (agent/job_queue.py) and
+# JOB_WORKERS in-process workers run it (0 = run workers separately: python -m agent.job_queue).
+# Submissions beyond the pending limits are rejected with 429.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX_PENDING = int(os.getenv("JOB_QUEUE_MAX_PENDING", "1000"))
+JOB_QUEUE_MAX_PER_USER = int(os.getenv("JOB_QUEUE_MAX_PER_USER", "50"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))  # Renewed while the job runs
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "604800"))  # Finished jobs are kept a week
+
+# --- LLM SCHEDULER ---
+# Every Gemini call is paced to the model's quota (requests and tokens per minute, 0 = no
+# limit) and retried with jittered exponential backoff on 429/5xx (agent/llm_scheduler.py).
+# Requests are not capped by default; on the free tier of gemini-2.5-flash-lite set
+# LLM_RPM_LIMIT=15 (its TPM limit, 250000, is the default below).
+LLM_RPM_LIMIT = int(os.getenv("LLM_RPM_LIMIT", "0"))
+LLM_TPM_LIMIT = int(os.getenv("LLM_TPM_LIMIT", "250000"))
+MODEL_RATE_LIMITS = {PRIMARY_MODEL: (LLM_RPM_LIMIT, LLM_TPM_LIMIT)}
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.25"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "20"))
+
+# --- LLM CALL COALESCING ---
+# Planner/judge calls from concurrent requests arriving within the window are sent as one
+# multi-request call (agent/coalescer.py). 0 disables coalescing.
+LLM_COALESCE_WINDOW_MS = float(os.getenv("LLM_COALESCE_WINDOW_MS", "0"))
+LLM_COALESCE_MAX_BATCH = int(os.getenv("LLM_COALESCE_MAX_BATCH", "16"))
+
+# --- PROMPT CONTEXT CACHING ---
+# Static system instructions are registered once with Gemini context caching (agent/prompts.py)
+# and referenced by handle. Instructions shorter than the model's cacheable minimum are sent inline.
+# Off by default: the shipped instructions are ~50-270 tokens, well below Gemini's 1024-token
+# minimum for explicit caching, so every call would be sent inline anyway. Lowering
+# PROMPT_CACHE_MIN_TOKENS does not help (Gemini rejects the create call); enable it once the
+# instructions grow past the minimum (e.g. with few-shot examples). Compaction always applies.
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+PROMPT_CACHE_TTL_SECONDS = float(os.getenv("PROMPT_CACHE_TTL_SECONDS", "3600"))
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+PROMPT_CACHE_RETRY_SECONDS = float(os.getenv("PROMPT_CACHE_RETRY_SECONDS", "600"))
+
+# --- BUDGET STATUS CACHE ---
+# Budget statuses (limit, spend in the current window) read by check_budget_tool and
+# GET /budgets are cached per user (agent/budget_cache.py) and dropped when a write to the
+# user commits. The TTL bounds how long writes from other processes can go unseen.
+BUDGET_CACHE_ENABLED = os.getenv("BUDGET_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+BUDGET_CACHE_MAX_USERS = int(os.getenv("BUDGET_CACHE_MAX_USERS", "10000"))
+BUDGET_CACHE_TTL_SECONDS = float(os.getenv("BUDGET_CACHE_TTL_SECONDS", "60"))
+
+# --- VENDOR INDEX ---
+# Vendor -> category counts learned from Expense rows (agent/vendor_index.py). Categories the
+# index is at least VENDOR_INDEX_MIN_CONFIDENCE sure of are used without asking the LLM.
+VENDOR_INDEX_MAX_VENDORS = int(os.getenv("VENDOR_INDEX_MAX_VENDORS", "50000"))
+VENDOR_INDEX_MAX_USER_ENTRIES = int(os.getenv("VENDOR_INDEX_MAX_USER_ENTRIES", "100000"))
+VENDOR_INDEX_MIN_CONFIDENCE = float(os.getenv("VENDOR_INDEX_MIN_CONFIDENCE", "0.8"))
+VENDOR_INDEX_SNAPSHOT = os.getenv("VENDOR_INDEX_SNAPSHOT")  # e.g. vendor_index.json (unset = rebuild at startup)
+
+# --- STATEMENT IMPORT ---
+# Bulk CSV/JSONL imports (agent/statement_import.py) commit IMPORT_CHUNK_SIZE rows per
+# transaction; rows without a resolvable category go to Gemini IMPORT_LLM_BATCH_SIZE at a time.
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+IMPORT_LLM_BATCH_SIZE = int(os.getenv("IMPORT_LLM_BATCH_SIZE", "50"))
+
+# --- ANOMALY SCAN ---
+# Nightly scan setting Expense.is_flagged (agent/anomaly_scan.py). Users are scanned in
+# partitions of about ANOMALY_SCAN_CHUNK_ROWS rows (a larger single user is loaded whole).
+ANOMALY_SCAN_CHUNK_ROWS = int(os.getenv("ANOMALY_SCAN_CHUNK_ROWS", "250000"))
+ANOMALY_Z_THRESHOLD = float(os.getenv("ANOMALY_Z_THRESHOLD", "3.5"))  # Std devs from the user's category norm
+ANOMALY_MIN_HISTORY = int(os.getenv("ANOMALY_MIN_HISTORY", "5"))  # Expenses needed before a norm is trusted
+ANOMALY_DUPLICATE_WINDOW_SECONDS = float(os.getenv("ANOMALY_DUPLICATE_WINDOW_SECONDS", "86400"))
+ANOMALY_VENDOR_SHARE = float(os.getenv("ANOMALY_VENDOR_SHARE", "0.8"))  # Share of a user's spend at one vendor
+
+# --- METRICS ---
+# Per-phase histograms served on /metrics and the optional 'timings' block (agent/metrics.py)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# --- LLM BACKEND ---
+# 'gemini': the real API (needs GEMINI_API_KEY)
+# 'fake':   offline deterministic stand-in (agent/fake_llm.py), tuned via FAKE_LLM_* variables
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini")
+
+# --- CLIENT (created on first use, so importing this module stays cheap) ---
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process-wide LLM client, or None when no GEMINI_API_KEY is configured."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_client()
+    return _client or None
+
+
+def _create_client():
+    if LLM_BACKEND == "fake":
+        from agent.fake_llm import FakeGeminiClient
+        return FakeGeminiClient.from_env(os.environ)
+    if os.getenv("GEMINI_API_KEY"):
+        from google import genai
+        return genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+    print("WARNING: GEMINI_API_KEY not found in environment.")
+    return False  # Remembered, so the warning is printed once
+
+
+def __getattr__(name):
+    # Backwards compatibility: `from client_config import CLIENT` still works, lazily
+    if name == "CLIENT":
+        return get_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
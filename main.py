@@ -1,15 +1,45 @@
 # main.py (at the project root)
 import uvicorn
-from fastapi import FastAPI
+import json
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from pydantic import BaseModel
+from typing import List, Optional
 # 🟢 UPDATED IMPORT: Pointing to the new orchestrator location
-from agent.main import run_auditor
+from agent.main import run_auditor_async, run_auditor_batch, stream_auditor
+from agent import metrics
+from agent.idempotency import IDEMPOTENCY_STORE, IdempotencyConflict, idempotency_key, request_fingerprint
+from agent.job_queue import JOB_QUEUE, JOB_WORKER_POOL, QueueFull
+from agent.shards import SHARD_ROUTER
+from agent.statement_import import FORMATS, import_statement
+from agent.tools import _budget_statuses_core, _check_budget_core, _set_budget_core
+from agent.vendor_index import VENDOR_INDEX
+from agent.writer import close_writers
+from client_config import LLM_BACKEND
+import io
 import os
+import tempfile
+from contextlib import asynccontextmanager
 
 load_dotenv()
 
-app = FastAPI(title="Expense Auditor Agent")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Explicit startup hook: importing the agent never touches the database
+    SHARD_ROUTER.init()  # The main database (shard 0) and any DB_SHARDS shards
+    VENDOR_INDEX.warm_start(SHARD_ROUTER.engines())
+    JOB_WORKER_POOL.start()
+    yield
+    await JOB_WORKER_POOL.stop()
+    await close_writers()  # Commits queued writes and stops the writer threads
+    if VENDOR_INDEX.snapshot_path:
+        VENDOR_INDEX.save_snapshot()
+
+
+app = FastAPI(title="Expense Auditor Agent", lifespan=lifespan)
 
 
 class ExpenseRequest(BaseModel):
@@ -17,22 +47,167 @@ class ExpenseRequest(BaseModel):
     expense_text: str
 
 
+class ExpenseBatchRequest(BaseModel):
+    user_id: str
+    expense_items: List[str]
+
+
+class BudgetUpdate(BaseModel):
+    limit: float
+    period: str = "all"  # 'all', 'month' or 'quarter'
+
+
+def _missing_api_key() -> bool:
+    # The offline fake backend (LLM_BACKEND=fake) needs no key
+    return LLM_BACKEND == "gemini" and not os.getenv("GEMINI_API_KEY")
+
+
 @app.get("/")
 def read_root():
     return {"message": "Expense Auditor Agent is running."}
 
 
 @app.post("/process_expense")
-def process_expense(data: ExpenseRequest):
-    """Endpoint to process an expense via the Gemini Agent."""
-    if not os.getenv("GEMINI_API_KEY"):
+async def process_expense(data: ExpenseRequest, response: Response, timings: bool = False, background: bool = False,
+                          idempotency_key_header: Optional[str] = Header(None, alias="Idempotency-Key")):
+    """
+    Endpoint to process an expense via the Gemini Agent (non-blocking, async pipeline).
+    `?timings=true` adds the per-phase timing block to the report.
+    Retries with the same Idempotency-Key (or, if IDEMPOTENCY_WINDOW_SECONDS is set, the
+    same text shortly after) get the first execution's report instead of logging the expense twice; see agent.idempotency.
+    Reusing an Idempotency-Key for a different request body is rejected with 422.
+    `?background=true` queues the audit instead (202 + job id; poll GET /jobs/{job_id}).
+    """
+    if _missing_api_key():
         return {"error": "GEMINI_API_KEY not found. Check your .env file."}
 
-    # This now triggers the Plan-Reflect-Execute cycle
-    report = run_auditor(data.user_id, data.expense_text)
+    if background:
+        try:
+            # Only an explicit Idempotency-Key dedupes submissions; the job itself runs at most once
+            job = await run_in_threadpool(
+                JOB_QUEUE.submit, data.user_id, data.expense_text, timings=timings,
+                idempotency_key=idempotency_key(data.user_id, data.expense_text, idempotency_key_header, window_seconds=0)
+            )
+        except QueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(int(e.retry_after))})
+        except IdempotencyConflict as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        response.status_code = 202
+        response.headers["Location"] = f"/jobs/{job['job_id']}"
+        return job
+
+    # This now triggers the Plan-Reflect-Execute cycle (at most once per idempotency key)
+    key = idempotency_key(data.user_id, data.expense_text, idempotency_key_header)
+    fingerprint = request_fingerprint(data.user_id, data.expense_text) if idempotency_key_header else None
+    try:
+        report, replayed = await IDEMPOTENCY_STORE.run(
+            key, data.user_id, lambda: run_auditor_async(data.user_id, data.expense_text, timings=timings), fingerprint
+        )
+    except IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
 
     return report
 
 
+@app.get("/jobs/{job_id}")
+async def read_job(job_id: str, wait: float = 0):
+    """
+    Status of a background audit; 'result' holds the report once it is 'done'.
+    `?wait=N` long-polls up to N seconds (max 60) for the job to finish.
+    """
+    job = await JOB_QUEUE.wait(job_id, timeout=min(max(wait, 0.0), 60.0))
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job '{job_id}'")
+    return job
+
+
+@app.post("/process_expense/stream")
+async def process_expense_stream(data: ExpenseRequest):
+    """
+    Server-sent events variant of /process_expense: emits plan, critique, each step result
+    and the summary as they become available instead of waiting for the whole audit.
+    """
+    if _missing_api_key():
+        return {"error": "GEMINI_API_KEY not found. Check your .env file."}
+
+    async def event_stream():
+        async for event, payload in stream_auditor(data.user_id, data.expense_text):
+            yield f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.post("/process_expenses")
+def process_expenses(data: ExpenseBatchRequest, timings: bool = False):
+    """Endpoint to audit a whole expense report with one planner/judge round-trip."""
+    if _missing_api_key():
+        return {"error": "GEMINI_API_KEY not found. Check your .env file."}
+
+    # Sync handler: FastAPI runs it in the threadpool, keeping the event loop free
+    report = run_auditor_batch(data.user_id, data.expense_items, timings=timings)
+
+    return report
+
+
+@app.post("/import_statement")
+async def import_statement_endpoint(request: Request, format: str = "csv", user_id: Optional[str] = None,
+                                    import_id: Optional[str] = None, restart: bool = False):
+    """
+    Bulk-imports a card statement sent as the raw request body (CSV or JSONL, see
+    agent.statement_import). Re-posting with the same `import_id` resumes an interrupted import.
+    """
+    if format not in FORMATS:
+        raise HTTPException(status_code=422, detail=f"format must be one of {FORMATS}")
+
+    # Spooled to disk past 8 MB, so large statements never sit in memory
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as body:
+        async for chunk in request.stream():
+            body.write(chunk)
+        body.seek(0)
+        with io.TextIOWrapper(body, encoding="utf-8-sig", newline="") as text:
+            # The import blocks on the DB writer and Gemini, so it runs in the threadpool
+            return await run_in_threadpool(
+                import_statement, text, format, user_id=user_id, import_id=import_id, restart=restart,
+                vendor_index=VENDOR_INDEX
+            )
+
+
+@app.get("/budgets/{user_id}")
+def read_budgets(user_id: str):
+    """
+    Where a user stands in every category they have a budget for or spent in. Served from
+    the budget status cache (agent.budget_cache), so dashboards can poll it cheaply.
+    """
+    return {"user_id": user_id, "budgets": _budget_statuses_core(user_id)}
+
+
+@app.get("/budgets/{user_id}/{category}")
+def read_budget(user_id: str, category: str):
+    """Limit, spend in the current window and status of one category (cached like /budgets)."""
+    return {"user_id": user_id, **_check_budget_core(user_id, category)}
+
+
+@app.put("/budgets/{user_id}/{category}")
+def update_budget(user_id: str, category: str, data: BudgetUpdate):
+    """Sets the user's budget (one per user for now) and returns the resulting status."""
+    try:
+        status = _set_budget_core(user_id, category, data.limit, data.period)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"user_id": user_id, **status}
+
+
+@app.get("/metrics")
+def read_metrics():
+    """Prometheus scrape endpoint: per-phase latency, token, DB, cache and error metrics."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
@@ -43,4 +43,85 @@ PLAN_SCHEMA = {
         }
     },
     "required": ["critique", "plan_steps"]
-}
\ No newline at end of file
+}
+
+# Multi-expense variant: one plan covers every line item of an expense report.
+# Log steps carry the line item they came from; budget checks are deduplicated per category.
+BATCH_PLAN_STEP_SCHEMA = {
+    **PLAN_STEP_SCHEMA,
+    "properties": {
+        **PLAN_STEP_SCHEMA["properties"],
+        "line_item": {
+            "type": "integer",
+            "description": "The 1-based number of the expense line this 'log_expense_tool' step records. Omit for budget checks."
+        }
+    }
+}
+
+BATCH_PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "critique": PLAN_SCHEMA["properties"]["critique"],
+        "plan_steps": {
+            "type": "array",
+            "description": (
+                "One 'log_expense_tool' step per expense line, followed by exactly one "
+                "'check_budget_tool' step per distinct category that was logged."
+            ),
+            "items": BATCH_PLAN_STEP_SCHEMA,
+            "minItems": 1
+        }
+    },
+    "required": ["critique", "plan_steps"]
+}
+
+# Cross-request variant: one call plans (or judges) several independent requests at once.
+# Each entry is a regular PLAN_SCHEMA object tagged with the request it answers.
+COALESCED_PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "plans": {
+            "type": "array",
+            "description": "Exactly one entry per numbered request.",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "request_number": {
+                        "type": "integer",
+                        "description": "The number of the request this plan answers."
+                    },
+                    **PLAN_SCHEMA["properties"]
+                },
+                "required": ["request_number", "critique", "plan_steps"]
+            },
+            "minItems": 1
+        }
+    },
+    "required": ["plans"]
+}
+
+# Statement import: categories for rows the local rules could not resolve (agent.statement_import)
+CATEGORY_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "categories": {
+            "type": "array",
+            "description": "Exactly one entry per numbered row.",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "row": {
+                        "type": "integer",
+                        "description": "The number of the row this category is for."
+                    },
+                    "category": {
+                        "type": "string",
+                        "description": "The spending category (e.g., 'Hardware', 'Meals')."
+                    }
+                },
+                "required": ["row", "category"]
+            }
+        }
+    },
+    "required": ["categories"]
+}
@@ -0,0 +1,81 @@
+# tests/test_anomaly_scan.py
+from datetime import datetime, timedelta, timezone
+
+from sqlmodel import Session, select
+
+from agent.anomaly_scan import scan_expenses
+from agent.db import Expense, get_db_engine
+
+START = datetime(2026, 10, 1, 9, 0, tzinfo=timezone.utc)
+DINERS = ("Bistro", "Cafe Luna", "Grill House", "Deli Corner", "Noodle Bar", "Taqueria")
+
+
+def seed(engine, rows):
+    with Session(engine) as session:
+        for day, (user_id, vendor, amount, category) in enumerate(rows):
+            session.add(Expense(user_id=user_id, vendor=vendor, amount=amount, category=category,
+                                created_at=START + timedelta(days=day)))
+        session.commit()
+
+
+def flagged(engine):
+    with Session(engine) as session:
+        return sorted((e.user_id, e.vendor, e.amount) for e in session.exec(select(Expense).where(Expense.is_flagged == True)))  # noqa: E712
+
+
+def varied_meals(user_id):
+    return [(user_id, vendor, 20.0 + n, "Meals") for n, vendor in enumerate(DINERS)]
+
+
+def test_flags_outliers_and_leaves_normal_spend_alone():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    seed(engine, varied_meals("U1") + [("U1", "Steakhouse", 400.0, "Meals")] + varied_meals("U2"))
+
+    report = scan_expenses(engine, chunk_rows=7)
+
+    assert flagged(engine) == [("U1", "Steakhouse", 400.0)]
+    assert report["reasons"]["outlier"] == 1 and report["partitions"] == 2
+
+
+def test_flags_duplicate_charges_within_the_window_only():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    with Session(engine) as session:
+        for minutes in (0, 5, 60 * 48):
+            session.add(Expense(user_id="U1", vendor="Best Buy #12", amount=520.0, category="Hardware",
+                                created_at=START + timedelta(minutes=minutes)))
+        session.add(Expense(user_id="U1", vendor="BestBuy Inc.", amount=520.0, category="Hardware",
+                            created_at=START + timedelta(minutes=10)))
+        session.add(Expense(user_id="U2", vendor="Best Buy", amount=520.0, category="Hardware", created_at=START))
+        session.commit()
+
+    report = scan_expenses(engine, vendor_share=1.1)
+
+    # The 5- and 10-minute repeats (the vendor normalizes to the same name); not the one two days later
+    assert report["reasons"]["duplicate"] == 2
+    assert flagged(engine) == [("U1", "Best Buy #12", 520.0), ("U1", "BestBuy Inc.", 520.0)]
+
+
+def test_flags_spend_concentrated_on_one_vendor():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    seed(engine, [("U1", "Acme Supply", 100.0 + n, "Office Supplies") for n in range(5)] + [("U1", "Diner", 10.0, "Meals")])
+
+    report = scan_expenses(engine)
+
+    assert report["reasons"]["concentration"] == 5
+    assert all(vendor == "Acme Supply" for _, vendor, _ in flagged(engine))
+
+
+def test_rescan_replaces_stale_flags_and_dry_run_writes_nothing():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    seed(engine, varied_meals("U1") + [("U1", "Steakhouse", 400.0, "Meals")])
+    scan_expenses(engine)
+
+    with Session(engine) as session:
+        steak = session.exec(select(Expense).where(Expense.vendor == "Steakhouse")).one()
+        steak.amount = 24.0
+        session.add(steak)
+        session.commit()
+
+    assert scan_expenses(engine, dry_run=True)["flagged"] == 0 and len(flagged(engine)) == 1
+    report = scan_expenses(engine)
+    assert (report["flagged"], report["previously_flagged"]) == (0, 1) and flagged(engine) == []
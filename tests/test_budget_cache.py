@@ -0,0 +1,92 @@
+# tests/test_budget_cache.py
+from agent.budget_cache import BUDGET_CACHE, BudgetCache, BudgetEntry, budget_scope
+from agent.db import get_db_engine, Budget, Session
+from agent.executor import execute_plan
+from agent.tools import (
+    _budget_statuses_core, _check_budget_core, _check_budget_in_session, _log_expense_core,
+    _log_expense_in_session, _set_budget_core,
+)
+
+
+def seeded_engine(limit=100.0):
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    with Session(engine) as session:
+        session.add(Budget(user_id="U1", limit=limit, category="Meals"))
+        session.commit()
+    return engine
+
+
+def hits():
+    return BUDGET_CACHE.stats()["hits"]
+
+
+def test_repeated_checks_are_served_from_the_cache_until_a_write_commits():
+    engine = seeded_engine()
+    _log_expense_core("U1", "Joe's Diner", 30.0, "Meals", db_engine=engine)
+
+    before = hits()
+    assert _check_budget_core("U1", "Meals", db_engine=engine)["total_spent"] == 30.0
+    assert _check_budget_core("U1", "Meals", db_engine=engine)["total_spent"] == 30.0
+    assert hits() == before + 1
+
+    _log_expense_core("U1", "Joe's Diner", 80.0, "Meals", db_engine=engine)
+    status = _check_budget_core("U1", "Meals", db_engine=engine)
+    assert (status["total_spent"], status["status"]) == (110.0, "OVER BUDGET")
+
+
+def test_uncommitted_writes_are_read_but_never_cached():
+    engine = seeded_engine()
+    _check_budget_core("U1", "Meals", db_engine=engine)  # Cached at 0.0
+
+    with Session(engine) as session:
+        _log_expense_in_session(session, "U1", "Joe's Diner", 30.0, "Meals")
+        assert _check_budget_in_session(session, "U1", "Meals")["total_spent"] == 30.0
+        session.rollback()
+
+    assert _check_budget_core("U1", "Meals", db_engine=engine)["total_spent"] == 0.0
+
+
+def test_plans_reuse_the_cache_and_see_their_own_expenses():
+    engine = seeded_engine()
+    check = {"tool_name": "check_budget_tool", "arguments": {"category": "Meals"}}
+    log = {"tool_name": "log_expense_tool", "arguments": {"vendor": "Joe's Diner", "amount": 30.0, "category": "Meals"}}
+
+    execute_plan([check], "U1", engine)
+    before = hits()
+    history = execute_plan([check, log, check], "U1", engine)
+
+    assert [step["result"]["total_spent"] for step in (history[0], history[2])] == [0.0, 30.0]
+    assert hits() == before + 1  # The check after the log read the session's uncommitted row
+
+
+def test_budget_updates_and_the_user_listing():
+    engine = seeded_engine()
+    _log_expense_core("U1", "BestBuy", 250.0, "Hardware", db_engine=engine)
+    assert [s["category"] for s in _budget_statuses_core("U1", db_engine=engine)] == ["Hardware", "Meals"]
+
+    status = _set_budget_core("U1", "Hardware", 200.0, "month", db_engine=engine)
+    assert (status["limit"], status["status"]) == (200.0, "OVER BUDGET")
+    listing = {s["category"]: s["limit"] for s in _budget_statuses_core("U1", db_engine=engine)}
+    assert listing == {"Hardware": 200.0}  # The user's only budget moved off Meals, which has no spend
+
+
+def test_fills_racing_a_commit_are_dropped_and_size_is_bounded():
+    cache = BudgetCache(max_users=2)
+    engine = seeded_engine()
+    entry = BudgetEntry(limit=100.0, budget_period="all", period="all", total_spent=0.0)
+
+    with Session(engine) as session:
+        _, token = cache.lookup(session, "U1", "Meals")
+        cache.invalidate("other.db", "U1")  # Commits to other databases do not matter
+        cache.store(session, "U1", "Meals", token, entry)
+        assert cache.lookup(session, "U1", "Meals")[0] == entry
+
+        _, token = cache.lookup(session, "U2", "Meals")
+        cache.invalidate(budget_scope(session), "U2")  # A commit for U2 landed mid-read
+        cache.store(session, "U2", "Meals", token, entry)
+        assert cache.lookup(session, "U2", "Meals")[0] is None
+
+        for user_id in ("U2", "U3"):
+            cache.store(session, user_id, "Meals", cache.lookup(session, user_id, "Meals")[1], entry)
+        assert cache.lookup(session, "U1", "Meals")[0] is None and cache.lookup(session, "U3", "Meals")[0] == entry
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,149 @@
+# tests/test_coalescer.py
+import gc
+import json
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from agent import metrics
+from agent import coalescer as coalescer_module
+from agent.coalescer import LLMCoalescer, get_coalescer
+from agent.fake_llm import FakeGeminiClient
+from agent.llm_scheduler import current_lane, llm_lane
+from agent.planner import run_planner_auditor
+
+
+def test_concurrent_plans_share_one_planner_call():
+    client = FakeGeminiClient()
+    coalescer = LLMCoalescer(client, window_ms=100, max_batch=8)
+    requests = [(f"U{i}", f"Spent {10 + i} bucks on a taxi ride downtown") for i in range(5)]
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        results = list(pool.map(
+            lambda item: run_planner_auditor(client, item[0], item[1], [], fast_path=False, coalescer=coalescer),
+            requests
+        ))
+
+    assert client.stats()["calls"]["planner"] == 1
+    for (user_id, _), result in zip(requests, results):
+        log_step = result['plan_steps'][0]
+        assert log_step['arguments']['user_id'] == user_id
+        assert log_step['arguments']['category'] == "Travel"
+    assert results[3]['plan_steps'][0]['arguments']['amount'] == 13.0
+    coalescer.close()
+
+
+def judged_requests(count):
+    requests = [(f"U{i}", f"Spent {10 + i} bucks on a taxi ride downtown") for i in range(count)]
+    plans = [json.dumps({"critique": "", "plan_steps": [
+        {"step_number": 1, "tool_name": "log_expense_tool",
+         "arguments": {"user_id": user_id, "vendor": "City Cab", "amount": 10.0 + i, "category": "Travel"}},
+        {"step_number": 2, "tool_name": "check_budget_tool", "arguments": {"user_id": user_id, "category": "Travel"}},
+    ]}) for i, (user_id, _) in enumerate(requests)]
+    return requests, plans
+
+
+def test_judge_calls_are_coalesced_and_routed_back():
+    client = FakeGeminiClient()
+    coalescer = LLMCoalescer(client, window_ms=100, max_batch=8)
+    requests, plans = judged_requests(3)
+
+    futures = [coalescer.judge(user_id, text, plan) for (user_id, text), plan in zip(requests, plans)]
+    judged = [json.loads(f.result()) for f in futures]
+
+    assert client.stats()["calls"]["judge"] == 1
+    assert [j['plan_steps'][0]['arguments']['user_id'] for j in judged] == ["U0", "U1", "U2"]
+    coalescer.close()
+
+
+def test_judged_plans_routed_to_the_wrong_request_are_rejected():
+    client = FakeGeminiClient()
+    generate = client.models.generate_content
+
+    def swapped(**request):  # A response that mixes up request numbers 1 and 2
+        body = json.loads(generate(**request).text)
+        for entry in body["plans"]:
+            entry["request_number"] = 3 - entry["request_number"]
+        return SimpleNamespace(text=json.dumps(body), usage_metadata=None)
+
+    client.models.generate_content = swapped
+    coalescer = LLMCoalescer(client, window_ms=100, max_batch=8)
+    requests, plans = judged_requests(2)
+
+    futures = [coalescer.judge(user_id, text, plan) for (user_id, text), plan in zip(requests, plans)]
+    for future in futures:
+        assert "does not appear in the request" in str(future.exception())
+    coalescer.close()
+
+
+def test_multi_expense_requests_keep_their_judged_plans():
+    client = FakeGeminiClient()
+    coalescer = LLMCoalescer(client, window_ms=100, max_batch=8)
+    requests, plans = judged_requests(2)
+    requests[1] = ("U1", "Spent 11 on a taxi and 30 on lunch at Joe's Diner")
+    plan = json.loads(plans[1])
+    plan["plan_steps"].insert(1, {"step_number": 2, "tool_name": "log_expense_tool",
+                                  "arguments": {"user_id": "U1", "vendor": "Joe's Diner", "amount": 30.0, "category": "Meals"}})
+    plans[1] = json.dumps(plan)
+
+    futures = [coalescer.judge(user_id, text, plan) for (user_id, text), plan in zip(requests, plans)]
+    judged = [json.loads(f.result()) for f in futures]
+
+    assert client.stats()["calls"]["judge"] == 1
+    assert [step["arguments"]["amount"] for step in judged[1]["plan_steps"] if step["tool_name"] == "log_expense_tool"] == [11.0, 30.0]
+    # A lone call (sent as a single request) gets the same check
+    lone = coalescer.judge("U0", "Spent 10 bucks on a taxi ride downtown", plans[1])
+    assert "does not appear in the request" in str(lone.exception())
+    coalescer.close()
+
+
+def test_coalesced_calls_keep_each_callers_lane_and_timings():
+    client = FakeGeminiClient()
+    lanes = []
+    generate = client.models.generate_content
+    client.models.generate_content = lambda **request: lanes.append(current_lane()) or generate(**request)
+    coalescer = LLMCoalescer(client, window_ms=100, max_batch=8)
+
+    def audit(i):
+        with llm_lane("batch" if i == 2 else "backfill"), metrics.track_request() as timings:
+            run_planner_auditor(client, f"U{i}", f"Spent {10 + i} bucks on a taxi ride downtown", [],
+                                fast_path=False, coalescer=coalescer)
+        return timings
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        timings = list(pool.map(audit, range(3)))
+
+    assert lanes == ["batch"]  # One shared call, in its most urgent caller's lane (not the pool thread's default)
+    assert all(t.tokens["planner"]["prompt"] > 0 for t in timings)
+    coalescer.close()
+
+
+def test_failed_batched_call_fails_every_caller():
+    client = FakeGeminiClient(error_rate=1.0)
+    coalescer = LLMCoalescer(client, window_ms=100, max_batch=8)
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        results = list(pool.map(
+            lambda i: run_planner_auditor(client, f"U{i}", "Spent 5 bucks on coffee", [], fast_path=False, coalescer=coalescer),
+            range(3)
+        ))
+
+    assert client.stats()["calls"]["planner"] == 1
+    assert all(result['plan_steps'] == [] for result in results)
+    assert all("Audit aborted" in result['final_report'] for result in results)
+    coalescer.close()
+
+
+def test_shared_coalescers_are_collected_with_their_client(monkeypatch):
+    monkeypatch.setattr(coalescer_module, "LLM_COALESCE_WINDOW_MS", 50)
+    client = FakeGeminiClient()
+    coalescer = get_coalescer(client)
+    assert get_coalescer(client) is coalescer and get_coalescer(FakeGeminiClient()) is not coalescer
+    lane_thread = coalescer._planner.thread
+
+    collected = weakref.ref(client)
+    del client, coalescer
+    gc.collect()
+    assert collected() is None  # Neither the registry nor the lane threads keep the client alive
+    lane_thread.join(1)
+    assert not lane_thread.is_alive()
@@ -0,0 +1,69 @@
+# tests/test_executor.py
+from sqlmodel import select
+
+from agent.db import get_db_engine, Expense, Session
+from agent.executor import execute_batch_plan, execute_plan
+
+
+def log_step(n, line_item, vendor, amount, category):
+    return {
+        "step_number": n, "tool_name": "log_expense_tool", "line_item": line_item,
+        "arguments": {"user_id": "U1", "vendor": vendor, "amount": amount, "category": category},
+    }
+
+
+def check_step(n, category):
+    return {"step_number": n, "tool_name": "check_budget_tool", "arguments": {"user_id": "U1", "category": category}}
+
+
+def test_batch_plan_logs_all_rows_and_checks_each_category_once():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    steps = [
+        log_step(1, 1, "Cafe Central", 12.0, "Meals"),
+        log_step(2, 2, "BestBuy", 99.0, "Hardware"),
+        log_step(3, 3, "Diner", 8.0, "Meals"),
+        check_step(4, "Meals"),
+        check_step(5, "Hardware"),
+        check_step(6, "Meals"),  # duplicate, dropped
+    ]
+
+    history = execute_batch_plan(steps, "U1", db_engine=engine)
+
+    assert [h["tool_name"] for h in history] == ["log_expense_tool"] * 3 + ["check_budget_tool"] * 2
+    assert all(h["status"] == "SUCCESS" for h in history)
+    assert history[3]["result"]["total_spent"] == 20.0
+    with Session(engine) as session:
+        assert len(session.exec(select(Expense)).all()) == 3
+
+
+def test_batch_plan_insert_is_all_or_nothing():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    steps = [
+        log_step(1, 1, "Cafe Central", 12.0, "Meals"),
+        {"step_number": 2, "tool_name": "log_expense_tool", "arguments": {"user_id": "U1", "amount": 5.0}},
+    ]
+
+    history = execute_batch_plan(steps, "U1", db_engine=engine)
+
+    assert all(h["status"] == "FAILED" for h in history)
+    with Session(engine) as session:
+        assert session.exec(select(Expense)).all() == []
+
+
+def test_mixed_category_plan_keeps_plan_order_and_per_category_totals():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    steps = [
+        log_step(1, None, "Cafe Central", 12.0, "Meals"),
+        log_step(2, None, "BestBuy", 99.0, "Hardware"),
+        {"step_number": 3, "tool_name": "log_expense_tool", "arguments": {"user_id": "U1", "amount": 5.0, "category": "Travel"}},
+        log_step(4, None, "Diner", 8.0, "Meals"),
+        check_step(5, "Hardware"),
+        check_step(6, "Meals"),
+    ]
+
+    history = execute_plan(steps, "U1", db_engine=engine)
+
+    assert [h["tool_name"] for h in history] == [s["tool_name"] for s in steps]
+    assert [h["status"] for h in history] == ["SUCCESS", "SUCCESS", "FAILED", "SUCCESS", "SUCCESS", "SUCCESS"]
+    assert history[4]["result"]["total_spent"] == 99.0
+    assert history[5]["result"]["total_spent"] == 20.0
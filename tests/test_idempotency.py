@@ -0,0 +1,154 @@
+# tests/test_idempotency.py
+import asyncio
+
+import pytest
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from agent.db import get_db_engine, get_async_db_engine, init_async_db, Budget, Expense, IdempotencyRecord
+from agent.fake_llm import FakeGeminiClient
+from agent.idempotency import IdempotencyConflict, IdempotencyStore, idempotency_key, request_fingerprint
+from agent.main import run_auditor_async
+
+
+class CountingAudit:
+    """Stands in for run_auditor_async: counts executions and can be told to fail."""
+    def __init__(self, result=None, delay=0.0):
+        self.calls = 0
+        self.result = result if result is not None else {"final_report": "ok", "full_history": [{"status": "SUCCESS"}]}
+        self.delay = delay
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.result
+
+
+def test_keys_prefer_the_header_and_only_use_the_text_when_a_window_is_set():
+    assert idempotency_key("U1", "Lunch $12", "abc") == idempotency_key("U1", "Dinner $30", "abc")
+    assert idempotency_key("U1", "Lunch $12", "abc") != idempotency_key("U2", "Lunch $12", "abc")
+    assert idempotency_key("a", "Lunch $12", "b:c") != idempotency_key("a:b", "Lunch $12", "c")  # Parts are hashed
+    assert idempotency_key("U1", "Lunch $12") is None  # Two identical purchases are two expenses
+    assert idempotency_key("U1", "Lunch  $12", window_seconds=120) == idempotency_key("U1", "lunch $12", window_seconds=120)
+    assert idempotency_key("U1", "Lunch $12", window_seconds=120) != idempotency_key("U2", "Lunch $12", window_seconds=120)
+
+
+def test_text_keys_slide_with_the_last_claim():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    store = IdempotencyStore(db_engine=engine, window_seconds=120)
+    key = idempotency_key("U1", "Lunch $12", window_seconds=120)
+    audit = CountingAudit()
+
+    def age_claim(seconds):
+        with Session(engine) as session:
+            record = session.get(IdempotencyRecord, key)
+            record.created_at -= seconds
+            session.add(record)
+            session.commit()
+
+    asyncio.run(store.run(key, "U1", audit))
+    age_claim(100)
+    assert asyncio.run(store.run(key, "U1", audit))[1] is True  # A retry 100s later
+    age_claim(30)
+    assert asyncio.run(store.run(key, "U1", audit))[1] is False  # The same text 130s later is a new purchase
+    age_claim(100)
+    assert asyncio.run(store.run(key, "U1", audit))[1] is True  # Measured from the newest claim
+    assert audit.calls == 2
+
+
+def test_concurrent_retries_join_the_first_execution():
+    store = IdempotencyStore(db_engine=get_db_engine(engine_url="sqlite:///:memory:"))
+    audit = CountingAudit(delay=0.05)
+
+    async def scenario():
+        return await asyncio.gather(*(store.run("key:U1:a", "U1", audit) for _ in range(3)))
+
+    results = asyncio.run(scenario())
+    assert audit.calls == 1
+    assert [replayed for _, replayed in results] == [False, True, True]
+    assert all(result == audit.result for result, _ in results)
+
+
+def test_finished_results_are_replayed_from_the_store_until_they_expire():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    audit = CountingAudit()
+
+    first = asyncio.run(IdempotencyStore(db_engine=engine).run("key:U1:a", "U1", audit))
+    # A new store on the same database (e.g. after a restart) still knows the result
+    replay = asyncio.run(IdempotencyStore(db_engine=engine).run("key:U1:a", "U1", audit))
+    assert audit.calls == 1 and replay == (first[0], True)
+
+    expired = asyncio.run(IdempotencyStore(db_engine=engine, ttl_seconds=-1).run("key:U1:b", "U1", audit))
+    asyncio.run(IdempotencyStore(db_engine=engine).run("key:U1:b", "U1", audit))
+    assert expired[1] is False and audit.calls == 3
+
+
+def test_long_executions_keep_their_claim(tmp_path):
+    engine = get_db_engine(engine_url=f"sqlite:///{tmp_path}/idempotency.db")
+    audit = CountingAudit(delay=0.6)
+
+    async def scenario():
+        first = asyncio.ensure_future(IdempotencyStore(db_engine=engine, lock_timeout=0.2).run("key:U1:a", "U1", audit))
+        await asyncio.sleep(0.4)  # Past the lock timeout, but the claim was renewed
+        # Another worker process retrying the same request
+        retry = await IdempotencyStore(db_engine=engine, lock_timeout=0.2).run("key:U1:a", "U1", audit)
+        return await first, retry
+
+    first, retry = asyncio.run(scenario())
+    assert audit.calls == 1 and retry == (first[0], True)
+
+
+def test_a_key_reused_for_a_different_request_is_refused():
+    store = IdempotencyStore(db_engine=get_db_engine(engine_url="sqlite:///:memory:"))
+    key = idempotency_key("U1", "Lunch $12", "abc")
+    audit = CountingAudit(delay=0.05)
+
+    async def scenario():
+        first = asyncio.ensure_future(store.run(key, "U1", audit, request_fingerprint("U1", "Lunch $12")))
+        await asyncio.sleep(0)
+        joined = await asyncio.gather(store.run(key, "U1", audit, request_fingerprint("U1", "Dinner $30")),
+                                      return_exceptions=True)
+        return await first, joined[0]
+
+    first, joined = asyncio.run(scenario())
+    assert first[1] is False and isinstance(joined, IdempotencyConflict)
+    with pytest.raises(IdempotencyConflict):  # The stored result is not replayed for another body
+        asyncio.run(store.run(key, "U1", audit, request_fingerprint("U1", "Dinner $30")))
+    assert asyncio.run(store.run(key, "U1", audit, request_fingerprint("U1", "Lunch $12")))[1] is True
+    assert audit.calls == 1
+
+
+def test_failures_before_execution_are_not_stored():
+    store = IdempotencyStore(db_engine=get_db_engine(engine_url="sqlite:///:memory:"))
+    aborted = CountingAudit(result={"final_report": "Audit aborted: 429", "plan_steps": [], "final_plan": {}})
+
+    asyncio.run(store.run("key:U1:a", "U1", aborted))
+    asyncio.run(store.run("key:U1:a", "U1", aborted))
+    assert aborted.calls == 2
+
+
+def test_retried_audit_logs_the_expense_once():
+    async def scenario():
+        audit_engine = get_async_db_engine(engine_url="sqlite+aiosqlite:///:memory:")
+        await init_async_db(audit_engine)
+        async with AsyncSession(audit_engine) as session:
+            session.add(Budget(user_id="U1", limit=500.0, category="Hardware"))
+            await session.commit()
+
+        store = IdempotencyStore(db_engine=get_db_engine(engine_url="sqlite:///:memory:"))
+        text = "I just put $520.00 on my card at BestBuy for a new monitor."
+        key = idempotency_key("U1", text, "retry-1")
+        client = FakeGeminiClient(latency=0.02)
+
+        def audit():
+            return run_auditor_async("U1", text, test_engine=audit_engine, client=client)
+
+        reports = await asyncio.gather(store.run(key, "U1", audit), store.run(key, "U1", audit))
+        async with AsyncSession(audit_engine) as session:
+            expenses = (await session.exec(select(Expense))).all()
+        await audit_engine.dispose()
+        return reports, expenses
+
+    reports, expenses = asyncio.run(scenario())
+    assert len(expenses) == 1
+    assert reports[0][0]["final_report"] == reports[1][0]["final_report"]
@@ -0,0 +1,144 @@
+# tests/test_job_queue.py
+import asyncio
+import threading
+import time
+
+import pytest
+from sqlmodel import Session, select
+
+from agent.db import AuditJob, get_db_engine
+from agent.idempotency import IdempotencyConflict
+from agent.job_queue import JobQueue, JobWorkerPool, QueueFull
+
+
+def make_queue(tmp_path, **kwargs):
+    # A file database: workers claim from several threads at once, which a single shared
+    # in-memory connection cannot serve
+    return JobQueue(db_engine=get_db_engine(engine_url=f"sqlite:///{tmp_path / 'jobs.db'}"), **kwargs)
+
+
+class RecordingRunner:
+    """Stands in for run_queued_audit: records the order jobs start in and can fail."""
+    def __init__(self, delay=0.02, failures=0, result=None):
+        self.delay = delay
+        self.failures = failures
+        self.result = result
+        self.started = []
+        self.running_users = set()
+        self.overlaps = 0
+
+    async def __call__(self, job):
+        self.started.append(job.expense_text)
+        if job.user_id in self.running_users:
+            self.overlaps += 1
+        self.running_users.add(job.user_id)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("Gemini 503")
+            return self.result or {"final_report": f"ok: {job.expense_text}", "full_history": [{"status": "SUCCESS"}]}
+        finally:
+            self.running_users.discard(job.user_id)
+
+
+def run_pool(queue, runner, job_ids, workers=4):
+    async def scenario():
+        pool = JobWorkerPool(queue, workers=workers, runner=runner)
+        pool.start()
+        try:
+            return await asyncio.gather(*(queue.wait(job_id, timeout=5) for job_id in job_ids))
+        finally:
+            await pool.stop()
+    return asyncio.run(scenario())
+
+
+def test_jobs_run_in_the_background_and_long_polls_get_the_result(tmp_path):
+    queue = make_queue(tmp_path)
+    job = queue.submit("U1", "Lunch $12")
+    assert job["status"] == "queued"
+
+    [finished] = run_pool(queue, RecordingRunner(), [job["job_id"]])
+    assert finished["status"] == "done" and finished["result"]["final_report"] == "ok: Lunch $12"
+    assert queue.get("missing") is None
+
+
+def test_each_users_jobs_run_one_at_a_time_in_submission_order(tmp_path):
+    queue = make_queue(tmp_path)
+    runner = RecordingRunner()
+    ids = [queue.submit(user, f"{user} expense {n}")["job_id"] for n in range(3) for user in ("U1", "U2")]
+
+    results = run_pool(queue, runner, ids, workers=4)
+
+    assert all(result["status"] == "done" for result in results)
+    assert runner.overlaps == 0
+    assert [text for text in runner.started if text.startswith("U1")] == ["U1 expense 0", "U1 expense 1", "U1 expense 2"]
+
+
+def test_backpressure_and_idempotent_submission(tmp_path):
+    queue = make_queue(tmp_path, max_pending=3, max_per_user=2)
+    first = queue.submit("U1", "a", idempotency_key="key:U1:a")
+    assert queue.submit("U1", "a", idempotency_key="key:U1:a")["job_id"] == first["job_id"]
+    with pytest.raises(IdempotencyConflict):
+        queue.submit("U1", "a different expense", idempotency_key="key:U1:a")
+    queue.submit("U1", "b")
+
+    with pytest.raises(QueueFull):
+        queue.submit("U1", "c")  # Per-user limit
+    queue.submit("U2", "d")
+    with pytest.raises(QueueFull) as full:
+        queue.submit("U3", "e")  # Global limit
+    assert full.value.retry_after > 0
+
+
+def test_concurrent_submissions_cannot_overshoot_the_limits(tmp_path):
+    url = f"sqlite:///{tmp_path / 'jobs.db'}"
+    queues = [JobQueue(db_engine=get_db_engine(engine_url=url), max_per_user=2) for _ in range(8)]  # One per process
+    start, accepted, refused = threading.Barrier(len(queues)), [], []
+
+    def submit(queue, n):
+        start.wait()
+        try:
+            accepted.append(queue.submit("U1", f"expense {n}"))
+        except QueueFull:
+            refused.append(n)
+
+    threads = [threading.Thread(target=submit, args=(queue, n)) for n, queue in enumerate(queues)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (len(accepted), len(refused)) == (2, 6)
+
+
+def test_failed_attempts_are_retried_then_reported(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    job = queue.submit("U1", "Lunch $12")
+
+    import agent.job_queue as job_queue
+    backoff, job_queue.RETRY_BACKOFF_SECONDS = job_queue.RETRY_BACKOFF_SECONDS, 0.0
+    try:
+        [recovered] = run_pool(queue, RecordingRunner(failures=1), [job["job_id"]])
+        assert (recovered["status"], recovered["attempts"]) == ("done", 2)
+
+        job = queue.submit("U1", "Dinner $30")
+        [failed] = run_pool(queue, RecordingRunner(failures=2), [job["job_id"]])
+        assert failed["status"] == "failed" and "Gemini 503" in failed["error"]
+    finally:
+        job_queue.RETRY_BACKOFF_SECONDS = backoff
+
+
+def test_jobs_of_a_crashed_worker_are_requeued_when_the_lease_expires(tmp_path):
+    queue = make_queue(tmp_path, lease_seconds=60)
+    job = queue.submit("U1", "Lunch $12")
+    assert queue.claim("dead-worker").job_id == job["job_id"]
+    assert queue.claim("other-worker") is None  # Leased, and U1's later jobs must wait
+
+    with Session(queue.db_engine) as session:
+        row = session.exec(select(AuditJob)).one()
+        row.lease_expires_at = time.time() - 1  # The dead worker never renewed it
+        session.add(row)
+        session.commit()
+
+    reclaimed = queue.claim("other-worker")
+    assert (reclaimed.job_id, reclaimed.attempts) == (job["job_id"], 2)
@@ -0,0 +1,104 @@
+# tests/test_llm_scheduler.py
+import asyncio
+import gc
+import threading
+import time
+import weakref
+
+import pytest
+from google.genai import errors
+
+from agent.fake_llm import FakeGeminiClient
+from agent.llm_scheduler import LLMScheduler, get_scheduled_client, llm_lane
+
+
+def quota_error(code=429):
+    return errors.ClientError(code, {"error": {"code": code, "message": "Quota exhausted.", "status": "RESOURCE_EXHAUSTED"}})
+
+
+def test_rate_limited_calls_are_retried_with_backoff():
+    scheduler = LLMScheduler(limits={}, max_retries=3, backoff_base=0.001, seed=0)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise quota_error()
+        return "ok"
+
+    assert scheduler.call("model", 10, flaky) == "ok"
+    assert scheduler.stats()["interactive"]["retries"] == 2
+
+
+def test_exhausted_retries_and_client_errors_propagate():
+    scheduler = LLMScheduler(limits={}, max_retries=2, backoff_base=0.001)
+
+    def always_429():
+        raise quota_error()
+
+    def bad_request():
+        raise quota_error(400)
+
+    with pytest.raises(errors.ClientError):
+        scheduler.call("model", 10, always_429)
+    with pytest.raises(errors.ClientError):
+        scheduler.call("model", 10, bad_request)
+    assert scheduler.stats()["interactive"]["retries"] == 2
+    assert scheduler.stats()["interactive"]["failures"] == 2
+
+
+def test_interactive_lane_overtakes_queued_backfill_work():
+    scheduler = LLMScheduler(limits={"model": (600, 0)})  # 10 requests/second once the burst is spent
+    requests_bucket, _ = scheduler._buckets_for("model")
+    requests_bucket.take(requests_bucket.capacity)
+    order = []
+
+    def run(lane):
+        with llm_lane(lane):
+            scheduler.call("model", 1, lambda: order.append(lane))
+
+    backfill = threading.Thread(target=run, args=("backfill",))
+    interactive = threading.Thread(target=run, args=("interactive",))
+    backfill.start()
+    time.sleep(0.02)
+    interactive.start()
+    backfill.join()
+    interactive.join()
+
+    assert order == ["interactive", "backfill"]
+    assert scheduler.stats()["backfill"]["max_wait_seconds"] > scheduler.stats()["interactive"]["max_wait_seconds"]
+
+
+def test_async_callers_wait_for_their_turn_without_polling():
+    scheduler = LLMScheduler(limits={"model": (600, 0)})
+    requests_bucket, _ = scheduler._buckets_for("model")
+    requests_bucket.take(requests_bucket.capacity)
+    admit, checks, order = scheduler._try_admit, [], []
+    scheduler._try_admit = lambda *args: checks.append(1) or admit(*args)
+
+    async def call(lane):
+        async def send():
+            order.append(lane)
+        with llm_lane(lane):
+            await scheduler.call_async("model", 1, send)
+
+    async def scenario():
+        first = asyncio.ensure_future(call("backfill"))
+        await asyncio.sleep(0.02)
+        await asyncio.gather(first, call("batch"), call("backfill"))
+
+    asyncio.run(scenario())
+    assert order == ["batch", "backfill", "backfill"]  # The batch call overtook the backfill work queued for quota
+    assert len(checks) <= 12  # One check per turn or quota wait, not one per 10ms
+
+
+def test_scheduled_clients_are_shared_per_client_and_collected_with_it():
+    client = FakeGeminiClient()
+    scheduled = get_scheduled_client(client)
+    assert get_scheduled_client(client) is scheduled and get_scheduled_client(scheduled) is scheduled
+    assert get_scheduled_client(FakeGeminiClient()) is not scheduled
+
+    collected = weakref.ref(client)
+    del client, scheduled
+    gc.collect()
+    assert collected() is None  # The registry does not keep clients alive
@@ -0,0 +1,63 @@
+# tests/test_metrics.py
+import asyncio
+
+from agent import metrics
+from agent.db import get_async_db_engine, get_db_engine, init_async_db, Budget, Session
+from agent.fake_llm import FakeGeminiClient
+from agent.main import run_auditor, run_auditor_async
+from agent.plan_cache import PLAN_CACHE
+
+
+def seeded_engine():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    with Session(engine) as session:
+        session.add(Budget(user_id="U1", limit=100.0, category="Meals"))
+        session.commit()
+    return engine
+
+
+def test_timings_block_covers_every_phase():
+    PLAN_CACHE.clear()
+    report = run_auditor("U1", "Spent 30 bucks on a team lunch at Joe's Diner",
+                         test_engine=seeded_engine(), client=FakeGeminiClient(), timings=True)
+
+    timings = report['timings']
+    assert {"planner", "execute", "summary", "total"} <= set(timings['phases_ms'])
+    assert timings['tokens']['planner']['prompt'] > 0 and timings['tokens']['planner']['response'] > 0
+    assert timings['cache'] == {"fast_path": "miss", "plan_cache": "miss", "local_judge": "hit"}
+    assert [step['tool_name'] for step in timings['steps']] == ["log_expense_tool", "check_budget_tool"]
+    assert timings['db_operations'] == 2 and timings['db_ms'] > 0
+
+
+def test_timings_are_opt_in_and_metrics_render():
+    report = run_auditor("U1", "Log $12.50 for lunch at Cafe Central under Meals.",
+                         test_engine=seeded_engine(), client=FakeGeminiClient())
+    assert "timings" not in report
+
+    exposition = metrics.render()
+    assert '# TYPE auditor_phase_seconds histogram' in exposition
+    assert 'auditor_phase_seconds_count{phase="execute"}' in exposition
+    assert 'auditor_cache_lookups_total{cache="fast_path",result="hit"}' in exposition
+
+
+def test_async_db_time_is_attributed_to_the_request():
+    async def scenario():
+        engine = get_async_db_engine(engine_url="sqlite+aiosqlite:///:memory:")
+        await init_async_db(engine)
+        return await run_auditor_async("U1", "Log $12.50 for lunch at Cafe Central under Meals.",
+                                       test_engine=engine, client=FakeGeminiClient(), timings=True)
+
+    timings = asyncio.run(scenario())['timings']
+    assert timings['db_operations'] == 2
+    assert len(timings['steps']) == 2
+
+
+def test_disabled_metrics_record_nothing(monkeypatch):
+    monkeypatch.setattr(metrics, "ENABLED", False)
+    metrics.reset()
+
+    report = run_auditor("U1", "Log $12.50 for lunch at Cafe Central under Meals.",
+                         test_engine=seeded_engine(), client=FakeGeminiClient(), timings=True)
+
+    assert "timings" not in report
+    assert "auditor_phase_seconds_count" not in metrics.render()
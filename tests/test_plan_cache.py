@@ -0,0 +1,108 @@
+# tests/test_plan_cache.py
+import asyncio
+import json
+import threading
+
+from agent.db import get_db_engine
+from agent.plan_cache import PlanCache, normalize_expense_text
+from agent.planner import run_planner_auditor
+
+
+def judged_plan(user_id, vendor, amount, category):
+    return {"critique": "Plan is valid", "plan_steps": [
+        {"step_number": 1, "tool_name": "log_expense_tool",
+         "arguments": {"user_id": user_id, "vendor": vendor, "amount": amount, "category": category}},
+        {"step_number": 2, "tool_name": "check_budget_tool",
+         "arguments": {"user_id": user_id, "category": category}},
+    ]}
+
+
+class ScriptedClient:
+    """Returns a fixed plan for every planner call and counts the calls."""
+    def __init__(self, plan):
+        self.calls = 0
+        client = self
+
+        class models:
+            @staticmethod
+            def generate_content(**kwargs):
+                client.calls += 1
+                return type("Response", (), {"text": json.dumps(plan)})()
+        self.models = models
+
+
+def test_requests_differing_in_slots_share_a_template():
+    t1, s1 = normalize_expense_text("U1", "Spent 12 on a team lunch at Joe's Diner, Meals")
+    t2, s2 = normalize_expense_text("U2", "Spent 30.5 on a team lunch at Pizza Hut, Meals")
+    assert t1 == t2
+    assert (s1["vendor"], s1["amount_0"]) == ("Joe's Diner", 12.0)
+    assert (s2["vendor"], s2["amount_0"]) == ("Pizza Hut", 30.5)
+
+
+def test_hit_refills_slots_without_llm_calls():
+    cache = PlanCache()
+    client = ScriptedClient(judged_plan("U1", "Joe's Diner", 12, "Meals"))
+    first = "Spent 12 on a team lunch at Joe's Diner"
+    second = "Spent 30 on a team lunch at Pizza Hut"
+
+    run_planner_auditor(client, "U1", first, [], fast_path=False, plan_cache=cache)
+    result = run_planner_auditor(client, "U2", second, [], fast_path=False, plan_cache=cache)
+
+    assert client.calls == 1
+    assert result['plan_steps'][0]['arguments'] == {"user_id": "U2", "vendor": "Pizza Hut", "amount": 30.0, "category": "Meals"}
+    assert cache.stats()["hits"] == 1
+
+
+def test_vendor_inferred_category_is_not_cached():
+    cache = PlanCache()
+    assert not cache.store("U1", "Put 520 on the card at BestBuy", judged_plan("U1", "BestBuy", 520, "Hardware"))
+
+
+def test_lru_and_ttl_eviction():
+    cache = PlanCache(max_size=1)
+    cache.store("U1", "Spent 12 on lunch at Diner", judged_plan("U1", "Diner", 12, "Meals"))
+    cache.store("U1", "Spent 12 on a taxi at Uber", judged_plan("U1", "Uber", 12, "Travel"))
+    assert cache.lookup("U1", "Spent 5 on lunch at Diner") is None
+    assert cache.stats()["evictions"] == 1
+
+    expired = PlanCache(ttl_seconds=-1)
+    expired.store("U1", "Spent 12 on lunch at Diner", judged_plan("U1", "Diner", 12, "Meals"))
+    assert expired.lookup("U1", "Spent 5 on lunch at Diner") is None
+
+
+def test_persisted_entries_survive_a_restart(tmp_path):
+    engine = get_db_engine(f"sqlite:///{tmp_path / 'plan_cache.db'}")
+    PlanCache(db_engine=engine).store("U1", "Spent 12 on lunch at Diner", judged_plan("U1", "Diner", 12, "Meals"))
+
+    plan = PlanCache(db_engine=engine).lookup("U9", "Spent 7 on lunch at Cafe")
+    assert plan['plan_steps'][0]['arguments'] == {"user_id": "U9", "vendor": "Cafe", "amount": 7.0, "category": "Meals"}
+
+
+def test_configured_database_is_opened_on_first_use(tmp_path):
+    path = tmp_path / "plan_cache.db"
+    cache = PlanCache(db_url=f"sqlite:///{path}")
+    assert not path.exists()  # Creating the cache (e.g. importing the module) does not touch it
+
+    cache.store("U1", "Spent 12 on lunch at Diner", judged_plan("U1", "Diner", 12, "Meals"))
+    assert path.exists()
+    assert PlanCache(db_url=f"sqlite:///{path}").lookup("U9", "Spent 7 on lunch at Cafe") is not None
+
+
+def test_async_lookups_and_stores_keep_database_io_off_the_event_loop(tmp_path):
+    cache = PlanCache(db_url=f"sqlite:///{tmp_path / 'plan_cache.db'}")
+    io_threads = []
+    for name in ("_load", "_persist"):
+        method = getattr(cache, name)
+        setattr(cache, name, lambda *args, method=method: io_threads.append(threading.current_thread()) or method(*args))
+
+    async def scenario():
+        loop_thread = threading.current_thread()
+        await cache.store_async("U1", "Spent 12 on lunch at Diner", judged_plan("U1", "Diner", 12, "Meals"))
+        cache.clear()
+        from_db = await cache.lookup_async("U9", "Spent 7 on lunch at Cafe")  # Read back from the database
+        from_memory = await cache.lookup_async("U8", "Spent 9 on lunch at Bistro")
+        return loop_thread, from_db, from_memory
+
+    loop_thread, from_db, from_memory = asyncio.run(scenario())
+    assert from_db["plan_steps"][0]["arguments"]["amount"] == 7.0 and from_memory is not None
+    assert len(io_threads) == 2 and loop_thread not in io_threads  # The in-memory hit did no I/O
@@ -0,0 +1,103 @@
+# tests/test_planner.py
+import json
+
+from agent.planner import extract_expense_fields, run_planner_auditor, validate_plan, FAST_PATH_MIN_CONFIDENCE
+
+
+class ExplodingClient:
+    """Any LLM call from the planner is a test failure."""
+    class models:
+        @staticmethod
+        def generate_content(**kwargs):
+            raise AssertionError("planner LLM should not be called")
+
+
+def load_test_cases():
+    with open('tests/test_data.json', 'r') as f:
+        return json.load(f)['tests']
+
+
+def test_extracts_explicit_category_request():
+    fields = extract_expense_fields("Log $45.50 for lunch at Cafe Central under Meals.")
+    assert fields["amount"] == 45.5
+    assert fields["vendor"] == "Cafe Central"
+    assert fields["category"] == "Meals"
+    assert fields["confidence"] == 1.0
+
+
+def test_extracts_keyword_category_request():
+    fields = extract_expense_fields("I just put $520.00 on my card at BestBuy for a new monitor for the office.")
+    assert (fields["amount"], fields["vendor"], fields["category"]) == (520.0, "BestBuy", "Hardware")
+    assert fields["confidence"] >= FAST_PATH_MIN_CONFIDENCE
+
+
+def test_ambiguous_requests_score_low():
+    assert extract_expense_fields("Paid $12 and $30 at Uber for taxi rides")["confidence"] == 0.0
+    assert extract_expense_fields("Refund the $20 from Amazon")["confidence"] == 0.0
+    assert extract_expense_fields("Spent $40 yesterday")["confidence"] < FAST_PATH_MIN_CONFIDENCE
+
+
+def test_e2e_inputs_are_planned_without_llm():
+    for case in load_test_cases():
+        result = run_planner_auditor(ExplodingClient(), case['user_id'], case['test_input']['expense_text'], [])
+        steps = result['plan_steps']
+        assert [s['tool_name'] for s in steps] == ["log_expense_tool", "check_budget_tool"]
+        assert steps[0]['arguments']['category'] == case['initial_db_state']['category']
+        assert all(s['arguments']['user_id'] == case['user_id'] for s in steps)
+
+
+# --- Local Judge ---
+
+REQUEST = "Spent 30 bucks on a team lunch at Joe's Diner"
+
+
+def planner_step(n, tool_name, **arguments):
+    return {"step_number": n, "tool_name": tool_name, "arguments": arguments}
+
+
+def test_valid_plan_passes_unchanged():
+    plan = {"critique": "", "plan_steps": [
+        planner_step(1, "log_expense_tool", user_id="U1", vendor="Joe's Diner", amount=30, category="Meals"),
+        planner_step(2, "check_budget_tool", user_id="U1", category="Meals"),
+    ]}
+    result = validate_plan(plan, "U1", REQUEST)
+    assert result["valid"] and result["repairs"] == []
+    assert result["plan"]["plan_steps"] == plan["plan_steps"]
+
+
+def test_repairs_user_id_amount_and_missing_budget_check():
+    plan = {"critique": "", "plan_steps": [
+        planner_step(1, "log_expense_tool", vendor="Joe's Diner", amount="$30", category="Meals"),
+    ]}
+    result = validate_plan(plan, "U1", REQUEST)
+    assert result["valid"]
+    steps = result["plan"]["plan_steps"]
+    assert [s["tool_name"] for s in steps] == ["log_expense_tool", "check_budget_tool"]
+    assert [s["step_number"] for s in steps] == [1, 2]
+    assert steps[0]["arguments"] == {"user_id": "U1", "vendor": "Joe's Diner", "amount": 30.0, "category": "Meals"}
+    assert steps[1]["arguments"] == {"user_id": "U1", "category": "Meals"}
+
+
+def test_unknown_tool_or_invented_amount_needs_the_judge():
+    unknown = {"plan_steps": [planner_step(1, "delete_expense_tool", user_id="U1")]}
+    invented = {"plan_steps": [
+        planner_step(1, "log_expense_tool", user_id="U1", vendor="Joe's Diner", amount=300, category="Meals"),
+    ]}
+    assert not validate_plan(unknown, "U1", REQUEST)["valid"]
+    assert not validate_plan(invented, "U1", REQUEST)["valid"]
+
+
+def test_plans_must_log_each_expense_exactly_once():
+    check = planner_step(1, "check_budget_tool", user_id="U1", category="Meals")
+    log = planner_step(1, "log_expense_tool", user_id="U1", vendor="Joe's Diner", amount=30, category="Meals")
+    assert not validate_plan({"plan_steps": [check]}, "U1", REQUEST)["valid"]
+    duplicated = validate_plan({"plan_steps": [log, dict(log), check]}, "U1", REQUEST)
+    assert not duplicated["valid"] and "Step 2 logs the same expense twice." in duplicated["problems"]
+
+
+def test_batch_plans_log_one_expense_per_line_item():
+    report = "Expense report with 2 line items:\n1. $12 lunch at Joe's Diner\n2. $12 lunch at Joe's Diner"
+    log = planner_step(1, "log_expense_tool", user_id="U1", vendor="Joe's Diner", amount=12, category="Meals")
+    assert validate_plan({"plan_steps": [log, dict(log)]}, "U1", report, batch=True)["valid"]
+    assert not validate_plan({"plan_steps": [log]}, "U1", report, batch=True)["valid"]
+    assert not validate_plan({"plan_steps": [log, dict(log), dict(log)]}, "U1", report, batch=True)["valid"]
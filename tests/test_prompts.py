@@ -0,0 +1,104 @@
+# tests/test_prompts.py
+import asyncio
+import json
+import time
+
+from agent import metrics
+from agent.fake_llm import FakeGeminiClient
+from agent.planner import JUDGE_PROMPT, _judge_request
+from agent.prompts import ContextCache, compact_history, compact_instruction, compact_plan_text
+from agent.summarizer import build_summary_prompt, summarize
+
+
+class CachingClient:
+    """Records caches.create calls; stands in for genai.Client."""
+    def __init__(self, fail=False, latency=0.0):
+        self.created = []
+        self.fail = fail
+        self.latency = latency
+        self.caches = self
+
+    def create(self, *, model, config):
+        time.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError("CachedContent not supported")
+        self.created.append(config.system_instruction)
+        return type("CachedContent", (), {"name": f"cachedContents/{len(self.created)}"})()
+
+
+BUDGET_STEP = {
+    "tool_name": "check_budget_tool", "status": "SUCCESS",
+    "result": {"category": "Hardware", "total_spent": 520.0, "limit": 500.0, "status": "OVER BUDGET",
+               "period": "all", "message": "Budget for Hardware: Spent $520.00 of $500.00. Status: OVER BUDGET"},
+}
+
+
+def test_history_and_plans_are_minified_without_losing_what_the_model_needs():
+    compact = compact_history([{"tool_name": "log_expense_tool", "status": "SUCCESS", "result": "Logged $520.00", "error": None}, BUDGET_STEP])
+    assert "error" not in compact[0] and "message" not in compact[1]["result"]
+    assert compact[1]["result"]["status"] == "OVER BUDGET"
+
+    prompt = build_summary_prompt([BUDGET_STEP])
+    assert "\n  " not in prompt and len(prompt) < len(json.dumps([BUDGET_STEP], indent=2))
+
+    plan = json.dumps({"critique": "", "plan_steps": [{"tool_name": "log_expense_tool", "arguments": {}}]}, indent=2)
+    assert json.loads(compact_plan_text(plan)) == {"plan_steps": [{"tool_name": "log_expense_tool", "arguments": {}}]}
+    assert compact_plan_text("not json") == "not json"
+
+
+def test_instructions_are_compacted_once_and_savings_are_reported():
+    instruction, saved = compact_instruction("  RULES:\n\n    1.   Be   brief.   \n")
+    assert instruction == "RULES:\n1. Be brief." and saved > 0
+
+    with metrics.track_request() as timings:
+        _judge_request("Lunch $12", json.dumps({"critique": "", "plan_steps": []}, indent=4))
+    assert timings.to_dict()["tokens_saved"]["judge"]["compaction"] > 0
+
+
+def test_context_cache_handles_are_created_once_and_reused():
+    cache = ContextCache(min_tokens=0, ttl_seconds=3600)
+    client = CachingClient()
+
+    handles = {cache.handle(client, "gemini-2.5-flash", "STATIC PROMPT") for _ in range(3)}
+    assert handles == {"cachedContents/1"} and client.created == ["STATIC PROMPT"]
+    assert cache.stats()["hits"] == 2
+
+
+def test_async_handles_are_created_off_the_event_loop():
+    cache = ContextCache(min_tokens=0)
+    client = CachingClient(latency=0.2)
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        handles = await asyncio.gather(*(cache.handle_async(client, "gemini-2.5-flash", "STATIC PROMPT") for _ in range(3)))
+        task.cancel()
+        return handles, ticks
+
+    handles, ticks = asyncio.run(scenario())
+    assert set(handles) == {"cachedContents/1"} and client.created == ["STATIC PROMPT"]
+    assert ticks >= 5  # The loop kept running while the handle was created
+    assert cache.handle(client, "gemini-2.5-flash", "STATIC PROMPT") == "cachedContents/1"
+
+
+def test_context_cache_falls_back_to_inline_prompts():
+    short = ContextCache(min_tokens=1024)
+    assert short.handle(CachingClient(), "gemini-2.5-flash", JUDGE_PROMPT) is None  # Below the cacheable size
+
+    failing, client = ContextCache(min_tokens=0, retry_seconds=600), CachingClient(fail=True)
+    assert failing.handle(client, "gemini-2.5-flash", "STATIC PROMPT") is None
+    assert failing.handle(client, "gemini-2.5-flash", "STATIC PROMPT") is None
+    assert failing.stats()["failures"] == 1  # The failure is remembered, not retried per request
+
+    assert ContextCache(min_tokens=0).handle(FakeGeminiClient(), "gemini-2.5-flash", "STATIC PROMPT") is None
+
+
+def test_llm_summary_still_reads_the_status_from_the_compact_history():
+    assert summarize(FakeGeminiClient(), [BUDGET_STEP], mode="llm") == "Audit complete. Warning: OVER BUDGET."
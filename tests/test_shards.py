@@ -0,0 +1,148 @@
+# tests/test_shards.py
+import asyncio
+import io
+
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from agent.db import Budget, Expense
+from agent.fake_llm import FakeGeminiClient
+from agent.main import run_auditor, run_auditor_async
+from agent.shards import ShardRouter, _copy_users, rebalance, shard_index, shard_stats, spend_report
+from agent import statement_import
+from agent.statement_import import import_statement
+from agent.tools import _check_budget_core, _log_expense_core
+from agent.writer import get_writer
+
+USERS = [f"U{n}" for n in range(40)]
+
+
+def make_router(tmp_path, count):
+    return ShardRouter(count, f"sqlite:///{tmp_path}/shard{{index}}.db", main_url=f"sqlite:///{tmp_path}/main.db")
+
+
+def expense_count(engine, user_id=None):
+    statement = select(func.count()).select_from(Expense)
+    if user_id:
+        statement = statement.where(Expense.user_id == user_id)
+    with Session(engine) as session:
+        return session.exec(statement).one()
+
+
+def test_adding_a_shard_only_moves_users_onto_it():
+    before = {user_id: shard_index(user_id, 4) for user_id in map(str, range(2000))}
+    after = {user_id: shard_index(user_id, 5) for user_id in before}
+
+    moved = [user_id for user_id in before if before[user_id] != after[user_id]]
+    assert all(after[user_id] == 4 for user_id in moved)
+    assert 0.1 < len(moved) / len(before) < 0.3  # ~1/5
+    assert min(list(before.values()).count(shard) for shard in range(4)) > 400  # Evenly spread
+
+
+def test_audits_write_to_the_users_shard(tmp_path):
+    router = make_router(tmp_path, 3)
+    users = USERS[:6]
+    for user_id in users:
+        report = run_auditor(user_id, "Spent $30 on a team lunch at Joe's Diner", test_engine=router,
+                             client=FakeGeminiClient())
+        assert "Meals" in report["final_report"]
+
+    async def audit_async():
+        return await run_auditor_async(users[0], "Spent $20 on a team lunch at Joe's Diner", test_engine=router,
+                                       client=FakeGeminiClient())
+    asyncio.run(audit_async())
+
+    for user_id in users:
+        home = router.shard_for(user_id)
+        counts = [expense_count(router.engine(index), user_id) for index in range(3)]
+        assert counts[home] == (2 if user_id == users[0] else 1) and sum(counts) == counts[home]
+    assert _check_budget_core(users[0], "Meals", db_engine=router)["total_spent"] == 50.0
+
+
+def test_rebalance_moves_rows_and_rollups_and_survives_a_rerun(tmp_path):
+    single = make_router(tmp_path, 1)
+    with Session(single.engine(0)) as session:
+        session.add_all([Budget(user_id=user_id, limit=25.0, category="Meals") for user_id in USERS])
+        session.commit()
+    for user_id in USERS:
+        for amount in (10.0, 20.0):
+            _log_expense_core(user_id, "Joe's Diner", amount, "Meals", db_engine=single)
+
+    sharded = make_router(tmp_path, 4)
+    stray = next(user_id for user_id in USERS if sharded.shard_for(user_id) != 0)
+    # A crash after an earlier run copied `stray` but before it deleted the source rows
+    with Session(single.engine(0)) as session:
+        rows = [{"user_id": e.user_id, "vendor": e.vendor, "amount": e.amount, "category": e.category,
+                 "is_flagged": e.is_flagged, "created_at": e.created_at}
+                for e in session.exec(select(Expense).where(Expense.user_id == stray))]
+    get_writer(sharded.engine_for(stray)).run(lambda session: _copy_users(session, [stray], rows, []))
+
+    report = rebalance(sharded, from_count=1)
+
+    assert report["users_moved"] == sum(sharded.shard_for(user_id) != 0 for user_id in USERS)
+    assert report["expenses_moved"] == 2 * report["users_moved"] - 2  # stray's rows were already copied
+    for user_id in USERS:
+        assert expense_count(sharded.engine_for(user_id), user_id) == 2
+        status = _check_budget_core(user_id, "Meals", db_engine=sharded)
+        assert (status["total_spent"], status["limit"], status["status"]) == (30.0, 25.0, "OVER BUDGET")
+    assert rebalance(sharded, from_count=1)["users_moved"] == 0
+    assert sum(shard["expenses"] for shard in shard_stats(sharded)) == 2 * len(USERS)
+
+
+def test_reports_merge_every_shard(tmp_path):
+    router = make_router(tmp_path, 3)
+    for n, user_id in enumerate(USERS[:9]):
+        _log_expense_core(user_id, "BestBuy", 100.0 + n, "Hardware", db_engine=router)
+        _log_expense_core(user_id, "Joe's Diner", 10.0, "Meals", db_engine=router)
+
+    by_category = spend_report(router)
+    assert by_category == [{"category": "Hardware", "total": 936.0, "count": 9},
+                           {"category": "Meals", "total": 90.0, "count": 9}]
+    assert spend_report(router, by="user", top=1) == [{"user": USERS[8], "total": 118.0, "count": 2}]
+
+
+def test_statement_import_splits_rows_across_shards(tmp_path):
+    router = make_router(tmp_path, 3)
+    users = USERS[:8]
+    statement = "User,Date,Vendor,Amount,Category\n" + "".join(
+        f"{user_id},2026-10-0{day},Cafe Central,{day}.00,Meals\n" for day in (1, 2) for user_id in users
+    )
+
+    report = import_statement(io.StringIO(statement), "csv", import_id="oct", db_engine=router, chunk_size=5)
+
+    assert (report["status"], report["rows_imported"]) == ("completed", 16)
+    assert [budget["user_id"] for budget in report["budgets"]] == users
+    for user_id in users:
+        assert expense_count(router.engine_for(user_id), user_id) == 2
+    rerun = import_statement(io.StringIO(statement), "csv", import_id="oct", db_engine=router)
+    assert rerun["rows_imported"] == 16 and sum(shard["expenses"] for shard in shard_stats(router)) == 16
+
+
+def test_resumed_import_only_categorizes_rows_its_lagging_shard_still_needs(tmp_path, monkeypatch):
+    router = make_router(tmp_path, 2)
+    ahead, behind = (next(user_id for user_id in USERS if router.shard_for(user_id) == shard) for shard in (0, 1))
+    statement = "User,Date,Vendor,Amount\n" + "".join(
+        f"{user_id},2026-10-0{day},{vendor},{day}.00\n"
+        for day, vendor in ((1, "Acme Corp"), (2, "Initech")) for user_id in (ahead, behind)
+    )
+
+    insert_chunk = statement_import._insert_chunk
+
+    def failing_on_one_shard(session, expenses, progress):
+        if session.get_bind() is router.engine(1):
+            raise RuntimeError("shard 1 unavailable")
+        return insert_chunk(session, expenses, progress)
+
+    monkeypatch.setattr(statement_import, "_insert_chunk", failing_on_one_shard)
+    aborted = import_statement(io.StringIO(statement), "csv", import_id="oct", db_engine=router,
+                               client=FakeGeminiClient(), chunk_size=4, llm_batch_size=1)
+    assert aborted["status"] == "aborted" and expense_count(router.engine(0)) == 2
+
+    monkeypatch.setattr(statement_import, "_insert_chunk", insert_chunk)
+    client = FakeGeminiClient()
+    resumed = import_statement(io.StringIO(statement), "csv", import_id="oct", db_engine=router,
+                               client=client, chunk_size=4, llm_batch_size=1)
+
+    assert resumed["status"] == "completed" and client.calls["categorize"] == 2  # Only the lagging shard's rows
+    assert set(map(tuple, resumed["affected"])) == {(ahead, "General"), (behind, "General")}
+    assert (expense_count(router.engine(0)), expense_count(router.engine(1))) == (2, 2)
@@ -0,0 +1,48 @@
+# tests/test_startup.py
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_CHECK = """
+import os, sys
+import agent.main
+assert 'google.genai' not in sys.modules, 'google.genai imported eagerly'
+assert not os.path.exists('poc_main.db'), 'database touched at import'
+import client_config
+assert client_config._client is None, 'LLM client built at import'
+"""
+
+
+def test_importing_the_agent_has_no_side_effects(tmp_path):
+    env = {**os.environ, "PYTHONPATH": ROOT}
+    result = subprocess.run([sys.executable, "-c", IMPORT_CHECK], cwd=tmp_path, env=env,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_init_db_creates_the_schema_on_demand(tmp_path):
+    from sqlalchemy import inspect
+    from agent.db import create_db_engine, init_db
+
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    assert not inspect(engine).has_table("expense")
+    init_db(engine)
+    assert {"expense", "budget", "spendrollup"} <= set(inspect(engine).get_table_names())
+
+
+def test_tool_declarations_are_built_once_per_client_without_pinning_it():
+    import gc
+    import weakref
+    from google import genai
+    from agent.tools import get_available_tool_declarations
+
+    client = genai.Client(api_key="test-key")
+    declarations = get_available_tool_declarations(client)
+    assert get_available_tool_declarations(client) is declarations
+
+    collected = weakref.ref(client)
+    del client
+    gc.collect()
+    assert collected() is None
@@ -0,0 +1,92 @@
+# tests/test_statement_import.py
+import io
+import json
+
+from sqlmodel import select
+
+from agent.db import get_db_engine, Budget, Expense, ImportCheckpoint, Session
+from agent.fake_llm import FakeGeminiClient
+from agent.tools import _check_budget_core
+from agent.statement_import import import_statement
+
+STATEMENT_CSV = """Date,Vendor,Amount,Category,Description
+2026-10-01,BestBuy,"1,200.00",hardware,
+2026-10-02,Joe's Diner,18.50,,team lunch
+2026-10-03,Acme Corp,99.00,,
+2026-10-04,Cafe Central,12.00,Meals,
+2026-10-05,,5.00,Meals,
+2026-10-06,Globex,not a number,,
+2026-10-07,Initech,45.00,,
+"""
+
+
+class FailingClient:
+    class models:
+        @staticmethod
+        def generate_content(**kwargs):
+            raise RuntimeError("categorizer unavailable")
+
+
+def seeded_engine():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    with Session(engine) as session:
+        session.add(Budget(user_id="U1", limit=1000.0, category="Hardware"))
+        session.commit()
+    return engine
+
+
+def test_structured_rows_skip_the_llm_and_budgets_are_checked_once():
+    engine, client = seeded_engine(), FakeGeminiClient()
+
+    report = import_statement(io.StringIO(STATEMENT_CSV), "csv", user_id="U1", import_id="oct",
+                              db_engine=engine, client=client, chunk_size=3, llm_batch_size=10)
+
+    assert report["status"] == "completed"
+    assert (report["rows_done"], report["rows_imported"], report["rows_skipped"]) == (7, 5, 2)
+    # Acme Corp and Initech are the only rows without a given or keyword category
+    assert report["llm_resolved"] == 2 and client.calls["categorize"] == 2
+    with Session(engine) as session:
+        categories = {e.vendor: e.category for e in session.exec(select(Expense)).all()}
+    assert categories == {"BestBuy": "Hardware", "Joe's Diner": "Meals", "Acme Corp": "General",
+                          "Cafe Central": "Meals", "Initech": "General"}
+
+    budgets = {b["category"]: b for b in report["budgets"]}
+    assert sorted(budgets) == ["General", "Hardware", "Meals"]
+    assert budgets["Hardware"]["status"] == "OVER BUDGET"
+    assert _check_budget_core("U1", "Meals", db_engine=engine)["total_spent"] == 30.5
+
+
+def test_interrupted_import_resumes_from_the_checkpoint():
+    engine = seeded_engine()
+
+    aborted = import_statement(io.StringIO(STATEMENT_CSV), "csv", user_id="U1", import_id="oct",
+                               db_engine=engine, client=FailingClient(), chunk_size=2)
+    assert aborted["status"] == "aborted" and "categorizer unavailable" in aborted["error"]
+    assert aborted["rows_done"] == 2  # The first chunk needs no LLM and was committed
+
+    resumed = import_statement(io.StringIO(STATEMENT_CSV), "csv", user_id="U1", import_id="oct",
+                               db_engine=engine, client=FakeGeminiClient(), chunk_size=2)
+    assert resumed["status"] == "completed" and resumed["resumed_from"] == 2
+    with Session(engine) as session:
+        assert len(session.exec(select(Expense)).all()) == 5
+        assert session.get(ImportCheckpoint, "oct").completed
+
+    again = import_statement(io.StringIO(STATEMENT_CSV), "csv", user_id="U1", import_id="oct",
+                             db_engine=engine, client=FailingClient())
+    assert again["status"] == "completed" and again["rows_imported"] == 5
+
+
+def test_jsonl_rows_carry_their_own_user_and_bad_lines_are_skipped():
+    engine = seeded_engine()
+    lines = [
+        json.dumps({"user_id": "U2", "merchant": "Delta", "amount": 320, "memo": "flight to NYC"}),
+        "{not json",
+        json.dumps({"merchant": "Orphan", "amount": 1, "category": "Meals"}),
+        json.dumps({"user_id": "U3", "vendor": "Staples", "amount": "(15.00)", "category": "Office Supplies"}),
+    ]
+
+    report = import_statement(io.StringIO("\n".join(lines)), "jsonl", db_engine=engine, client=FailingClient())
+
+    assert (report["rows_imported"], report["rows_skipped"], report["llm_resolved"]) == (2, 2, 0)
+    assert sorted(report["affected"]) == [["U2", "Travel"], ["U3", "Office Supplies"]]
+    assert _check_budget_core("U3", "Office Supplies", db_engine=engine)["total_spent"] == -15.0
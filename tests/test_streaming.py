@@ -0,0 +1,72 @@
+# tests/test_streaming.py
+import asyncio
+import json
+from functools import partial
+
+from fastapi.testclient import TestClient
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import main
+from agent.db import get_async_db_engine, init_async_db, Budget
+from agent.fake_llm import FakeGeminiClient
+from agent.main import stream_auditor
+from agent.plan_cache import PLAN_CACHE
+
+REQUEST = "Spent 30 bucks on a team lunch at Joe's Diner"  # Planned by the planner LLM
+
+
+async def seeded_async_engine():
+    engine = get_async_db_engine(engine_url="sqlite+aiosqlite:///:memory:")
+    await init_async_db(engine)
+    async with AsyncSession(engine) as session:
+        session.add(Budget(user_id="U1", limit=20.0, category="Meals"))
+        await session.commit()
+    return engine
+
+
+def test_stream_emits_each_phase_in_order():
+    PLAN_CACHE.clear()
+
+    async def scenario():
+        engine = await seeded_async_engine()
+        events = [event async for event in stream_auditor("U1", REQUEST, test_engine=engine, client=FakeGeminiClient())]
+        await engine.dispose()
+        return events
+
+    events = asyncio.run(scenario())
+    names = [name for name, _ in events]
+    steps = [payload for name, payload in events if name == "step"]
+
+    assert names[:2] == ["plan", "critique"] and names[-1] == "done"
+    assert names[2:-1] == ["step"] * len(steps) + ["summary"] * (len(names) - 3 - len(steps))
+    assert "summary" in names
+    assert [step["tool_name"] for step in steps] == ["log_expense_tool", "check_budget_tool"]
+    assert [step["step_number"] for step in steps] == [1, 2]
+
+    done = events[-1][1]
+    assert done["final_report"] == "".join(payload for name, payload in events if name == "summary")
+    assert "OVER BUDGET" in done["final_report"]
+    assert done["full_history"] == [{k: v for k, v in step.items() if k != "step_number"} for step in steps]
+    assert done["plan_details"]["plan_steps"] == events[1][1]["plan_steps"]
+
+
+def test_stream_endpoint_frames_server_sent_events(monkeypatch):
+    PLAN_CACHE.clear()
+    engine = asyncio.run(seeded_async_engine())
+    monkeypatch.setattr(main, "_missing_api_key", lambda: False)
+    monkeypatch.setattr(main, "stream_auditor", partial(stream_auditor, test_engine=engine, client=FakeGeminiClient()))
+
+    response = TestClient(main.app).post("/process_expense/stream", json={"user_id": "U1", "expense_text": REQUEST})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.headers["cache-control"] == "no-cache"
+    frames = response.text.split("\n\n")
+    assert frames[-1] == ""  # Every event ends with a blank line
+    events = []
+    for frame in frames[:-1]:
+        event_line, data_line = frame.split("\n")
+        assert event_line.startswith("event: ") and data_line.startswith("data: ")
+        events.append((event_line[len("event: "):], json.loads(data_line[len("data: "):])))
+    assert [name for name, _ in events][:2] == ["plan", "critique"]
+    assert events[-1][0] == "done" and "OVER BUDGET" in events[-1][1]["final_report"]
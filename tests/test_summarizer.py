@@ -0,0 +1,44 @@
+# tests/test_summarizer.py
+from agent.summarizer import render_template_summary, needs_llm_summary, summarize
+
+
+def budget_entry(total_spent, limit, status):
+    return {"tool_name": "check_budget_tool", "status": "SUCCESS", "result": {
+        "category": "Meals", "total_spent": total_spent, "limit": limit, "status": status, "period": "all",
+    }}
+
+
+LOG_ENTRY = {"tool_name": "log_expense_tool", "status": "SUCCESS",
+             "result": "Successfully logged expense ID 1 for $45.5 at Cafe Central. Now checking budget."}
+
+
+class FailingClient:
+    class models:
+        @staticmethod
+        def generate_content(**kwargs):
+            raise RuntimeError("429 RESOURCE_EXHAUSTED")
+
+
+def test_template_states_budget_status():
+    under = render_template_summary([LOG_ENTRY, budget_entry(45.5, 100.0, "Under Budget")])
+    over = render_template_summary([LOG_ENTRY, budget_entry(520.0, 500.0, "OVER BUDGET")])
+    assert "Status: Under Budget" in under
+    assert "OVER BUDGET" in over and "Status: Under Budget" not in over
+
+
+def test_hybrid_escalates_only_unusual_histories():
+    assert not needs_llm_summary([LOG_ENTRY, budget_entry(45.5, 100.0, "Under Budget")])
+    assert needs_llm_summary([LOG_ENTRY])
+    assert needs_llm_summary([{**LOG_ENTRY, "status": "FAILED"}, budget_entry(0.0, 100.0, "Under Budget")])
+
+
+def test_template_and_hybrid_modes_make_no_llm_call():
+    history = [LOG_ENTRY, budget_entry(45.5, 100.0, "Under Budget")]
+    assert "Status: Under Budget" in summarize(FailingClient(), history, mode="template")
+    assert "Status: Under Budget" in summarize(FailingClient(), history, mode="hybrid")
+
+
+def test_llm_mode_keeps_error_report_and_hybrid_falls_back():
+    history = [{**LOG_ENTRY, "status": "FAILED", "result": "boom"}]
+    assert summarize(FailingClient(), history, mode="llm").startswith("SUMMARIZATION ERROR")
+    assert "FAILED: boom" in summarize(FailingClient(), history, mode="hybrid")
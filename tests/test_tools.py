@@ -0,0 +1,104 @@
+# tests/test_tools.py
+import asyncio
+import sqlite3
+from datetime import datetime, timezone
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from agent.db import get_db_engine, get_async_db_engine, init_async_db, Budget, Expense, SpendRollup, Session
+from agent.rollups import rebuild_rollups, current_period_key
+from agent.tools import (
+    _log_expense_core, _check_budget_core,
+    _log_expense_core_async, _check_budget_core_async,
+)
+
+
+def seed_budget(engine, user_id, category, limit):
+    with Session(engine) as session:
+        session.add(Budget(user_id=user_id, limit=limit, category=category))
+        session.commit()
+
+
+def test_log_then_check_budget_sync():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    seed_budget(engine, "U1", "Meals", 100.0)
+
+    message = _log_expense_core("U1", "Cafe Central", 45.5, "Meals", db_engine=engine)
+    assert "Successfully logged expense ID 1" in message
+
+    status = _check_budget_core("U1", "Meals", db_engine=engine)
+    assert status["total_spent"] == 45.5
+    assert status["status"] == "Under Budget"
+
+
+def test_log_then_check_budget_async():
+    async def scenario():
+        engine = get_async_db_engine(engine_url="sqlite+aiosqlite:///:memory:")
+        await init_async_db(engine)
+        async with AsyncSession(engine) as session:
+            session.add(Budget(user_id="U1", limit=500.0, category="Hardware"))
+            await session.commit()
+
+        await _log_expense_core_async("U1", "BestBuy", 520.0, "Hardware", db_engine=engine)
+        status = await _check_budget_core_async("U1", "Hardware", db_engine=engine)
+        await engine.dispose()
+        return status
+
+    status = asyncio.run(scenario())
+    assert status["total_spent"] == 520.0
+    assert status["status"] == "OVER BUDGET"
+
+
+def test_monthly_budget_only_counts_current_month():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    with Session(engine) as session:
+        session.add(Budget(user_id="U1", limit=100.0, category="Meals", period="month"))
+        session.add(Expense(user_id="U1", vendor="Old Diner", amount=500.0, category="Meals",
+                            created_at=datetime(2020, 1, 15, tzinfo=timezone.utc)))
+        session.commit()
+    rebuild_rollups(engine)
+
+    _log_expense_core("U1", "Cafe Central", 45.5, "Meals", db_engine=engine)
+    status = _check_budget_core("U1", "Meals", db_engine=engine)
+
+    assert status["period"] == current_period_key("month")
+    assert status["total_spent"] == 45.5
+    assert status["status"] == "Under Budget"
+
+
+def test_rebuild_matches_incremental_rollups():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    for amount in (10.0, 20.0, 12.5):
+        _log_expense_core("U1", "Diner", amount, "Meals", db_engine=engine)
+    with Session(engine) as session:
+        incremental = sorted((r.period, r.total, r.count) for r in session.exec(select(SpendRollup)).all())
+
+    rebuild_rollups(engine)
+    with Session(engine) as session:
+        rebuilt = sorted((r.period, r.total, r.count) for r in session.exec(select(SpendRollup)).all())
+
+    assert rebuilt == incremental
+    assert ("all", 42.5, 3) in rebuilt
+
+
+def test_upgrading_a_database_backfills_its_rollups(tmp_path):
+    path = tmp_path / "old.db"
+    with sqlite3.connect(path) as conn:  # The schema from before rollups and timestamps
+        conn.executescript("""
+            CREATE TABLE expense (id INTEGER PRIMARY KEY, user_id VARCHAR NOT NULL, vendor VARCHAR NOT NULL,
+                                  amount FLOAT NOT NULL, category VARCHAR NOT NULL, is_flagged BOOLEAN NOT NULL);
+            CREATE TABLE budget (id INTEGER PRIMARY KEY, user_id VARCHAR NOT NULL UNIQUE, "limit" FLOAT NOT NULL,
+                                 category VARCHAR NOT NULL);
+            INSERT INTO expense VALUES (1, 'U1', 'BestBuy', 600.0, 'Hardware', 0), (2, 'U1', 'BestBuy', 300.0, 'Hardware', 0);
+            INSERT INTO budget VALUES (1, 'U1', 500.0, 'Hardware');
+        """)
+    conn.close()
+
+    engine = get_db_engine(engine_url=f"sqlite:///{path}")
+    status = _check_budget_core("U1", "Hardware", db_engine=engine)
+    assert status["total_spent"] == 900.0 and status["status"] == "OVER BUDGET"
+
+    _log_expense_core("U1", "BestBuy", 10.0, "Hardware", db_engine=engine)
+    get_db_engine(engine_url=f"sqlite:///{path}")  # Later startups do not count the history twice
+    assert _check_budget_core("U1", "Hardware", db_engine=engine)["total_spent"] == 910.0
@@ -0,0 +1,111 @@
+# tests/test_vendor_index.py
+from agent.db import Session, get_db_engine
+from agent.planner import FAST_PATH_MIN_CONFIDENCE, extract_expense_fields, run_planner_auditor
+from agent.tools import _log_expense_core
+from agent.vendor_index import VendorIndex, normalize_vendor
+from agent.writer import run_job_batch
+
+
+class ExplodingClient:
+    """Any LLM call from the planner is a test failure."""
+    class models:
+        @staticmethod
+        def generate_content(**kwargs):
+            raise AssertionError("planner LLM should not be called")
+
+
+def trained_index(**kwargs):
+    index = VendorIndex(**kwargs)
+    for _ in range(3):
+        index.record("U1", "BestBuy", "Hardware")
+        index.record("U2", "Starbucks Coffee", "Meals")
+    return index
+
+
+def test_vendor_names_are_normalized():
+    assert normalize_vendor("Best Buy #123") == normalize_vendor("BestBuy Inc.") == normalize_vendor("bestbuy.com") == "bestbuy"
+    assert normalize_vendor("SHELL OIL 0453") == "shelloil"
+
+
+def test_exact_prefix_and_fuzzy_lookups():
+    index = trained_index()
+    exact = index.lookup("BEST BUY")
+    assert (exact.category, exact.match, exact.confidence) == ("Hardware", "exact", 1.0)
+    assert index.lookup("Starbucks").match == "prefix"
+    assert index.lookup("Bestbyu").match == "fuzzy"
+    assert index.lookup("Unheard Of Ltd") is None
+
+
+def test_user_history_overrides_the_global_consensus():
+    index = trained_index()
+    index.record("U9", "BestBuy", "Office Supplies")
+
+    assert index.lookup("BestBuy", "U9").category == "Office Supplies"
+    assert index.lookup("BestBuy", "U1").category == "Hardware"
+    assert index.lookup("BestBuy").category == "Hardware"
+
+
+def test_memory_is_bounded_by_lru_eviction():
+    index = VendorIndex(max_vendors=2, max_user_entries=2)
+    for vendor in ("Alpha", "Bravo", "Charlie"):
+        index.record("U1", vendor, "Meals")
+
+    assert index.stats()["vendors"] == 2 and index.stats()["user_entries"] == 2
+    assert index.lookup("Alpha") is None and index.lookup("Charlie") is not None
+
+
+def test_snapshot_warm_start_only_replays_new_rows(tmp_path):
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    for amount in (10.0, 20.0, 30.0):
+        _log_expense_core("U1", "Acme Supply", amount, "Office Supplies", db_engine=engine)
+
+    built = VendorIndex()
+    built.build_from_db(engine)
+    built.save_snapshot(str(tmp_path / "vendors.json"))
+
+    _log_expense_core("U1", "Acme Supply", 5.0, "Office Supplies", db_engine=engine)
+    warm = VendorIndex(snapshot_path=str(tmp_path / "vendors.json"))
+    assert warm.warm_start(engine) == 1  # Only the expense logged after the snapshot
+    assert warm.lookup("Acme Supply").observations == 4
+
+
+def test_fast_path_takes_the_category_from_vendor_history():
+    index = VendorIndex()
+    for _ in range(3):
+        index.record("U1", "Acme Supply", "Office Supplies")
+
+    result = run_planner_auditor(ExplodingClient(), "U1", "Paid $89.99 at Acme Supply", vendor_index=index)
+
+    log_step = result["plan_steps"][0]["arguments"]
+    assert (log_step["vendor"], log_step["category"]) == ("Acme Supply", "Office Supplies")
+
+
+def test_vendor_history_contradicting_a_keyword_defers_to_the_planner():
+    index = VendorIndex()
+    index.record("U9", "BestBuy", "Hardware", count=500)
+
+    fields = extract_expense_fields("$80 for a coffee maker at BestBuy", "U9", index)
+    assert fields["category"] is None and fields["confidence"] < FAST_PATH_MIN_CONFIDENCE
+    # Without history, the keyword alone still makes it a confident Meals expense
+    assert extract_expense_fields("$80 for a coffee maker at BestBuy", "U9")["category"] == "Meals"
+
+
+def test_rolled_back_expenses_are_not_learned():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    index = VendorIndex()
+
+    def failing_job(session):
+        index.record_on_commit(session, "U1", "Acme Supply", "Office Supplies", expense_id=1)
+        raise ValueError("job failed")
+
+    with Session(engine) as session:
+        run_job_batch(session, [failing_job, lambda s: index.record_on_commit(s, "U1", "BestBuy", "Hardware", expense_id=2)])
+        assert index.lookup("BestBuy") is None  # Not before the commit
+        session.commit()
+    with Session(engine) as session:
+        index.record_on_commit(session, "U2", "Zed Cafe", "Meals", expense_id=3)
+        session.rollback()
+
+    assert index.lookup("BestBuy").category == "Hardware"
+    assert index.lookup("Acme Supply") is None and index.lookup("Zed Cafe") is None
+    assert index.stats()["high_water"] == {":memory:": 2}
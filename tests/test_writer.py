@@ -0,0 +1,95 @@
+# tests/test_writer.py
+import asyncio
+import gc
+import threading
+
+from sqlmodel import select
+
+from agent.db import get_db_engine, get_async_db_engine, Expense, Session
+from agent.executor import execute_plan
+from agent.tools import _log_expense_in_session
+from agent.writer import GroupCommitWriter, close_writers, get_async_writer, get_writer
+
+
+def test_concurrent_jobs_are_group_committed(tmp_path):
+    engine = get_db_engine(f"sqlite:///{tmp_path / 'writer.db'}")
+    writer = GroupCommitWriter(engine, max_wait=0.05)
+
+    futures = [
+        writer.submit(lambda session, i=i: _log_expense_in_session(session, "U1", f"Vendor {i}", 1.0, "Meals"))
+        for i in range(20)
+    ]
+    assert all("Successfully logged" in f.result() for f in futures)
+    assert writer.stats()["batches"] < 20
+    writer.close()
+
+    with Session(engine) as session:
+        assert len(session.exec(select(Expense)).all()) == 20
+
+
+def test_failing_job_does_not_roll_back_its_batch(tmp_path):
+    engine = get_db_engine(f"sqlite:///{tmp_path / 'writer.db'}")
+    writer = GroupCommitWriter(engine, max_wait=0.05)
+
+    def broken(session):
+        _log_expense_in_session(session, "U1", "Ghost", 99.0, "Meals")
+        raise ValueError("boom")
+
+    good = writer.submit(lambda session: _log_expense_in_session(session, "U1", "Diner", 5.0, "Meals"))
+    bad = writer.submit(broken)
+    assert "Successfully logged" in good.result()
+    assert isinstance(bad.exception(), ValueError)
+    writer.close()
+
+    with Session(engine) as session:
+        assert [e.vendor for e in session.exec(select(Expense)).all()] == ["Diner"]
+
+
+def test_execute_plan_runs_concurrent_plans_through_one_writer():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    plan = [
+        {"step_number": 1, "tool_name": "log_expense_tool",
+         "arguments": {"vendor": "Diner", "amount": 10.0, "category": "Meals"}},
+        {"step_number": 2, "tool_name": "check_budget_tool", "arguments": {"category": "Meals"}},
+    ]
+    histories = []
+    threads = [threading.Thread(target=lambda u=u: histories.append(execute_plan(plan, u, engine))) for u in "ABCDE"]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(histories) == 5
+    for history in histories:
+        assert [h["status"] for h in history] == ["SUCCESS", "SUCCESS"]
+        assert history[1]["result"]["total_spent"] == 10.0
+
+
+def test_writers_stop_with_their_engine():
+    engine = get_db_engine(engine_url="sqlite:///:memory:")
+    writer = get_writer(engine)
+    assert get_writer(engine) is writer
+    writer.run(lambda session: _log_expense_in_session(session, "U1", "Diner", 5.0, "Meals"))
+
+    del engine
+    gc.collect()
+    writer._thread.join(timeout=5)
+    assert not writer._thread.is_alive() and writer.db_engine is None
+
+
+def test_close_writers_drains_sync_and_async_writers(tmp_path):
+    engine = get_db_engine(f"sqlite:///{tmp_path / 'writer.db'}")
+    async_engine = get_async_db_engine(f"sqlite+aiosqlite:///{tmp_path / 'writer.db'}")
+
+    async def scenario():
+        sync_writer, async_writer = get_writer(engine), get_async_writer(async_engine)
+        queued = sync_writer.submit(lambda session: _log_expense_in_session(session, "U1", "Diner", 5.0, "Meals"))
+        await async_writer.run(lambda session: _log_expense_in_session(session, "U1", "Cafe", 3.0, "Meals"))
+        await close_writers()
+        return sync_writer, async_writer, queued
+
+    sync_writer, async_writer, queued = asyncio.run(scenario())
+    assert "Successfully logged" in queued.result()
+    assert not sync_writer._thread.is_alive() and async_writer._task.done()
+    with Session(engine) as session:
+        assert len(session.exec(select(Expense)).all()) == 2